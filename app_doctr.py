@@ -1,16 +1,22 @@
 from datetime import date, datetime
 import copy
+import io
 import json
 import os
-import requests
+import altair as alt
+import numpy as np
+import pandas as pd
 import streamlit as st
 from requests.auth import HTTPBasicAuth
 
+from msfocr import tracing
 from msfocr.data import dhis2
+from msfocr.data.background import BackgroundJob
+from msfocr.data import image_utils
+from msfocr.data import matching
 from msfocr.doctr import ocr_functions as doctr_ocr_functions
 from msfocr.data import post_processing
-from img2table.document import Image
-from img2table.ocr import DocTR
+from msfocr.data.sheet_type import SheetClassifier
 
 # Hardcoded period types and formatting, probably won't update but can get them through API
 PERIOD_TYPES = {
@@ -35,69 +41,124 @@ PERIOD_TYPES = {
 }
 
 PAGE_REVIEWED_INDICATOR = "✓"
+PAGE_PENDING_INDICATOR = "⏳"
+
+# Set MSFOCR_TRACING=1 to time the pipeline and show the timings of the session in a debug panel
+TRACING_ENABLED = os.environ.get("MSFOCR_TRACING", "").lower() in ("1", "true", "yes")
+# Cells whose recognized words have a lower mean OCR confidence are pointed out for review
+LOW_OCR_CONFIDENCE = 0.7
+
+@st.cache_resource
+def get_trace_exporter():
+    """Records the tracing spans of all sessions in memory, set up once per server process."""
+    exporter = tracing.InMemoryExporter()
+    tracing.configure(exporter)
+    return exporter
+
+
+def tracing_panel(trace_exporter):
+    """Debug panel with the waterfall of the pipeline stages timed in this session."""
+    with st.expander("Debug: pipeline timings"):
+        rows = tracing.waterfall(trace_exporter.spans(st.session_state.trace_id))
+        if not rows:
+            st.caption("Nothing timed yet.")
+            return
+        timings = pd.DataFrame(rows)
+        # Numbered, so that repeated calls of the same function get their own bar
+        timings["label"] = [f"{i + 1}. {span}" for i, span in enumerate(timings["span"])]
+        chart = alt.Chart(timings).mark_bar().encode(
+            x=alt.X("start_ms", title="ms"), x2="end_ms",
+            y=alt.Y("label", sort=None, title=None),
+            color="thread",
+            tooltip=["span", "duration_ms", "thread", "attributes", "error"])
+        st.altair_chart(chart, use_container_width=True)
+        st.dataframe(timings.drop(columns=["label"]), hide_index=True)
+        if st.button("Clear timings"):
+            trace_exporter.clear(st.session_state.trace_id)
+            st.rerun()
+
 
 # Wrapper functions
 @st.cache_resource
-def create_ocr():
+def create_ocr_models():
     """
-    Load img2table docTR model  
+    Load one img2table docTR model per recognition worker, in a pool shared by all sessions so that
+    each model is only used by one recognition at a time
     """
-    doctr_ocr = DocTR(detect_language=False)
-    return doctr_ocr
+    return doctr_ocr_functions.create_model_pool(doctr_ocr_functions.create_ocr_models())
 
-@st.cache_data(show_spinner=False)
-def get_tabular_content_wrapper(_doctr_ocr, img):
-    return doctr_ocr_functions.get_tabular_content(_doctr_ocr, img)
+@st.cache_resource(show_spinner=False)
+def get_sheet_classifier(_client, server_url, username):
+    """
+    Builds the sheet type classifier from the data set and org unit names of the DHIS2 server, once per server and user,
+    as the names a user can see depend on their permissions. Called from the recognition job, so no spinner is shown.
+    """
+    return SheetClassifier.from_dhis2(client=_client)
 
 @st.cache_data
-def get_DE_COC_List_wrapper(form):
-    """A wrapper function for caching the get_DE_COC_List function."""
-    dataElement_list, categoryOptionsList =  dhis2.get_DE_COC_List(form)
+def get_DE_COC_List_wrapper(_client, server_url, username, form):
+    """A wrapper function for caching the get_DE_COC_List function Cached per server and user."""
+    dataElement_list, categoryOptionsList =  dhis2.get_DE_COC_List(form, client=_client)
     return dataElement_list, categoryOptionsList
 
 
 @st.cache_data
-def getFormJson_wrapper(data_set_selected_id, period_ID, org_unit_dropdown):
-    """A wrapper function for caching the getFormJson function."""
-    return dhis2.getFormJson(data_set_selected_id, period_ID, org_unit_dropdown)
+def compileForm_wrapper(_client, server_url, username, form):
+    """A wrapper function for caching the compileForm function, so each form is only indexed once Cached per server and user."""
+    return dhis2.compileForm(form, client=_client)
+
+
+@st.cache_data
+def getFormJson_wrapper(_client, server_url, username, data_set_selected_id, period_ID, org_unit_dropdown):
+    """A wrapper function for caching the getFormJson function in memory, on top of its on-disk form cache Cached per server and user."""
+    return dhis2.getFormJson(data_set_selected_id, period_ID, org_unit_dropdown, client=_client)
 
 
 @st.cache_data
-def get_data_sets(data_set_uids):
+def get_data_sets(_client, server_url, username, data_set_uids):
     """
     Retrieves data sets based on their UIDs. Wrapper function.
 
     Usage:
-    data_sets = get_data_sets(["uid1", "uid2"])
+    data_sets = get_data_sets(dhis2_client, dhis2_client.server_url, dhis2_client.username, ["uid1", "uid2"])
 
+    :param _client: DHIS2Client of the current session, not hashed by the cache
+    :param server_url: DHIS2 server URL of the client, part of the cache key
+    :param username: DHIS2 username of the client, part of the cache key so sessions of different users don't share results
     :param data_set_uids: List of data set UIDs
     :return: List of data sets
     """
-    return dhis2.getDataSets(data_set_uids)
+    return dhis2.getDataSets(data_set_uids, client=_client)
 
 
 @st.cache_data
-def get_org_unit_children(org_unit_id):
+def get_org_unit_children(_client, server_url, username, org_unit_id):
     """
     Retrieves children of an organization unit. Wrapper function.
 
     Usage:
-    children = get_org_unit_children("parent_uid")
+    children = get_org_unit_children(dhis2_client, dhis2_client.server_url, dhis2_client.username, "parent_uid")
 
+    :param _client: DHIS2Client of the current session, not hashed by the cache
+    :param server_url: DHIS2 server URL of the client, part of the cache key
+    :param username: DHIS2 username of the client, part of the cache key so sessions of different users don't share results
     :param org_unit_id: UID of the parent organization unit
     :return: List of child organization units
     """
-    return dhis2.getOrgUnitChildren(org_unit_id)
+    return dhis2.getOrgUnitChildren(org_unit_id, client=_client)
 
 
 @st.cache_data
-def dhis2_all_UIDs(item_type, search_items):
+def dhis2_all_UIDs(_client, server_url, username, item_type, search_items):
     """
     Gets all fields similar to search_items from the metadata.
 
     Usage:
-    uids = dhis2_all_UIDs("dataElements", ["Malaria", "HIV"])
+    uids = dhis2_all_UIDs(dhis2_client, dhis2_client.server_url, dhis2_client.username, "dataElements", ["Malaria", "HIV"])
 
+    :param _client: DHIS2Client of the current session, not hashed by the cache
+    :param server_url: DHIS2 server URL of the client, part of the cache key
+    :param username: DHIS2 username of the client, part of the cache key so sessions of different users don't share results
     :param item_type: Defines the type of metadata (dataset, organisation unit, data element) to search
     :param search_items: A list of text to search
     :return: A list of all (name,id) pairs of fields that match the search words
@@ -105,7 +166,7 @@ def dhis2_all_UIDs(item_type, search_items):
     if search_items == "" or search_items is None:
         return []
     else:
-        return dhis2.getAllUIDs(item_type, search_items)
+        return dhis2.getAllUIDs(item_type, search_items, client=_client)
 
 
 def week1_start_ordinal(year):
@@ -187,61 +248,209 @@ def json_export(kv_pairs):
     return json.dumps(json_export)
 
 
+@st.cache_resource
+def get_name_matcher(vocabulary):
+    """Builds the NameMatcher of a vocabulary once and shares it between reruns."""
+    return matching.NameMatcher(vocabulary)
+
+
 def correct_field_names(dfs, form):
     """
-    Corrects the text data in tables by replacing with closest match among the hardcoded fieldnames.
+    Corrects the text data in tables by replacing with closest match among the field names of the DHIS2 form.
+    Corrections with a low similarity score are stored in the session state so they can be shown to the user.
     
     :param dfs: Data as dataframes
     :return: Corrected data as dataframes
     """
-    dataElement_list,categoryOptionsList = get_DE_COC_List_wrapper(form)
-    
-    for table in dfs:
-        for row in range(table.shape[0]):
-            max_similarity_dataElement = 0
-            dataElement = ""
-            text = table.iloc[row,0]
-            if text is not None:
-                for name in dataElement_list:
-                    sim = post_processing.letter_by_letter_similarity(text, name)
-                    if max_similarity_dataElement < sim:
-                        max_similarity_dataElement = sim
-                        dataElement = name
-                table.iloc[row,0] = dataElement
-
-    for table in dfs:
-        for id,col in enumerate(table.columns):
-            max_similarity_catOpt = 0
-            catOpt = ""
-            text = table.iloc[0,id]
-            if text is not None:
-                for name in categoryOptionsList:
-                    sim =  post_processing.letter_by_letter_similarity(text, name)
-                    if max_similarity_catOpt < sim:
-                        max_similarity_catOpt = sim
-                        catOpt = name
-                table.iloc[0,id] = catOpt
+    dataElement_list,categoryOptionsList = get_DE_COC_List_wrapper(dhis2_client, dhis2_client.server_url, dhis2_client.username, form)
+    st.session_state.low_confidence_corrections = matching.correct_table_names(dfs,
+                                                                              get_name_matcher(tuple(dataElement_list)),
+                                                                              get_name_matcher(tuple(categoryOptionsList)))
     return dfs        
 
 
-def set_first_row_as_header(df):
+def page_number(page_label):
+    """Page number of a page selector label, without the reviewed or pending indicator."""
+    return int(page_label.replace(PAGE_REVIEWED_INDICATOR, "").replace(PAGE_PENDING_INDICATOR, "").strip())
+
+
+def start_recognition(tally_sheet_images, ocr_models, dhis2_client):
+    """
+    Starts recognizing the uploaded tally sheets in a background job, so pages can be reviewed as soon as they are recognized.
+    :param tally_sheet_images: Uploaded image files
+    :param ocr_models: Pool of img2table DocTR models shared by all sessions, see create_model_pool
+    :param dhis2_client: DHIS2Client of the session, whose data set and org unit names are used to find the sheet type of each page
+    :return: Started BackgroundJob, with the result of get_sheet_content or the exception of each page
     """
-    Sets the first row in the recognized table (ideally the header information for each column) as the table header
-    :param Dataframe
-    :return Dataframe after correction
+    # The job gets its own copy of the uploads, so displaying an image never moves the file position under it
+    pages = [io.BytesIO(sheet.getvalue()) for sheet in tally_sheet_images]
+
+    def recognize(on_result):
+        # Downloading all names can take a while on large servers, so it is done here instead of delaying the page
+        try:
+            sheet_classifier = get_sheet_classifier(dhis2_client, dhis2_client.server_url, dhis2_client.username)
+        except Exception:
+            # The sheet type is only a suggestion, the known sheet types are good enough to go on with
+            sheet_classifier = None
+        # A page that fails, e.g. an unreadable image, doesn't discard the other pages
+        for i, content in doctr_ocr_functions.iter_sheet_content(pages, ocr_models, sheet_classifier, return_exceptions=True):
+            if job.cancelled:
+                break
+            on_result(i, content)
+
+    job = BackgroundJob(recognize, len(pages))
+    return job.start()
+
+
+def collect_recognized_pages(job):
+    """Adds the tables of the pages recognized since the previous run to the session state."""
+    results = job.results()
+    new_pages = sorted(set(results) - st.session_state.pages_loaded)
+    for i in new_pages:
+        st.session_state.pages_loaded.add(i)
+        if isinstance(results[i], Exception):
+            st.session_state['recognition_errors'].append(f"Page {i + 1} could not be recognized, please upload it again. ({results[i]})")
+            continue
+        table_df, confidence_df, sheet_type = results[i]
+        table_df = post_processing.evaluate_cells(post_processing.clean_up(table_df))
+        st.session_state.table_dfs.extend(table_df)
+        st.session_state.table_confidences.extend(confidence_df)
+        st.session_state.sheet_types[i] = sheet_type
+        st.session_state.page_nums.extend([str(i + 1)] * len(table_df))
+    if new_pages:
+        st.session_state.pages_confirmed = all_pages_confirmed(job)
+    if job.error is not None and len(st.session_state.pages_loaded) < job.n_items:
+        st.error(f"Image recognition stopped, please clear the form and upload the images again. ({job.error})")
+
+
+def all_pages_confirmed(job):
+    """True once every page has been recognized and all recognized pages are confirmed by the user."""
+    return (len(st.session_state.pages_loaded) == job.n_items
+            and all(ele.endswith(PAGE_REVIEWED_INDICATOR) for ele in st.session_state.page_nums))
+
+
+@st.fragment(run_every=1)
+def recognition_progress(job):
+    """Shows the progress of the background recognition, rerunning the app whenever new pages are ready."""
+    if len(job.results()) > len(st.session_state.pages_loaded) or job.error is not None:
+        st.rerun()
+    st.progress(job.progress(), text=f"Recognized {len(st.session_state.pages_loaded)} of {job.n_items} pages, "
+                                      "recognized pages can already be reviewed...")
+
+
+def start_upload(dhis2_client, data_payload):
     """
-    df.columns = df.iloc[0]  
-    df = df.iloc[1:]  
-    df.reset_index(drop=True, inplace=True)
-    return df
+    Starts importing the data payload into DHIS2 in a background job, large payloads are imported in chunks.
+    :param dhis2_client: DHIS2Client of the session
+    :param data_payload: Data value set as a JSON string, from json_export
+    :return: Started BackgroundJob, with the import summary of each chunk
+    """
+    return BackgroundJob(lambda on_result: dhis2.importDataValueSet(data_payload, dhis2_client, dry_run=True, on_chunk=on_result),
+                         dhis2.countImportChunks(data_payload)).start()
+
+
+@st.fragment(run_every=1)
+def upload_progress(job):
+    """Shows the progress of the DHIS2 import, rerunning the app once it is done."""
+    if job.done:
+        st.rerun()
+    st.progress(job.progress(), text="Uploading to DHIS2, please wait...")
+
+
+def show_import_summary(job):
+    """Shows the counts of the DHIS2 import and the data values it rejected."""
+    if job.error is not None:
+        st.error(f"Submission failed. Please try again or notify a technician. ({job.error})")
+        return
+    summary = dhis2.mergeImportSummaries(job.results()[i] for i in sorted(job.results()))
+    counts = f"{summary['imported']} imported, {summary['updated']} updated, {summary['ignored']} ignored"
+    if summary['conflicts']:
+        st.warning(f"Submitted with conflicts: {counts}.")
+        st.dataframe(pd.DataFrame(summary['conflicts']), hide_index=True)
+    else:
+        st.success(f"Submitted! {counts}.")
+
+
+def mark_table_dirty(i):
+    """on_change callback of the table editors, marks the table as having edits not stored in the session state yet."""
+    st.session_state.dirty_tables.add(i)
+
+
+def commit_table(i, df):
+    """Stores a table in the session state and resets its editor, whose edits are now part of the stored table."""
+    st.session_state.table_dfs[i] = df
+    st.session_state.pop(f"editor_{i}", None)
+    st.session_state.table_edits.pop(i, None)
+    st.session_state.dirty_tables.discard(i)
+
+
+def commit_dirty_tables():
+    """Stores the edits of the tables changed since they were last stored, the other tables are left as they are."""
+    for i in list(st.session_state.dirty_tables):
+        commit_table(i, st.session_state.table_edits[i])
+
+
+@st.fragment
+def image_panel(sheet):
+    """Shows the tally sheet on request, toggling it only reruns this panel.
+    The preview is decoded once per upload, zoom tiles only when zooming in is first asked for."""
+    if st.toggle("Show Image", key="show_image"):
+        preview_cache = st.session_state['preview_cache']
+        if st.toggle("Zoom in", key="zoom_image"):
+            levels = preview_cache.get(sheet, key=sheet.file_id, tiles=True)["tiles"]
+            level_index = st.select_slider("Zoom", options=range(len(levels) - 1, -1, -1), key="zoom_level",
+                                           format_func=lambda level: f"{100 // levels[level]['scale']}%")
+            level = levels[level_index]
+            columns, rows = level["grid"]
+            # One slider per level, the number of tiles differs between levels
+            column = st.slider("Horizontal position", 0, columns - 1, key=f"zoom_column_{level_index}") if columns > 1 else 0
+            row = st.slider("Vertical position", 0, rows - 1, key=f"zoom_row_{level_index}") if rows > 1 else 0
+            st.image(level["tiles"][(column, row)])
+        else:
+            st.image(preview_cache.get(sheet, key=sheet.file_id)["data"])
 
 
-def save_st_table(table_dfs):
-    """Saves the tables to the session state if there are any changes and reruns."""
-    for idx, table in enumerate(table_dfs):
-        if not table_dfs[idx].equals(st.session_state.table_dfs[idx]):
-            st.session_state.table_dfs = table_dfs
-            st.rerun()
+@st.fragment
+def table_editor(i, title):
+    """
+    Editable table with its column buttons. Edits and column changes only rerun this fragment, not the whole app.
+    :param i: Index of the table in the session state
+    :param title: Title shown above the table
+    """
+    df = st.session_state.table_dfs[i]
+    st.write(title)
+    col1, col2 = st.columns([4, 1])
+
+    with col1:
+        # Display tables as editable fields, edits are kept until the page is confirmed
+        edited_df = st.data_editor(df, num_rows="dynamic", key=f"editor_{i}", use_container_width=True,
+                                   on_change=mark_table_dirty, args=(i,))
+        if i in st.session_state.dirty_tables:
+            st.session_state.table_edits[i] = edited_df
+
+        # Point out cells the OCR model was unsure about, as long as the table still has its recognized shape
+        confidence = st.session_state.table_confidences[i]
+        if confidence.shape == df.shape:
+            low_confidence_cells = np.argwhere((confidence > 0) & (confidence < LOW_OCR_CONFIDENCE))
+            if len(low_confidence_cells) > 0:
+                st.caption("Low recognition confidence, please check: " +
+                           ", ".join(f"row {df.index[row]} / column {df.columns[col]}" for row, col in low_confidence_cells))
+
+    with col2:
+        # Add column functionality
+        if st.button("Add Column", key=f"add_col_{i}"):
+            edited_df = edited_df.copy()
+            edited_df[str(int(edited_df.columns[-1]) + 1)] = None
+            commit_table(i, edited_df)
+            st.rerun(scope="fragment")
+
+        # Delete column functionality
+        if not df.empty:
+            col_to_delete = st.selectbox("Column to delete", df.columns, key=f"del_col_{i}")
+            if st.button("Delete Column", key=f"delete_col_{i}"):
+                commit_table(i, edited_df.drop(columns=[col_to_delete]))
+                st.rerun(scope="fragment")
+
 
 # Initializing session state variables that only need to be set on startup
 if "initialised" not in st.session_state:
@@ -257,7 +466,18 @@ st.set_page_config("Doctors Without Borders Data Entry")
 st.markdown("<h1 style='text-align: center;'>Doctors Without Borders Image Recognition Data Entry</h1>", unsafe_allow_html=True)
 
 server_url = os.environ["DHIS2_SERVER_URL"]
-dhis2.configure_DHIS2_server(server_url = server_url)
+
+# Each session keeps its own pooled connection to DHIS2 with the credentials of its user
+if 'dhis2_client' not in st.session_state:
+    st.session_state['dhis2_client'] = dhis2.DHIS2Client(server_url)
+dhis2_client = st.session_state['dhis2_client']
+
+# Everything timed in this session, including the background recognition, goes to the session's trace
+if TRACING_ENABLED:
+    trace_exporter = get_trace_exporter()
+    if 'trace_id' not in st.session_state:
+        st.session_state['trace_id'] = tracing.new_trace_id()
+    tracing.set_trace(st.session_state['trace_id'])
 
 # Initialize session state variables
 if 'authenticated' not in st.session_state:
@@ -272,11 +492,12 @@ if 'auth_failed' not in st.session_state:
 placeholder = st.empty()
 
 def authenticate():
-    response = requests.get(f'{dhis2.DHIS2_SERVER_URL}/api/33/me', auth=HTTPBasicAuth(st.session_state['username'], st.session_state['password']))
+    response = dhis2_client.get(dhis2_client.api_url('33/me'), auth=HTTPBasicAuth(st.session_state['username'], st.session_state['password']))
     if response.status_code == 200:
         st.session_state['authenticated'] = True
         st.session_state['auth_failed'] = False
         st.session_state['user_info'] = response.json()
+        dhis2_client.configure(username=st.session_state['username'], password=st.session_state['password'])
     else:
         st.session_state['auth_failed'] = True
 
@@ -294,8 +515,6 @@ if st.session_state['auth_failed']:
 
 if st.session_state['authenticated']:
     placeholder.empty()
-    
-    dhis2.configure_DHIS2_server(username = st.session_state['username'], password=st.session_state['password'])
 
     # File upload layout
     upload_holder = st.empty()
@@ -305,16 +524,12 @@ if st.session_state['authenticated']:
                                 accept_multiple_files=True,
                                 key=st.session_state['upload_key'])
 
-    # OCR Model
-    doctr_ocr = create_ocr()
+    # OCR Models
+    ocr_models = create_ocr_models()
 
     # Once images are uploaded
     if len(tally_sheet_images) > 0:
         
-        # First load session state
-        if 'first_load' not in st.session_state:
-            st.session_state['first_load'] = True
-        
         # Removing the data upload file button to force users to clear form
         upload_holder.empty()
 
@@ -323,14 +538,33 @@ if st.session_state['authenticated']:
             st.session_state.upload_key += 1
             if 'table_dfs' in st.session_state:
                 del st.session_state['table_dfs']
+            if 'dirty_tables' in st.session_state:
+                del st.session_state['dirty_tables']
+            if 'table_edits' in st.session_state:
+                del st.session_state['table_edits']
             if 'table_names' in st.session_state:
                 del st.session_state['table_names']
             if 'page_nums' in st.session_state:
                 del st.session_state['page_nums']
+            if 'table_confidences' in st.session_state:
+                del st.session_state['table_confidences']
+            if 'sheet_types' in st.session_state:
+                del st.session_state['sheet_types']
             if 'pages_confirmed' in st.session_state:
                 del st.session_state['pages_confirmed'] 
-            if 'first_load' in st.session_state:
-                del st.session_state['first_load']       
+            if 'low_confidence_corrections' in st.session_state:
+                del st.session_state['low_confidence_corrections']
+            if 'recognition_errors' in st.session_state:
+                del st.session_state['recognition_errors']
+            if 'recognition_job' in st.session_state:
+                st.session_state['recognition_job'].cancel()
+                del st.session_state['recognition_job']
+            if 'pages_loaded' in st.session_state:
+                del st.session_state['pages_loaded']
+            if 'preview_cache' in st.session_state:
+                del st.session_state['preview_cache']
+            if 'upload_job' in st.session_state:
+                del st.session_state['upload_job']
             st.rerun()
 
         # Sidebar for header data
@@ -347,7 +581,7 @@ if st.session_state['authenticated']:
             # Successive if-statements: simulate tree layout, needs prior values
             if org_unit:
                 # Get all UIDs corresponding to the text field value
-                org_unit_options = dhis2_all_UIDs("organisationUnits", [org_unit])
+                org_unit_options = dhis2_all_UIDs(dhis2_client, dhis2_client.server_url, dhis2_client.username, "organisationUnits", [org_unit])
                 
                 if org_unit_options == []:
                     st.error("No organization units by this name were found. Please try again.")
@@ -363,7 +597,7 @@ if st.session_state['authenticated']:
                 if org_unit_dropdown is not None:
                     if org_unit_options:
                         org_unit_id = [id[1] for id in org_unit_options if id[0] == org_unit_dropdown][0]
-                        org_unit_children_options = get_org_unit_children(org_unit_id)
+                        org_unit_children_options = get_org_unit_children(dhis2_client, dhis2_client.server_url, dhis2_client.username, org_unit_id)
                         org_unit_children_dropdown = st.selectbox(
                             "Tally Sheet Type",
                             sorted([id[0] for id in org_unit_children_options]),
@@ -375,7 +609,7 @@ if st.session_state['authenticated']:
 
                             org_unit_child_id = [id[2] for id in org_unit_children_options if id[0] == org_unit_children_dropdown][0]
                             data_set_ids = [id[1] for id in org_unit_children_options if id[0] == org_unit_children_dropdown][0]
-                            data_set_options = get_data_sets(data_set_ids)
+                            data_set_options = get_data_sets(dhis2_client, dhis2_client.server_url, dhis2_client.username, data_set_ids)
                             data_set = st.selectbox(
                                 "Data Set",
                                 sorted([id[0] for id in data_set_options]),
@@ -397,86 +631,93 @@ if st.session_state['authenticated']:
         
         # Populate streamlit with data recognized from tally sheets
         
-        # Spinner for data upload. If it's going to be on screen for long, make it bespoke    
-        with st.spinner("Running image recognition..."):
-            if st.session_state['first_load']:
-                table_dfs, page_nums_to_display = [], []
-                for i, sheet in enumerate(tally_sheet_images):
-                    img = Image(src=sheet)
-                    table_df = get_tabular_content_wrapper(doctr_ocr, img)
-                    table_dfs.extend(table_df)
-                    page_nums_to_display.extend([str(i + 1)] * len(table_df))
-                table_dfs = post_processing.clean_up(table_dfs)
-                table_dfs = post_processing.evaluate_cells(table_dfs)
-                st.session_state['first_load'] = False
-            else:
-                table_dfs = st.session_state['table_dfs'].copy()    
-
-       
         # Form session state initialization
         if 'table_dfs' not in st.session_state:
-            st.session_state.table_dfs = table_dfs
+            st.session_state.table_dfs = []
         if 'page_nums' not in st.session_state:
-            st.session_state.page_nums = page_nums_to_display
+            st.session_state.page_nums = []
+        if 'table_confidences' not in st.session_state:
+            st.session_state.table_confidences = []
+        if 'sheet_types' not in st.session_state:
+            st.session_state.sheet_types = {}
+        if 'recognition_errors' not in st.session_state:
+            st.session_state['recognition_errors'] = []
+        if 'pages_loaded' not in st.session_state:
+            st.session_state.pages_loaded = set()
+        if 'preview_cache' not in st.session_state:
+            st.session_state.preview_cache = image_utils.PreviewCache()
+        if 'dirty_tables' not in st.session_state:
+            st.session_state.dirty_tables = set()
+        if 'table_edits' not in st.session_state:
+            st.session_state.table_edits = {}
         if 'data_payload' not in st.session_state:
             st.session_state.data_payload = None
         if 'pages_confirmed' not in st.session_state:
-            st.session_state['pages_confirmed'] = False  
+            st.session_state['pages_confirmed'] = False
+        if 'low_confidence_corrections' not in st.session_state:
+            st.session_state['low_confidence_corrections'] = []  
+
+        # Recognition runs in the background, pages are added to the session state as they are recognized
+        if 'recognition_job' not in st.session_state:
+            st.session_state['recognition_job'] = start_recognition(tally_sheet_images, ocr_models, dhis2_client)
+        recognition_job = st.session_state['recognition_job']
+        collect_recognized_pages(recognition_job)
+        if len(st.session_state.pages_loaded) < recognition_job.n_items and recognition_job.error is None:
+            recognition_progress(recognition_job)
+
+        for error in st.session_state['recognition_errors']:
+            st.error(error)
 
         # Displaying the editable information
-        # Used for multipage selection functionality
-        page_options = sorted({num for num in st.session_state.page_nums}, key=lambda k: int(k.replace(PAGE_REVIEWED_INDICATOR, "")))
+        # Used for multipage selection functionality, pages still being recognized are marked as pending
+        pending_pages = [f"{i + 1} {PAGE_PENDING_INDICATOR}" for i in range(len(tally_sheet_images))
+                         if i not in st.session_state.pages_loaded and recognition_job.error is None]
+        page_options = sorted({num for num in st.session_state.page_nums} | set(pending_pages), key=page_number)
         current_page = next((i for i, num in enumerate(page_options) if not num.endswith(PAGE_REVIEWED_INDICATOR)), 0)
         page_selected = st.selectbox("Page Number", page_options, index=int(current_page))
+        if page_selected in pending_pages:
+            st.info(f"Page {page_number(page_selected)} is still being recognized, its tables will show up here when it is done.")
+
+        # Sheet type recognized from the page header, to help filling in the sidebar
+        dataSet, orgUnit, period = st.session_state.sheet_types.get(page_number(page_selected) - 1, ["", "", []])
+        if dataSet or orgUnit or period:
+            st.caption(f"Recognized on this page: data set '{dataSet}', organisation unit '{orgUnit}'"
+                       + (f", period {period[0]} to {period[-1]}" if period else ""))
         
         # Displaying images so the user can see them
-        with st.expander("Show Image"):
-            sheet = tally_sheet_images[int(page_selected.replace(PAGE_REVIEWED_INDICATOR, "").strip()) - 1]
-            image = doctr_ocr_functions.correct_image_orientation(sheet)
-            st.image(image)
+        image_panel(tally_sheet_images[page_number(page_selected) - 1])
         
         # Uploading the tables, adding columns for each name
-        for i, (df, page_num) in enumerate(zip(st.session_state.table_dfs, st.session_state.page_nums)):
-            if page_num != page_selected:
-                table_dfs[i] = df
-                continue
-            int_page_num = int(page_num.replace(PAGE_REVIEWED_INDICATOR, "").strip())
-            st.write(f"Table {i + 1}")
-            col1, col2 = st.columns([4, 1])
-
-            with col1:
-                # Display tables as editable fields
-                table_dfs[i] = st.data_editor(df, num_rows="dynamic", key=f"editor_{i}", use_container_width=True)
-
-            with col2:
-                # Add column functionality
-                if st.button("Add Column", key=f"add_col_{i}"):
-                    table_dfs[i][str(int(table_dfs[i].columns[-1]) + 1)] = None
-                    save_st_table(table_dfs)
-    
-                # Delete column functionality
-                if not st.session_state.table_dfs[i].empty:
-                    col_to_delete = st.selectbox("Column to delete", st.session_state.table_dfs[i].columns,
-                                                key=f"del_col_{i}")
-                    if st.button("Delete Column", key=f"delete_col_{i}"):
-                        table_dfs[i] = table_dfs[i].drop(columns=[col_to_delete])
-                        save_st_table(table_dfs)
+        for i, page_num in enumerate(st.session_state.page_nums):
+            if page_num == page_selected:
+                table_editor(i, f"Table {i + 1}")
 
         # Following button functionality relies on the data set to be selected, hence the blocker
         if data_set_selected_id:
     
             period_ID = get_period()
             # Get the information about the DHIS2 form after all form identifiers have been selected by the user    
-            form = getFormJson_wrapper(data_set_selected_id, period_ID, org_unit_child_id)
+            form = getFormJson_wrapper(dhis2_client, dhis2_client.server_url, dhis2_client.username, data_set_selected_id, period_ID, org_unit_child_id)
 
             # Correct field names button
             if st.button("Correct to DHIS2 field names", key="correct_names", type="primary"):
             # This can normalize table headers to match DHIS2 using Levenstein distance or semantic search    
                 if data_set_selected_id:
-                    table_dfs = correct_field_names(table_dfs, form)
-                    save_st_table(table_dfs)
+                    commit_dirty_tables()
+                    correct_field_names(st.session_state.table_dfs, form)
+                    # Names were corrected in place, editors are reset to show them
+                    for i in range(len(st.session_state.table_dfs)):
+                        st.session_state.pop(f"editor_{i}", None)
+                    st.rerun()
                 else:
                     raise Exception("Select a valid dataset") 
+
+            # Flag corrections that are not similar enough to the DHIS2 name to be trusted
+            if st.session_state.low_confidence_corrections:
+                st.warning("Please check these corrections, the recognized text was not similar to any DHIS2 field name:\n\n" +
+                           "\n".join(f"- Page {page_number(st.session_state.page_nums[idx])}: "
+                                      f"'{original}' → '{corrected}' ({score:.0%})"
+                                      for idx, _, _, original, corrected, score in st.session_state.low_confidence_corrections))
                 
                 
             # Confirm data button
@@ -484,9 +725,9 @@ if st.session_state['authenticated']:
                 st.session_state.page_nums = [f"{num} {PAGE_REVIEWED_INDICATOR}" if (num == page_selected and not num.endswith(PAGE_REVIEWED_INDICATOR)) 
                                             else num 
                                             for num in st.session_state.page_nums]
-                st.session_state.pages_confirmed = all(ele.endswith(PAGE_REVIEWED_INDICATOR) for ele in st.session_state.page_nums)
-                # In case the user didn't change anything and confirmed, it will reload and move to the next one regardless.
-                save_st_table(table_dfs)
+                st.session_state.pages_confirmed = all_pages_confirmed(recognition_job)
+                # Only the tables with edits are stored, in case the user didn't change anything it moves to the next page regardless.
+                commit_dirty_tables()
                 st.rerun()
                 
             # Generate and display key-value pairs button
@@ -497,13 +738,16 @@ if st.session_state['authenticated']:
                         # Copying the session state dfs so that any non-confirmed changes aren't used
                         final_dfs = copy.deepcopy(st.session_state.table_dfs)
                         for id, table in enumerate(final_dfs):
-                            final_dfs[id] = set_first_row_as_header(table)
+                            final_dfs[id] = post_processing.set_first_row_as_header(table)
 
+                        form_index = compileForm_wrapper(dhis2_client, dhis2_client.server_url, dhis2_client.username, form)
                         key_value_pairs = []
                         for df in final_dfs:
-                            key_value_pairs.extend(doctr_ocr_functions.generate_key_value_pairs(df, form))
+                            key_value_pairs.extend(doctr_ocr_functions.generate_key_value_pairs(df, form_index))
                         
                         st.session_state.data_payload = json_export(key_value_pairs)
+                        # The summary of a previous upload is about another payload
+                        st.session_state.pop('upload_job', None)
 
                         # Displaying the data payload as requested
                         st.write("### Data payload ###")
@@ -517,24 +761,23 @@ if st.session_state['authenticated']:
                 # Check that every page has been confirmed
                 if all(PAGE_REVIEWED_INDICATOR in str(num) for num in st.session_state.page_nums):
                     if st.session_state.data_payload is not None:
-                        data_value_set_url = f'{dhis2.DHIS2_SERVER_URL}/api/dataValueSets?dryRun=true'
-                        # Send the POST request with the data payload
-                        response = requests.post(
-                            data_value_set_url,
-                            auth=(dhis2.DHIS2_USERNAME, dhis2.DHIS2_PASSWORD),
-                            headers={'Content-Type': 'application/json'},
-                            data=st.session_state.data_payload
-                        )
+                        # DHIS2 imports in the background, the app polls the import job until it is done
+                        st.session_state['upload_job'] = start_upload(dhis2_client, st.session_state.data_payload)
                     else:
                         st.error("Generate key value pairs first")
-                    # Check the response status
-                    if response.status_code == 200:
-                        st.success("Submitted!")
-                    else:
-                        st.error("Submission failed. Please try again or notify a technician.")
                 else: 
                     st.error("Please confirm that all pages are correct.")
 
+            if 'upload_job' in st.session_state:
+                if st.session_state['upload_job'].done:
+                    show_import_summary(st.session_state['upload_job'])
+                else:
+                    upload_progress(st.session_state['upload_job'])
+
         # Corresponding to the if statement for button check
         else:
-            st.error("Please finish selecting organisation unit and data set.")
\ No newline at end of file
+            st.error("Please finish selecting organisation unit and data set.")
+
+if TRACING_ENABLED:
+    with st.sidebar:
+        tracing_panel(trace_exporter)
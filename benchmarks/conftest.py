@@ -0,0 +1,81 @@
+import tracemalloc
+
+import pytest
+
+import synthetic
+
+
+def pytest_addoption(parser):
+    group = parser.getgroup("msfocr benchmarks")
+    group.addoption("--bench-tables", type=int, default=50, help="Number of tables of the synthetic upload")
+    group.addoption("--bench-data-elements", type=int, default=200, help="Number of data elements of the synthetic DHIS2 form")
+    group.addoption("--bench-category-option-combos", type=int, default=4,
+                    help="Number of category option combos of the synthetic DHIS2 form")
+    group.addoption("--bench-image-size", default="2000x1500", help="WIDTHxHEIGHT of the synthetic tally sheet images")
+    group.addoption("--bench-images", type=int, default=8, help="Number of images sent to the stubbed OpenAI client")
+    group.addoption("--bench-llm-latency", type=float, default=0.0,
+                    help="Seconds the stubbed OpenAI client takes to answer each request")
+
+
+@pytest.fixture(scope="session")
+def bench_options(pytestconfig):
+    width, height = (int(size) for size in pytestconfig.getoption("bench_image_size").lower().split("x"))
+    return {"tables": pytestconfig.getoption("bench_tables"),
+            "data_elements": pytestconfig.getoption("bench_data_elements"),
+            "category_option_combos": pytestconfig.getoption("bench_category_option_combos"),
+            "image_size": (width, height),
+            "images": pytestconfig.getoption("bench_images"),
+            "llm_latency": pytestconfig.getoption("bench_llm_latency")}
+
+
+@pytest.fixture
+def upload(bench_options):
+    return synthetic.make_upload(bench_options["tables"])
+
+
+@pytest.fixture(scope="session")
+def form_and_names(bench_options):
+    return synthetic.make_form(bench_options["data_elements"], bench_options["category_option_combos"])
+
+
+@pytest.fixture(scope="session")
+def llm_result(form_and_names):
+    return synthetic.make_llm_result(*form_and_names)
+
+
+@pytest.fixture(scope="session")
+def sheet_image_bytes(bench_options):
+    # Orientation 6, like most phone photos of a sheet
+    return synthetic.make_sheet_image(bench_options["image_size"], orientation=6).getvalue()
+
+
+@pytest.fixture
+def measure(benchmark):
+    """
+    Benchmarks a function like the benchmark fixture, then runs it once more under tracemalloc and stores the peak
+    Python memory it allocated in the extra_info of the benchmark, which --benchmark-autosave saves with the timings.
+    Pass setup to build fresh arguments for every round (5 rounds by default), e.g. for functions changing their input:
+    measure(function, setup=lambda: (arguments,))
+    Pass rounds to run slow functions a fixed number of times instead of as often as pytest-benchmark's calibration
+    decides, e.g. measure(function, rounds=1).
+    """
+    def run(function, *args, setup=None, rounds=None, **kwargs):
+        if setup is None and rounds is None:
+            result = benchmark(function, *args, **kwargs)
+            memory_args = args
+        elif setup is None:
+            result = benchmark.pedantic(function, args=args, kwargs=kwargs, rounds=rounds)
+            memory_args = args
+        else:
+            result = benchmark.pedantic(function, setup=lambda: (setup(), kwargs), rounds=rounds or 5)
+            memory_args = setup()
+        tracemalloc.start()
+        try:
+            function(*memory_args, **kwargs)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        benchmark.extra_info["peak_memory_kib"] = round(peak / 1024)
+        return result
+
+    return run
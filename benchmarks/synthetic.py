@@ -0,0 +1,157 @@
+"""Synthetic inputs of configurable size for the benchmarks: OCR'd tables, DHIS2 forms and metadata, tally sheet
+images and OpenAI results, so the benchmarks run offline and give the same numbers on every machine.
+"""
+import asyncio
+import json
+from io import BytesIO
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+
+# Prefixes of the synthetic UIDs of each metadata type
+UID_PREFIXES = {"dataElements": "de", "categoryOptionCombos": "coc"}
+AGE_GROUPS = ["0-11m", "12-59m", "5-14y", "15y+", "Resident", "Displaced", "Male", "Female"]
+CELL_VALUES = np.array(["", "-", "None", None, "3", "12", "4+5", "1+1+2"], dtype=object)
+
+
+def make_upload(n_tables=50, n_rows=40, n_cols=8, seed=0):
+    """
+    Synthetic upload of OCR'd tables: a header row and column, tallies, empty cells and None/"None" values.
+    """
+    rng = np.random.default_rng(seed)
+    tables = []
+    for _ in range(n_tables):
+        cells = rng.choice(CELL_VALUES, size=(n_rows, n_cols))
+        cells[0, :] = [""] + [f"Column {col}" for col in range(1, n_cols)]
+        cells[:, 0] = [""] + [f"Row {row}" for row in range(1, n_rows)]
+        tables.append(pd.DataFrame(cells))
+    return tables
+
+
+def category_option_combo_names(n):
+    return [AGE_GROUPS[i % len(AGE_GROUPS)] + (f" ({i // len(AGE_GROUPS)})" if i >= len(AGE_GROUPS) else "")
+            for i in range(n)]
+
+
+def make_form(n_data_elements=200, n_category_option_combos=4, fields_per_group=40):
+    """
+    Synthetic DHIS2 form, as returned by getFormJson, with a field for every data element and category option combo.
+    :return: Tuple of the form and a dictionary of {UID: name} of its data elements and category option combos
+    """
+    names = {}
+    coc_ids = []
+    for j, name in enumerate(category_option_combo_names(n_category_option_combos)):
+        coc_ids.append(f"{UID_PREFIXES['categoryOptionCombos']}{j:08d}")
+        names[coc_ids[-1]] = name
+    fields = []
+    for i in range(n_data_elements):
+        de_id = f"{UID_PREFIXES['dataElements']}{i:09d}"
+        names[de_id] = f"Vaccination {i} dose"
+        for coc_id in coc_ids:
+            fields.append({"label": f"{names[de_id]} {names[coc_id]}", "dataElement": de_id,
+                           "categoryOptionCombo": coc_id, "type": "INTEGER_POSITIVE"})
+    groups = [{"label": f"Tab {k}", "fields": fields[k:k + fields_per_group]} for k in range(0, len(fields), fields_per_group)]
+    return {"groups": groups}, names
+
+
+def make_llm_result(form, names, n_rows_per_table=20, misspell_every=5, seed=0):
+    """
+    Synthetic result of the OpenAI OCR, with one table per group of n_rows_per_table data elements of the form.
+    Every misspell_every-th row name has a typo for the name correction to fix.
+    """
+    rng = np.random.default_rng(seed)
+    data_elements = list(dict.fromkeys(field["dataElement"] for group in form["groups"] for field in group["fields"]))
+    cocs = list(dict.fromkeys(field["categoryOptionCombo"] for group in form["groups"] for field in group["fields"]))
+    tables = []
+    for start in range(0, len(data_elements), n_rows_per_table):
+        rows = []
+        for k, de_id in enumerate(data_elements[start:start + n_rows_per_table], start):
+            name = names[de_id]
+            if misspell_every and k % misspell_every == 0:
+                name = name.replace("a", "o", 1)
+            rows.append([name] + list(rng.choice(["", "3", "12", "4+5", "1+1+2"], size=len(cocs))))
+        tables.append({"table_name": f"Table {len(tables) + 1}", "headers": [""] + [names[coc] for coc in cocs], "data": rows})
+    return {"tables": tables}
+
+
+def make_sheet_image(size=(2000, 1500), n_rows=20, n_cols=5, orientation=None, seed=0):
+    """
+    Synthetic photo of a tally sheet: a grid of handwriting-like tallies on slightly noisy paper, JPEG encoded.
+    :param size: (width, height) in pixels
+    :param orientation: EXIF orientation to store, None for none
+    :return: BytesIO of the JPEG file
+    """
+    rng = np.random.default_rng(seed)
+    width, height = size
+    paper = rng.normal(235, 8, size=(height, width)).clip(0, 255).astype(np.uint8)
+    image = Image.fromarray(paper).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    top, left = height // 8, width // 20
+    row_height, col_width = (height - top - height // 20) // n_rows, (width - 2 * left) // n_cols
+    for row in range(n_rows + 1):
+        draw.line([(left, top + row * row_height), (left + n_cols * col_width, top + row * row_height)], fill=(40, 40, 40), width=3)
+    for col in range(n_cols + 1):
+        draw.line([(left + col * col_width, top), (left + col * col_width, top + n_rows * row_height)], fill=(40, 40, 40), width=3)
+    draw.text((left, top // 3), "Vaccination - paediatric   Week 25   25/06/2024", fill=(20, 20, 20))
+    for row in range(n_rows):
+        draw.text((left + 10, top + row * row_height + row_height // 3), f"Vaccination {row} dose", fill=(20, 20, 20))
+        for col in range(1, n_cols):
+            tallies = int(rng.integers(0, 12))
+            for t in range(tallies):
+                x = left + col * col_width + 10 + t * 8
+                draw.line([(x, top + row * row_height + 8), (x + 2, top + (row + 1) * row_height - 8)], fill=(30, 30, 120), width=2)
+
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", quality=90, exif=exif)
+    buffered.seek(0)
+    return buffered
+
+
+def register_dhis2_metadata(requests_mock, server_url, names):
+    """
+    Answers the metadata requests of msfocr.data.dhis2 for the given names with requests_mock, like a DHIS2 server would.
+    """
+    def respond(item_type):
+        def callback(request, context):
+            query = parse_qs(urlparse(request.url).query)
+            filters = query.get("filter", [""])[0]
+            if filters.startswith("id:in:"):
+                uids = filters[len("id:in:["):-1].split(",")
+            else:
+                uids = [uid for uid in names if uid.startswith(UID_PREFIXES[item_type])]
+            name_field = "formName" if item_type == "dataElements" else "name"
+            return {item_type: [{"id": uid, name_field: names[uid], "lastUpdated": "2024-01-01T00:00:00.000"}
+                                for uid in uids if uid in names]}
+        return callback
+
+    for item_type in ("dataElements", "categoryOptionCombos"):
+        requests_mock.get(f"{server_url}/api/{item_type}", json=respond(item_type))
+
+
+class FakeCompletions:
+    """Stands in for AsyncOpenAI().chat.completions, answering every image with the same result."""
+
+    def __init__(self, result, latency=0.0):
+        self.content = json.dumps(result)
+        self.latency = latency
+
+    async def create(self, model, messages, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=self.content))])
+
+
+class FakeAsyncOpenAI:
+    """Offline stand-in for openai.AsyncOpenAI, pass it as the client of extract_text_from_batch_images_async."""
+
+    def __init__(self, result, latency=0.0):
+        self.chat = SimpleNamespace(completions=FakeCompletions(result, latency))
+
+    async def close(self):
+        pass
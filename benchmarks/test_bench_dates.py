@@ -0,0 +1,37 @@
+"""Micro-benchmarks of date recognition, run with `pytest benchmarks` (needs the bench extra)."""
+from datetime import datetime
+
+import pytest
+
+from msfocr.data import post_processing
+
+# OCR lines of a page: mostly table content, a few dates
+LINES = ([f"BCG {i}" for i in range(150)] + [f"{i} + {i + 1}" for i in range(40)]
+         + ["Vaccination - paediatric", "W-14", "25/06/2024", "2024-06-30", "June 25, 2024",
+            "Period: 25/06/2024 - 30/06/2024", "30 June 2024", "2024/06/30", "06/25/2024", "Date"])
+
+
+def legacy_get_yyyy_mm_dd(text):
+    """strptime loop get_yyyy_mm_dd replaced, kept for comparison."""
+    for fmt in post_processing.DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            continue
+    return None
+
+
+@pytest.mark.parametrize("get_date", [legacy_get_yyyy_mm_dd, post_processing.get_yyyy_mm_dd], ids=["legacy", "recognizer"])
+def test_bench_get_yyyy_mm_dd(benchmark, get_date):
+    dates = benchmark(lambda: [get_date(line) for line in LINES])
+    assert dates == [legacy_get_yyyy_mm_dd(line) for line in LINES]
+
+
+def test_bench_find_dates(benchmark):
+    recognizer = post_processing.DateRecognizer()
+    dates = benchmark(lambda: [date for line in LINES for date in recognizer.find_dates(line)])
+    assert len(dates) == 8
+
+
+def test_bench_create_recognizer(benchmark):
+    benchmark(post_processing.DateRecognizer)
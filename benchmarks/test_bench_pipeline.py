@@ -0,0 +1,134 @@
+"""Per-stage benchmarks of the OCR to DHIS2 payload pipeline, run with `pytest benchmarks` (needs the bench extra).
+Everything runs offline: DHIS2 is answered by requests_mock and OpenAI by a stubbed client, on synthetic inputs
+whose size is set with the --bench-* options, see conftest.py.
+"""
+import copy
+import itertools
+from io import BytesIO
+
+import pytest
+
+import synthetic
+from msfocr.data import dhis2, matching, post_processing
+from msfocr.data.cache import FormCache, MetadataCache
+from msfocr.llm import ocr_functions
+
+SERVER_URL = "http://dhis2.bench"
+
+
+@pytest.fixture
+def dhis2_client(requests_mock, form_and_names):
+    synthetic.register_dhis2_metadata(requests_mock, SERVER_URL, form_and_names[1])
+    with dhis2.DHIS2Client(SERVER_URL, "bench", "bench") as client:
+        yield client
+
+
+@pytest.fixture
+def metadata_cache(tmp_path):
+    cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    yield cache
+    cache.close()
+
+
+@pytest.fixture
+def form_cache(tmp_path):
+    return FormCache(tmp_path / "forms")
+
+
+@pytest.fixture
+def recognized_tables(llm_result):
+    _, tables = ocr_functions.parse_table_data(copy.deepcopy(llm_result))
+    return post_processing.evaluate_cells(tables)
+
+
+def test_bench_encode_image(measure, sheet_image_bytes):
+    payload = measure(lambda: ocr_functions.encode_image_payload(BytesIO(sheet_image_bytes), **ocr_functions.DEFAULT_ENCODING))
+    assert max(payload["dimensions"]) <= ocr_functions.DEFAULT_ENCODING["max_size"]
+
+
+def test_bench_get_results(measure, bench_options, sheet_image_bytes, llm_result):
+    images = [BytesIO(sheet_image_bytes) for _ in range(bench_options["images"])]
+    client = synthetic.FakeAsyncOpenAI(llm_result, bench_options["llm_latency"])
+    results = measure(ocr_functions.get_results, images, cache=False, client=client, max_concurrency=4,
+                      requests_per_minute=10 ** 6)
+    assert results == [llm_result] * len(images)
+
+
+def test_bench_parse_table_data(measure, llm_result):
+    # parse_table_data adds the headers to the rows of the result, so every round gets a fresh copy
+    names, tables = measure(ocr_functions.parse_table_data, setup=lambda: (copy.deepcopy(llm_result),))
+    assert len(names) == len(llm_result["tables"])
+
+
+def test_bench_get_DE_COC_List_cold(measure, tmp_path, dhis2_client, form_and_names):
+    form, _ = form_and_names
+    counter = itertools.count()
+    dataElement_list, _ = measure(lambda form, cache: dhis2.get_DE_COC_List(form, dhis2_client, cache),
+                                  setup=lambda: (form, MetadataCache(tmp_path / f"cold{next(counter)}.sqlite3")))
+    assert len(dataElement_list) == len({field["dataElement"] for group in form["groups"] for field in group["fields"]})
+
+
+def test_bench_get_DE_COC_List_warm(measure, dhis2_client, metadata_cache, form_and_names):
+    form, _ = form_and_names
+    dhis2.get_DE_COC_List(form, dhis2_client, metadata_cache)
+    measure(dhis2.get_DE_COC_List, form, dhis2_client, metadata_cache)
+
+
+def test_bench_correct_table_names(measure, dhis2_client, metadata_cache, form_and_names, recognized_tables):
+    dataElement_list, categoryOptionsList = dhis2.get_DE_COC_List(form_and_names[0], dhis2_client, metadata_cache)
+    dataElement_matcher = matching.NameMatcher(dataElement_list)
+    categoryOption_matcher = matching.NameMatcher(categoryOptionsList)
+    measure(matching.correct_table_names, dataElement_matcher=dataElement_matcher, categoryOption_matcher=categoryOption_matcher,
+            setup=lambda: ([table.copy() for table in recognized_tables],))
+
+
+def test_bench_getFormJson(measure, requests_mock, dhis2_client, form_cache, form_and_names):
+    form = form_and_names[0]
+    requests_mock.get(f"{SERVER_URL}/api/dataSets/ds1/form.json", json=form)
+    # Two periods with the same fields, the form of any other period then comes from the form cache
+    for period in ["2024W1", "2024W2"]:
+        dhis2.getFormJson("ds1", period, "ou1", dhis2_client, form_cache)
+    periods = itertools.count(3)
+    measure(lambda: dhis2.getFormJson("ds1", f"2024W{next(periods)}", "ou1", dhis2_client, form_cache))
+    assert requests_mock.call_count == 2
+
+
+def test_bench_compileForm(measure, dhis2_client, metadata_cache, form_cache, form_and_names):
+    dhis2.compileForm(form_and_names[0], dhis2_client, metadata_cache, form_cache)
+    measure(dhis2.compileForm, form_and_names[0], dhis2_client, metadata_cache, form_cache)
+
+
+def test_bench_generate_key_value_pairs(measure, dhis2_client, metadata_cache, form_cache, form_and_names, recognized_tables):
+    form_index = dhis2.compileForm(form_and_names[0], dhis2_client, metadata_cache, form_cache)
+    tables = [post_processing.set_first_row_as_header(table.copy()) for table in recognized_tables]
+    # Only rows whose name was read correctly are found in the form
+    tables = [table[table.iloc[:, 0].isin(form_and_names[1].values())] for table in tables]
+    measure(lambda: [pair for table in tables for pair in dhis2.generate_key_value_pairs(table, form_index)])
+
+
+def test_bench_payload(measure, dhis2_client, metadata_cache, form_cache, form_and_names, llm_result):
+    """From the OpenAI result of a sheet to its data values, with the DHIS2 metadata already cached."""
+    form = form_and_names[0]
+    dhis2.compileForm(form, dhis2_client, metadata_cache, form_cache)
+
+    def payload(result):
+        _, tables = ocr_functions.parse_table_data(result)
+        tables = post_processing.evaluate_cells(tables)
+        dataElement_list, categoryOptionsList = dhis2.get_DE_COC_List(form, dhis2_client, metadata_cache)
+        matching.correct_table_names(tables, matching.NameMatcher(dataElement_list), matching.NameMatcher(categoryOptionsList))
+        form_index = dhis2.compileForm(form, dhis2_client, metadata_cache, form_cache)
+        return [pair for table in tables
+                for pair in dhis2.generate_key_value_pairs(post_processing.set_first_row_as_header(table), form_index)]
+
+    data_values = measure(payload, setup=lambda: (copy.deepcopy(llm_result),))
+    assert len(data_values) > 0
+
+
+def test_bench_get_tabular_content(measure, sheet_image_bytes):
+    pytest.importorskip("doctr")
+    img2table_document = pytest.importorskip("img2table.document")
+    from msfocr.doctr import ocr_functions as doctr_ocr_functions
+
+    model = doctr_ocr_functions.create_ocr_models(1)[0]
+    measure(lambda: doctr_ocr_functions.get_tabular_content(model, img2table_document.Image(src=BytesIO(sheet_image_bytes))),
+            rounds=1)
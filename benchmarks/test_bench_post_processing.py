@@ -0,0 +1,30 @@
+"""Benchmarks of the table post processing, run with `pytest benchmarks` (needs the bench extra)."""
+from msfocr.data import post_processing
+
+
+def legacy_clean_up(table_dfs):
+    """Cell by cell implementation clean_up replaced, kept for comparison. Misses NaN cells of pandas string columns."""
+    for table in table_dfs:
+        for row in range(table.shape[0]):
+            for col in range(table.shape[1]):
+                if table.iloc[row, col] is None or table.iloc[row, col] == "None":
+                    table.iloc[row, col] = ""
+    return table_dfs
+
+
+def test_bench_clean_up_legacy(benchmark, upload):
+    benchmark(legacy_clean_up, [table.copy() for table in upload])
+
+
+def test_bench_clean_up(measure, upload):
+    result = measure(post_processing.clean_up, upload)
+    assert not any(table.isin(["None"]).any(axis=None) or table.isna().any(axis=None) for table in result)
+
+
+def test_bench_clean_up_inplace(benchmark, upload):
+    benchmark(post_processing.clean_up, [table.copy() for table in upload], inplace=True)
+
+
+def test_bench_evaluate_cells(measure, upload):
+    tables = post_processing.clean_up(upload)
+    measure(post_processing.evaluate_cells, setup=lambda: ([table.copy() for table in tables],))
@@ -0,0 +1,353 @@
+"""Batch processing of folders of tally sheets from the command line, without the Streamlit apps.
+
+Usage:
+msfocr "scans/2024/*.jpg" --engine llm --workers 8 --output results.jsonl --data-set <UID> --org-unit <UID> --period 2024W3
+
+Each image gets one JSON line in the output with its recognized tables. When the DHIS2_SERVER_URL, DHIS2_USERNAME and
+DHIS2_PASSWORD environment variables are set and the data set, org unit and period of an image are known, the line
+also holds the data value set payload for DHIS2. Running the same command again skips the images already processed
+successfully, so an interrupted run continues where it stopped. Images whose payload couldn't be built, e.g. because
+DHIS2 was unreachable, are written with the status "partial" and processed again.
+"""
+import argparse
+import csv
+import glob
+import json
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from msfocr import tracing
+from msfocr.data import dhis2, matching, post_processing
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff"}
+# Columns of the mapping file besides the image name
+MAPPING_FIELDS = ("dataSet", "orgUnit", "period")
+# Images sent to an engine at once. Keeps the memory of the LLM engine bounded, which encodes the images of a batch up front.
+CHUNK_SIZE = 64
+
+
+def find_images(inputs):
+    """
+    :param inputs: List of image paths, directories (searched recursively) or glob patterns
+    :return: Sorted list of the absolute paths of the images found, without duplicates
+    """
+    paths = set()
+    for pattern in inputs:
+        path = Path(pattern)
+        if path.is_dir():
+            candidates = path.rglob("*")
+        elif path.is_file():
+            candidates = [path]
+        else:
+            candidates = (Path(match) for match in glob.glob(pattern, recursive=True))
+        # Absolute paths, so that a resumed run matches the checkpoint whatever the cwd or the form of the inputs
+        paths.update(os.path.abspath(candidate) for candidate in candidates
+                     if candidate.is_file() and candidate.suffix.lower() in IMAGE_EXTENSIONS)
+    return sorted(paths)
+
+
+def read_mapping(path):
+    """
+    Reads the data set, org unit and period of each image from a CSV file with the columns image, dataSet, orgUnit
+    and period, where image is the file name of the image. Empty cells fall back to the command line options.
+    :param path: Path of the CSV file
+    :return: Dictionary of {file name: {field: value}}
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        return {row["image"]: {field: row[field] for field in MAPPING_FIELDS if row.get(field)}
+                for row in csv.DictReader(f)}
+
+
+def read_checkpoint(output_path):
+    """
+    :param output_path: Path of the JSONL output of an earlier run
+    :return: Set of the images that run processed successfully, images with a "partial" record are not included
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Last line of a run that was killed while writing it
+                continue
+            if record.get("status") == "ok":
+                done.add(record["image"])
+    return done
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class JsonlWriter:
+    """
+    Appends one JSON record per line to a file. Each record is flushed to disk before write returns,
+    so the output is a reliable checkpoint even if the process is killed.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: Path of the JSONL file, created if needed
+        """
+        # A killed run can leave a partial last line, the next record must not be appended to it
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._file = open(path, "a", encoding="utf-8")
+        if needs_newline:
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, default=_json_default)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def table_rows(table):
+    """
+    :param table: Table DataFrame, with the column names in its first row
+    :return: List of rows of the table, with None for missing values
+    """
+    return table.astype(object).where(table.notna(), None).values.tolist()
+
+
+class SheetProcessor:
+    """
+    Turns the tables recognized in an image into its output record: post processed tables, corrected to the field
+    names of the DHIS2 form and with the data value set payload when the image's data set, org unit and period are known.
+    Forms are downloaded and indexed once for each data set, org unit and period.
+    """
+
+    def __init__(self, client=None, defaults=None, mapping=None, key_value_pairs=dhis2.generate_key_value_pairs):
+        """
+        :param client: DHIS2Client to use, None to only write the recognized tables
+        :param defaults: Dictionary of the dataSet, orgUnit and period used for images without their own in mapping
+        :param mapping: Dictionary of {file name: {field: value}}, see read_mapping
+        :param key_value_pairs: Function generating the data values of a table, the docTR engine has its own
+        """
+        self.client = client
+        self.defaults = defaults or {}
+        self.mapping = mapping or {}
+        self.key_value_pairs = key_value_pairs
+        self._forms = {}
+
+    def form_for(self, dataSet, period, orgUnit):
+        """
+        :return: Tuple of the FormIndex of the form and the NameMatchers of its data element and category option combo names
+        """
+        key = (dataSet, period, orgUnit)
+        if key not in self._forms:
+            form = dhis2.getFormJson(dataSet, period, orgUnit, client=self.client)
+            dataElement_list, categoryOptionsList = dhis2.get_DE_COC_List(form, client=self.client)
+            self._forms[key] = (dhis2.compileForm(form, client=self.client),
+                                matching.NameMatcher(dataElement_list),
+                                matching.NameMatcher(categoryOptionsList))
+        return self._forms[key]
+
+    def record(self, image, names, tables, sheet_type=None):
+        """
+        :param image: Path of the image
+        :param names: List of table names
+        :param tables: List of table DataFrames, with the column names in their first row
+        :param sheet_type: dataSet, orgUnit and period names recognized on the sheet, if the engine finds them
+        :return: Output record of the image
+        """
+        fields = {**self.defaults, **self.mapping.get(os.path.basename(image), {})}
+        record = {"image": image, "status": "ok", **fields}
+        if sheet_type is not None:
+            record["sheetType"] = sheet_type
+
+        if self.client is not None and all(fields.get(field) for field in MAPPING_FIELDS):
+            try:
+                form_index, dataElement_matcher, categoryOption_matcher = self.form_for(
+                    fields["dataSet"], fields["period"], fields["orgUnit"])
+                corrections = matching.correct_table_names(tables, dataElement_matcher, categoryOption_matcher)
+                record["lowConfidenceCorrections"] = [
+                    {"table": idx, "row": row, "column": col, "original": original, "corrected": corrected, "score": score}
+                    for idx, row, col, original, corrected, score in corrections]
+                data_values = []
+                for table in tables:
+                    data_values.extend(self.key_value_pairs(post_processing.set_first_row_as_header(table.copy()), form_index))
+                record["payload"] = {"dataSet": fields["dataSet"], "period": fields["period"],
+                                     "orgUnit": fields["orgUnit"], "dataValues": data_values}
+            except Exception as e:
+                # The error may be transient, e.g. DHIS2 being down, so the image is processed again on resume
+                record["status"] = "partial"
+                record["payloadError"] = str(e)
+
+        record["tables"] = [{"name": name, "rows": table_rows(table)} for name, table in zip(names, tables)]
+        return record
+
+
+def llm_engine(workers, client=None):
+    """
+    :param workers: Number of OpenAI requests in flight at the same time
+    :param client: Unused, the LLM engine doesn't need DHIS2
+    :return: Function recognizing a list of images, calling on_result(index, (names, tables, None) or exception)
+    """
+    from msfocr.llm import ocr_functions
+
+    def recognize(images, on_result):
+        # Results arrive on the asyncio event loop of get_results. They are handed over to this thread, so that
+        # parsing them and the blocking DHIS2 downloads and file writes of on_result don't hold up the other requests.
+        results = queue.Queue()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            requests_done = executor.submit(tracing.propagate(ocr_functions.get_results), images, return_exceptions=True,
+                                            on_result=lambda i, result: results.put((i, result)), max_concurrency=workers)
+            requests_done.add_done_callback(lambda _: results.put(None))
+            for i, result in iter(results.get, None):
+                if not isinstance(result, Exception):
+                    try:
+                        names, tables = ocr_functions.parse_table_data(result)
+                        result = (names, post_processing.evaluate_cells(tables), None)
+                    except Exception as e:
+                        result = e
+                on_result(i, result)
+            # Raises the error of the whole batch, if any
+            requests_done.result()
+
+    return recognize
+
+
+def doctr_engine(workers, client=None):
+    """
+    :param workers: Number of docTR models recognizing images at the same time
+    :param client: DHIS2Client whose data set and org unit names are used to recognize the sheet type, None for the known defaults
+    :return: Function recognizing a list of images, calling on_result(index, (names, tables, sheet type) or exception)
+    """
+    from msfocr.data.sheet_type import SheetClassifier
+    from msfocr.doctr import ocr_functions
+
+    models = ocr_functions.create_ocr_models(workers)
+    classifier = SheetClassifier.from_dhis2(client) if client is not None else None
+
+    def recognize(images, on_result):
+        for i, result in ocr_functions.iter_sheet_content(images, models, classifier, return_exceptions=True):
+            if not isinstance(result, Exception):
+                try:
+                    tables, _, sheet_type = result
+                    tables = post_processing.evaluate_cells(post_processing.clean_up(tables))
+                    result = ([f"Table {j + 1}" for j in range(len(tables))], tables, sheet_type)
+                except Exception as e:
+                    result = e
+            on_result(i, result)
+
+    return recognize
+
+
+ENGINES = {"llm": llm_engine, "doctr": doctr_engine}
+
+
+def process_images(images, recognize, processor, writer, chunk_size=CHUNK_SIZE, log=None):
+    """
+    Recognizes images chunk by chunk and writes the record of each image as soon as it is done.
+    :param images: List of image paths
+    :param recognize: Function returned by one of the ENGINES
+    :param processor: SheetProcessor building the records
+    :param writer: JsonlWriter of the output
+    :param chunk_size: Number of images given to the engine at once
+    :param log: Function called with a progress message after each image
+    :return: Number of images that failed or whose payload couldn't be built
+    """
+    failures = 0
+    n_done = 0
+    for start in range(0, len(images), chunk_size):
+        chunk = images[start:start + chunk_size]
+
+        def on_result(i, result, chunk=chunk):
+            nonlocal failures, n_done
+            image = chunk[i]
+            try:
+                if isinstance(result, Exception):
+                    raise result
+                record = processor.record(image, *result)
+                if record["status"] == "partial":
+                    failures += 1
+            except Exception as e:
+                record = {"image": image, "status": "error", "error": f"{type(e).__name__}: {e}"}
+                failures += 1
+            writer.write(record)
+            n_done += 1
+            if log is not None:
+                log(f"[{n_done}/{len(images)}] {image}: {record['status']}")
+
+        recognize(chunk, on_result)
+    return failures
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="msfocr", description="Recognizes the tables of tally sheet images and writes them as JSON lines.")
+    parser.add_argument("inputs", nargs="+", help="Image files, directories or glob patterns of the tally sheets")
+    parser.add_argument("-o", "--output", default="msfocr_results.jsonl",
+                        help="JSONL output file, images already in it are skipped (default: %(default)s)")
+    parser.add_argument("-e", "--engine", choices=sorted(ENGINES), default="llm", help="OCR engine (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=4,
+                        help="Concurrent OpenAI requests or docTR models (default: %(default)s)")
+    parser.add_argument("--data-set", help="UID of the DHIS2 data set of the sheets")
+    parser.add_argument("--org-unit", help="UID of the DHIS2 organisation unit of the sheets")
+    parser.add_argument("--period", help="DHIS2 period of the sheets, e.g. 2024W3")
+    parser.add_argument("--mapping", help="CSV file with the columns image, dataSet, orgUnit and period for each image file name")
+    parser.add_argument("--restart", action="store_true", help="Process all images again instead of resuming")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    images = find_images(args.inputs)
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+    done = read_checkpoint(args.output)
+    todo = [image for image in images if image not in done]
+    print(f"{len(images)} images found, {len(images) - len(todo)} already processed", file=sys.stderr)
+    if not todo:
+        return 0
+
+    client = None
+    if all(os.environ.get(name) for name in ("DHIS2_SERVER_URL", "DHIS2_USERNAME", "DHIS2_PASSWORD")):
+        client = dhis2.DHIS2Client(os.environ["DHIS2_SERVER_URL"], os.environ["DHIS2_USERNAME"], os.environ["DHIS2_PASSWORD"])
+    else:
+        print("DHIS2_SERVER_URL, DHIS2_USERNAME or DHIS2_PASSWORD not set, only writing the recognized tables", file=sys.stderr)
+
+    defaults = {"dataSet": args.data_set, "orgUnit": args.org_unit, "period": args.period}
+    mapping = read_mapping(args.mapping) if args.mapping else None
+    key_value_pairs = dhis2.generate_key_value_pairs
+    if args.engine == "doctr":
+        from msfocr.doctr import ocr_functions as doctr_ocr_functions
+        key_value_pairs = doctr_ocr_functions.generate_key_value_pairs
+    processor = SheetProcessor(client, {field: value for field, value in defaults.items() if value}, mapping, key_value_pairs)
+
+    writer = JsonlWriter(args.output)
+    try:
+        recognize = ENGINES[args.engine](args.workers, client)
+        failures = process_images(todo, recognize, processor, writer, log=lambda message: print(message, file=sys.stderr))
+    finally:
+        writer.close()
+        if client is not None:
+            client.close()
+    if failures:
+        print(f"{failures} images failed or have no payload, run the same command again to retry them", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
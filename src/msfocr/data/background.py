@@ -0,0 +1,96 @@
+"""Background jobs, so the apps can show the first recognized pages of an upload while the rest is still being processed.
+The job runs in a thread and only keeps results in memory; the apps keep the job in their session state and pick up
+new results on each rerun.
+"""
+import contextvars
+import threading
+
+
+class BackgroundJob:
+    """
+    Runs a function producing results for a list of items (e.g. the pages of an upload) in a daemon thread.
+    The function reports each result as soon as it is done, in any order, by calling on_result(index, result).
+
+    Usage:
+    job = BackgroundJob(lambda on_result: get_results(pages, return_exceptions=True, on_result=on_result), len(pages))
+    job.start()
+    ...
+    for index, result in job.results().items():
+        ...
+    """
+
+    def __init__(self, function, n_items):
+        """
+        :param function: Function taking the on_result callback as its only argument
+        :param n_items: Number of results the function will report
+        """
+        self.function = function
+        self.n_items = n_items
+        self.error = None
+        self._results = {}
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        # The thread runs in the context the job was created in, so its tracing spans belong to the same trace
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run,), daemon=True)
+
+    def _run(self):
+        try:
+            self.function(self._store)
+        except Exception as e:
+            # Failures of single items are reported as their result, this is a failure of the whole job
+            self.error = e
+        finally:
+            self._done.set()
+
+    def _store(self, index, result):
+        if self._cancelled.is_set():
+            return
+        with self._lock:
+            self._results[index] = result
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def cancel(self):
+        """
+        Stops storing results. The function itself keeps running until it returns, functions that can stop
+        early should check cancelled.
+        """
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    @property
+    def done(self):
+        """
+        True once the function has returned, also if it failed
+        """
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Waits for the function to return.
+        :param timeout: Maximum time to wait in seconds, None to wait as long as needed
+        :return: True if the job is done
+        """
+        return self._done.wait(timeout)
+
+    def results(self):
+        """
+        :return: Dictionary of {item index: result} of the results reported so far
+        """
+        with self._lock:
+            return dict(self._results)
+
+    def progress(self):
+        """
+        :return: Fraction of the items with a result, between 0 and 1
+        """
+        with self._lock:
+            n_results = len(self._results)
+        return n_results / self.n_items if self.n_items > 0 else 1.0
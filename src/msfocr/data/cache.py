@@ -0,0 +1,370 @@
+"""Local on-disk caches, so DHIS2 metadata and forms don't have to be downloaded again for every upload and the same
+image isn't sent to the OCR model twice.
+The cache directory defaults to ~/.cache/msfocr and can be changed with the MSFOCR_CACHE_DIR environment variable.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+_form_cache = None
+_form_cache_lock = threading.Lock()
+
+# Seconds a cached DHIS2 form is used before it is downloaded again, in case the form was changed on the server
+FORM_CACHE_TTL = 24 * 60 * 60
+
+
+def get_cache_dir():
+    """
+    Returns the directory used for on-disk caches, creating it if needed.
+    :return: Path of the cache directory
+    """
+    cache_dir = Path(os.environ.get("MSFOCR_CACHE_DIR", Path.home() / ".cache" / "msfocr"))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+class MetadataCache:
+    """
+    SQLite store of DHIS2 metadata names, e.g. data element form names and category option combo names.
+    Items are keyed by server URL, metadata type and UID, so several DHIS2 servers can share one file.
+    The store also remembers when each metadata type was last synchronised, which lets callers only ask
+    the server for items changed since then.
+    """
+
+    def __init__(self, path=None):
+        """
+        :param path: Path of the SQLite file, defaults to metadata.sqlite3 in the cache directory
+        """
+        self.path = Path(path) if path is not None else get_cache_dir() / "metadata.sqlite3"
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS items (
+                                            server TEXT NOT NULL,
+                                            item_type TEXT NOT NULL,
+                                            id TEXT NOT NULL,
+                                            name TEXT NOT NULL,
+                                            last_updated TEXT,
+                                            PRIMARY KEY (server, item_type, id))""")
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS syncs (
+                                            server TEXT NOT NULL,
+                                            item_type TEXT NOT NULL,
+                                            synced_at TEXT NOT NULL,
+                                            PRIMARY KEY (server, item_type))""")
+            # Metadata types whose items have all been downloaded, not only the ones looked up by UID
+            self._connection.execute("""CREATE TABLE IF NOT EXISTS catalogues (
+                                            server TEXT NOT NULL,
+                                            item_type TEXT NOT NULL,
+                                            PRIMARY KEY (server, item_type))""")
+
+    def get_names(self, server, item_type, uids):
+        """
+        Looks up the cached names of the given UIDs.
+        :param server: DHIS2 server URL
+        :param item_type: Type of metadata, e.g. 'dataElements'
+        :param uids: List of UIDs
+        :return: Dictionary of {UID: name} for the UIDs found in the cache
+        """
+        uids = list(uids)
+        names = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for i in range(0, len(uids), 500):
+            chunk = uids[i:i + 500]
+            placeholders = ",".join("?" * len(chunk))
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT id, name FROM items WHERE server = ? AND item_type = ? AND id IN ({placeholders})",
+                    [server, item_type, *chunk]).fetchall()
+            names.update(rows)
+        return names
+
+    def get_all_names(self, server, item_type):
+        """
+        :return: Dictionary of {UID: name} of all cached items of item_type
+        """
+        with self._lock:
+            rows = self._connection.execute("SELECT id, name FROM items WHERE server = ? AND item_type = ?",
+                                            (server, item_type)).fetchall()
+        return dict(rows)
+
+    def store(self, server, item_type, items):
+        """
+        Inserts or updates cached items.
+        :param server: DHIS2 server URL
+        :param item_type: Type of metadata, e.g. 'dataElements'
+        :param items: Iterable of (UID, name, lastUpdated) tuples
+        """
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO items (server, item_type, id, name, last_updated) VALUES (?, ?, ?, ?, ?)",
+                [(server, item_type, uid, name, last_updated) for uid, name, last_updated in items])
+
+    def get_last_sync(self, server, item_type):
+        """
+        :return: Timestamp string of the last synchronisation of item_type, or None if it was never synchronised
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT synced_at FROM syncs WHERE server = ? AND item_type = ?",
+                                           (server, item_type)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_last_sync(self, server, item_type, synced_at):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO syncs (server, item_type, synced_at) VALUES (?, ?, ?)",
+                                     (server, item_type, synced_at))
+
+    def is_complete(self, server, item_type):
+        """
+        :return: True if all items of item_type have been stored, see set_complete
+        """
+        with self._lock:
+            row = self._connection.execute("SELECT 1 FROM catalogues WHERE server = ? AND item_type = ?",
+                                           (server, item_type)).fetchone()
+        return row is not None
+
+    def set_complete(self, server, item_type):
+        with self._lock, self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO catalogues (server, item_type) VALUES (?, ?)",
+                                     (server, item_type))
+
+    def clear(self, server=None):
+        """
+        Removes all cached items, or only those of one server.
+        """
+        with self._lock, self._connection:
+            if server is None:
+                self._connection.execute("DELETE FROM items")
+                self._connection.execute("DELETE FROM syncs")
+                self._connection.execute("DELETE FROM catalogues")
+            else:
+                self._connection.execute("DELETE FROM items WHERE server = ?", (server,))
+                self._connection.execute("DELETE FROM syncs WHERE server = ?", (server,))
+                self._connection.execute("DELETE FROM catalogues WHERE server = ?", (server,))
+
+    def close(self):
+        self._connection.close()
+
+
+def get_metadata_cache():
+    """
+    Returns the metadata cache shared by the whole process, stored in the cache directory.
+    """
+    global _metadata_cache
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            _metadata_cache = MetadataCache()
+    return _metadata_cache
+
+
+class ResultCache:
+    """
+    Directory of JSON results, each stored in a file named after the hash of everything that produced it
+    (e.g. image bytes, prompt and model). Reading a result marks it as recently used and the least recently
+    used results are removed once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes=200 * 2 ** 20):
+        """
+        :param directory: Directory holding the results, created if needed
+        :param max_bytes: Maximum total size of the stored results
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # Running total size of the stored results, counted on the first put
+        self._total_bytes = None
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Hashes the inputs of a result into a cache key.
+        :param parts: bytes, strings or JSON serializable objects
+        :return: Hexadecimal SHA-256 digest
+        """
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode("utf-8")
+            elif not isinstance(part, bytes):
+                part = json.dumps(part, sort_keys=True).encode("utf-8")
+            # Length prefix, so different splits of the same bytes give different keys
+            digest.update(len(part).to_bytes(8, "little"))
+            digest.update(part)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return self.directory / f"{key}.json"
+
+    def get(self, key):
+        """
+        :param key: Cache key from make_key
+        :return: The stored result, or None if there is none
+        """
+        path = self._path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                result = json.load(f)
+            os.utime(path)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return result
+
+    def put(self, key, result):
+        """
+        Stores a result, then evicts the least recently used results if the cache is over its size limit.
+        :param key: Cache key from make_key
+        :param result: JSON serializable result
+        """
+        # Write to a temporary file first so that readers never see a partially written result
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(result, f)
+            size = os.path.getsize(tmp_path)
+            path = self._path(key)
+            with self._lock:
+                if self._total_bytes is None:
+                    self._total_bytes = self._directory_size()
+                try:
+                    self._total_bytes -= path.stat().st_size
+                except FileNotFoundError:
+                    pass
+                os.replace(tmp_path, path)
+                self._total_bytes += size
+                over_limit = self._total_bytes > self.max_bytes
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+        # Only list the directory when the running total says the cache is too large
+        if over_limit:
+            self._evict()
+
+    def _entries(self):
+        entries = []
+        for path in self.directory.glob("*.json"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def _directory_size(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def _evict(self):
+        with self._lock:
+            # Other processes may share the directory, so the total is counted again from the files
+            entries = self._entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+                if total <= self.max_bytes:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+            self._total_bytes = total
+
+    def clear(self):
+        with self._lock:
+            for path in self.directory.glob("*.json"):
+                path.unlink(missing_ok=True)
+            self._total_bytes = 0
+
+
+class FormCache:
+    """
+    On-disk cache of DHIS2 forms and of the names needed to compile them, stored in a ResultCache.
+    Entries expire after ttl seconds. Forms are stored per (data set, period, org unit), and the cache also remembers
+    the structure (fields) of the form of each (data set, org unit): once two periods gave the same fields and none
+    gave different ones, the form is taken to be independent of the period and other periods are served from the cache.
+    """
+
+    def __init__(self, directory=None, ttl=FORM_CACHE_TTL, max_bytes=50 * 2 ** 20):
+        """
+        :param directory: Directory holding the forms, defaults to forms in the cache directory
+        :param ttl: Seconds an entry is used after it was stored
+        :param max_bytes: Maximum total size of the stored forms, see ResultCache
+        """
+        self.results = ResultCache(directory if directory is not None else get_cache_dir() / "forms", max_bytes)
+        self.ttl = ttl
+
+    @staticmethod
+    def structure(form):
+        """
+        :param form: json data of the form, as returned by getFormJson
+        :return: Hash of the fields of the form, equal for forms with the same fields
+        """
+        return ResultCache.make_key([[(field['label'], field['dataElement'], field['categoryOptionCombo'])
+                                      for field in group['fields']] for group in form['groups']])
+
+    def _get(self, key):
+        entry = self.results.get(key)
+        if entry is None or time.time() - entry['stored_at'] > self.ttl:
+            return None
+        return entry
+
+    def get_form(self, server, dataSet_uid, period, orgUnit_uid):
+        """
+        :return: The cached form of the data set for the period and org unit, or None if there is none
+        """
+        entry = self._get(ResultCache.make_key("form", server, dataSet_uid, orgUnit_uid, period))
+        if entry is not None:
+            return entry['form']
+        shared = self._get(ResultCache.make_key("form", server, dataSet_uid, orgUnit_uid))
+        if shared is not None and shared['period_independent']:
+            return shared['form']
+        return None
+
+    def put_form(self, server, dataSet_uid, period, orgUnit_uid, form):
+        """
+        Stores the form of the data set for the period and org unit, and whether its fields depend on the period.
+        """
+        now = time.time()
+        structure = self.structure(form)
+        self.results.put(ResultCache.make_key("form", server, dataSet_uid, orgUnit_uid, period), {'stored_at': now, 'form': form})
+
+        shared_key = ResultCache.make_key("form", server, dataSet_uid, orgUnit_uid)
+        shared = self._get(shared_key)
+        if shared is None:
+            shared = {'stored_at': now, 'form': form, 'structure': structure, 'periods': [],
+                      'period_dependent': False}
+        elif shared['structure'] != structure:
+            # Fields differ between periods, every period needs its own form until this entry expires
+            shared['period_dependent'] = True
+        if period not in shared['periods']:
+            shared['periods'].append(period)
+        shared['period_independent'] = not shared['period_dependent'] and len(shared['periods']) > 1
+        self.results.put(shared_key, shared)
+
+    def get_names(self, server, form):
+        """
+        :return: Dictionary of {UID: name} of the data elements and category option combos of the form, as stored
+            by put_names for a form with the same fields, or None
+        """
+        entry = self._get(ResultCache.make_key("names", server, self.structure(form)))
+        return entry['names'] if entry is not None else None
+
+    def put_names(self, server, form, names):
+        self.results.put(ResultCache.make_key("names", server, self.structure(form)), {'stored_at': time.time(), 'names': names})
+
+    def clear(self):
+        self.results.clear()
+
+
+def get_form_cache():
+    """
+    Returns the form cache shared by the whole process, stored in the cache directory.
+    """
+    global _form_cache
+    with _form_cache_lock:
+        if _form_cache is None:
+            _form_cache = FormCache()
+    return _form_cache
@@ -1,13 +1,162 @@
 import urllib.parse
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from msfocr import tracing
+from msfocr.data.cache import get_form_cache, get_metadata_cache
 
 # Make sure these are set before trying to make requests
 DHIS2_USERNAME = None
 DHIS2_PASSWORD = None
 DHIS2_SERVER_URL = None
 
-# TODO It might be clearer to create a Server object class and have this be the __init__() function
+# Longest GET URL sent to DHIS2, proxies in front of the server tend to reject longer ones
+MAX_URL_LENGTH = 2000
+
+# Cached metadata names are checked for changes on the server at most this often
+METADATA_SYNC_INTERVAL = timedelta(minutes=5)
+# Items changed this long before the last sync are requested again, as DHIS2 reports lastUpdated in server time
+METADATA_SYNC_OVERLAP = timedelta(days=1)
+METADATA_TIMESTAMP_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# Data values sent per import request, larger payloads are imported in chunks
+IMPORT_CHUNK_SIZE = 5000
+# Seconds between two checks of an import job, doubled after every check, at least IMPORT_MIN_POLL_INTERVAL after the
+# first check and at most IMPORT_MAX_POLL_INTERVAL
+IMPORT_POLL_INTERVAL = 0.5
+IMPORT_MIN_POLL_INTERVAL = 0.1
+IMPORT_MAX_POLL_INTERVAL = 5.0
+# Seconds to wait for an import job before giving up on it
+IMPORT_TIMEOUT = 600
+# Import statuses from best to worst, merged summaries get the worst status of their parts
+IMPORT_STATUSES = ['SUCCESS', 'OK', 'WARNING', 'ERROR']
+
+# Client used by the module level functions when no client is passed in explicitly
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+class DHIS2Client:
+    """
+    Connection to a DHIS2 server backed by a pooled requests.Session.
+    Connections are kept alive and reused between requests, so repeated calls don't pay for a new TCP/TLS
+    handshake each time. A client can be shared between threads, but holds a single set of credentials,
+    so create one client per user session.
+    """
+
+    def __init__(self, server_url=None, username=None, password=None, pool_size=10, max_retries=3,
+                 backoff_factor=0.5, timeout=(10, 120)):
+        """
+        :param server_url: Base URL of the DHIS2 server, without the trailing /api
+        :param username: DHIS2 username
+        :param password: DHIS2 password
+        :param pool_size: Maximum number of connections kept alive to the server
+        :param max_retries: Number of retries for failed GET requests, including 429 and 5xx responses
+        :param backoff_factor: Exponential backoff factor between retries, in seconds
+        :param timeout: Default (connect, read) timeout in seconds used for every request
+        """
+        self.server_url = server_url
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+
+        retries = Retry(total=max_retries,
+                        backoff_factor=backoff_factor,
+                        status_forcelist=(429, 500, 502, 503, 504),
+                        allowed_methods=frozenset(["GET", "HEAD"]),
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retries)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def username(self):
+        return self.session.auth[0]
+
+    @property
+    def password(self):
+        return self.session.auth[1]
+
+    def configure(self, username=None, password=None, server_url=None):
+        """
+        Updates the credentials or server of the client, keeping the open connections.
+        Arguments left as None are not changed.
+        """
+        if username is not None or password is not None:
+            self.session.auth = (username if username is not None else self.username,
+                                 password if password is not None else self.password)
+        if server_url is not None:
+            self.server_url = server_url
+
+    def api_url(self, path):
+        """
+        Builds the full URL of a DHIS2 API endpoint.
+        :param path: Endpoint path relative to /api, e.g. 'dataSets/{uid}'
+        :return: Full URL string
+        """
+        return f'{self.server_url}/api/{path}'
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with tracing.span("dhis2.GET", url=url) as request_span:
+            response = self.session.get(url, **kwargs)
+            request_span.set_attributes(status_code=response.status_code)
+        return response
+
+    def post(self, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with tracing.span("dhis2.POST", url=url) as request_span:
+            response = self.session.post(url, **kwargs)
+            request_span.set_attributes(status_code=response.status_code)
+        return response
+
+    def get_json(self, url):
+        """
+        Sends a GET request and returns the decoded JSON response.
+        :param url: Full URL to request
+        :return: Decoded JSON data
+        """
+        response = self.get(url)
+
+        if response.status_code == 401:
+            raise ValueError("Authentication failed. Check your username and password.")
+        response.raise_for_status()
+
+        return response.json()
+
+    def close(self):
+        self.session.close()
+
+
+def get_default_client():
+    """
+    Returns the client used by the module level functions, configured with configure_DHIS2_server.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = DHIS2Client(DHIS2_SERVER_URL, DHIS2_USERNAME, DHIS2_PASSWORD)
+    return _default_client
+
+
+def _get_client(client):
+    return client if client is not None else get_default_client()
+
+
 def configure_DHIS2_server(username=None, password=None, server_url=None):
     global DHIS2_SERVER_URL, DHIS2_USERNAME, DHIS2_PASSWORD
     if username is not None: 
@@ -16,8 +165,11 @@ def configure_DHIS2_server(username=None, password=None, server_url=None):
         DHIS2_PASSWORD = password
     if server_url is not None: 
         DHIS2_SERVER_URL = server_url
+    get_default_client().configure(username, password, server_url)
 
-def getAllUIDs(item_type, search_items):
+@tracing.traced("dhis2.getAllUIDs")
+def getAllUIDs(item_type, search_items, client=None):
+    client = _get_client(client)
     encoded_search_items = [urllib.parse.quote_plus(item) for item in search_items]
 
     if item_type=='dataElements':
@@ -25,8 +177,8 @@ def getAllUIDs(item_type, search_items):
     else:
         filter_param = 'filter=' + '&filter='.join([f'name:ilike:{term}' for term in encoded_search_items])
         
-    url = f'{DHIS2_SERVER_URL}/api/{item_type}?{filter_param}'
-    data = getResponse(url)
+    url = client.api_url(f'{item_type}?{filter_param}')
+    data = getResponse(url, client)
     items = data[item_type]
     print(f"{len(data[item_type])} matches found for {search_items}")
     if len(items) > 0:
@@ -36,92 +188,214 @@ def getAllUIDs(item_type, search_items):
 
     return uid
 
-def getResponse(url):
-    response = requests.get(url, auth=(DHIS2_USERNAME, DHIS2_PASSWORD))
-
-    if response.status_code == 401:
-        raise ValueError("Authentication failed. Check your username and password.")
-    response.raise_for_status()
+def getResponse(url, client=None):
+    return _get_client(client).get_json(url)
 
-    data = response.json()
-    return data
-
-def getOrgUnitChildren(uid):
+@tracing.traced("dhis2.getOrgUnitChildren")
+def getOrgUnitChildren(uid, client=None):
     """
     Searches DHIS2 for all the direct children of an organization unit.
     :param uid: String of organization unit UID
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
     :return: List of (org unit child name, org unit child data sets))
     """
-    url = f'{DHIS2_SERVER_URL}/api/organisationUnits/{uid}?includeChildren=true'
-    data = getResponse(url)
+    client = _get_client(client)
+    url = client.api_url(f'organisationUnits/{uid}?includeChildren=true')
+    data = getResponse(url, client)
     items = data['organisationUnits']
     children = [(item['name'], item['dataSets'], item['id']) for item in items if item['id'] != uid]
     
     return children
 
-def getDataSets(data_sets_uids):
+@tracing.traced("dhis2.getItemsByUIDs")
+def getItemsByUIDs(item_type, uids, fields, client=None):
+    """
+    Fetches the metadata items of one type with the given UIDs, using an id:in filter instead of one request per UID.
+    If the URL would exceed MAX_URL_LENGTH, the UIDs are split into chunks that are requested concurrently.
+    :param item_type: Type of metadata, e.g. 'dataSets'
+    :param uids: List of UIDs to fetch
+    :param fields: Comma separated string of fields to return for each item
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :return: Dictionary of {UID: item}, UIDs unknown to the server are left out
+    """
+    client = _get_client(client)
+    uids = list(dict.fromkeys(uids))
+    if len(uids) == 0:
+        return {}
+
+    base_url = client.api_url(f'{item_type}?paging=false&fields={fields}&filter=id:in:')
+    # Brackets around the list plus a comma after every UID
+    uid_length = max(len(uid) for uid in uids) + 1
+    chunk_size = max(1, (MAX_URL_LENGTH - len(base_url) - 2) // uid_length)
+    urls = [base_url + '[' + ','.join(uids[i:i + chunk_size]) + ']' for i in range(0, len(uids), chunk_size)]
+
+    if len(urls) == 1:
+        responses = [getResponse(urls[0], client)]
+    else:
+        with ThreadPoolExecutor(max_workers=min(len(urls), 4)) as executor:
+            responses = list(executor.map(tracing.propagate(lambda url: getResponse(url, client)), urls))
+
+    return {item['id']: item for data in responses for item in data[item_type]}
+
+@tracing.traced("dhis2.getDataSets")
+def getDataSets(data_sets_uids, client=None):
     """
     Searches DHIS2 for every data set given in a list.
     :param data_sets_uids: List of data set objects retrieved from DHIS2
-    :return: List of (data set name, data set id))
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :return: List of (data set name, data set id, period type), in the order of data_sets_uids
     """
-    data_sets = []
-    
-    for uid_obj in data_sets_uids:
-        uid = uid_obj['id']
-        url = f'{DHIS2_SERVER_URL}/api/dataSets/{uid}'
-        
-        data = getResponse(url)
-        data_set = (data['name'], data['id'], data['periodType'])
-        data_sets.append(data_set)
-        
+    uids = [uid_obj['id'] for uid_obj in data_sets_uids]
+    items = getItemsByUIDs('dataSets', uids, 'id,name,periodType', client)
+
+    data_sets = [(items[uid]['name'], uid, items[uid]['periodType']) for uid in uids if uid in items]
     return data_sets
 
-def getFormJson(dataSet_uid, period, orgUnit_uid):
+@tracing.traced("dhis2.getFormJson")
+def getFormJson(dataSet_uid, period, orgUnit_uid, client=None, form_cache=None):
     """
     Gets information about all forms associated with a organisation, dataset, period combination in DHIS2.
+    Forms are served from the form cache when possible, also for other periods once the form of the data set and
+    organisation unit turned out to be the same for every period.
     :param dataset UID, time period, organisation unit UID
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param form_cache: FormCache to use, defaults to the shared on-disk cache
     :return json response containing hierarchical information about tabs, tables, non-tabular fields
     """
-    
-    # POST empty data payload to trigger form generation
-    json_export = {}
-    json_export["dataSet"] = dataSet_uid
-    json_export["period"] = period
-    json_export["orgUnit"] = orgUnit_uid
-    json_export["dataValues"] = []
-    data_payload = json.dumps(json_export)
-    posturl = f'{DHIS2_SERVER_URL}/api/dataValueSets?dryRun=true' 
-
-    response = requests.post(
-                        posturl,
-                        auth=(DHIS2_USERNAME, DHIS2_PASSWORD),
-                        headers={'Content-Type': 'application/json'},
-                        data=data_payload
-                    )  
-    response.raise_for_status()
+    client = _get_client(client)
+    form_cache = form_cache if form_cache is not None else get_form_cache()
+    data = form_cache.get_form(client.server_url, dataSet_uid, period, orgUnit_uid)
+    if data is not None:
+        tracing.set_attributes(cached=True)
+        return data
 
-    # Get form now
-    url = f'{DHIS2_SERVER_URL}/api/dataSets/{dataSet_uid}/form.json?pe={period}&ou={orgUnit_uid}'
-    data = getResponse(url)
+    url = client.api_url(f'dataSets/{dataSet_uid}/form.json?pe={period}&ou={orgUnit_uid}')
+    response = client.get(url)
+    if response.status_code == 401:
+        raise ValueError("Authentication failed. Check your username and password.")
+    if response.ok:
+        data = response.json()
+    else:
+        # POST empty data payload to trigger form generation, then get the form again
+        tracing.set_attributes(primed=True)
+        json_export = {}
+        json_export["dataSet"] = dataSet_uid
+        json_export["period"] = period
+        json_export["orgUnit"] = orgUnit_uid
+        json_export["dataValues"] = []
+        response = client.post(
+                            client.api_url('dataValueSets?dryRun=true'),
+                            headers={'Content-Type': 'application/json'},
+                            data=json.dumps(json_export)
+                        )
+        response.raise_for_status()
+        data = getResponse(url, client)
+
+    form_cache.put_form(client.server_url, dataSet_uid, period, orgUnit_uid, data)
     return data
-            
-def get_DE_COC_List(form):
+
+@tracing.traced("dhis2.syncMetadataNames")
+def syncMetadataNames(item_type, name_field, client=None, metadata_cache=None):
+    """
+    Updates the cached names of a metadata type with the items changed on the server since the last sync,
+    using a lastUpdated filter. Does nothing if the last sync is more recent than METADATA_SYNC_INTERVAL.
+    :param item_type: Type of metadata, e.g. 'dataElements'
+    :param name_field: Field holding the name of the item, e.g. 'formName'
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param metadata_cache: MetadataCache to update, defaults to the shared on-disk cache
+    """
+    client = _get_client(client)
+    metadata_cache = metadata_cache if metadata_cache is not None else get_metadata_cache()
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    last_sync = metadata_cache.get_last_sync(client.server_url, item_type)
+    if last_sync is not None:
+        last_sync = datetime.strptime(last_sync, METADATA_TIMESTAMP_FORMAT)
+        if now - last_sync < METADATA_SYNC_INTERVAL:
+            return
+        since = (last_sync - METADATA_SYNC_OVERLAP).strftime(METADATA_TIMESTAMP_FORMAT)
+        url = client.api_url(f'{item_type}?paging=false&fields={_name_fields(name_field)}&filter=lastUpdated:gt:{since}')
+        data = getResponse(url, client)
+        metadata_cache.store(client.server_url, item_type, _named_items(data[item_type], name_field))
+    # Nothing is cached before the first sync, items fetched from now on are up to date
+    metadata_cache.set_last_sync(client.server_url, item_type, now.strftime(METADATA_TIMESTAMP_FORMAT))
+
+@tracing.traced("dhis2.getNames")
+def getNames(item_type, uids, name_field, client=None, metadata_cache=None):
+    """
+    Resolves the names of metadata items from the local metadata cache. UIDs missing from the cache are fetched
+    from the server and stored, so each item is only downloaded once.
+    :param item_type: Type of metadata, e.g. 'dataElements'
+    :param uids: List of UIDs to resolve
+    :param name_field: Field holding the name of the item, e.g. 'formName'. Items without it get their name instead.
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param metadata_cache: MetadataCache to use, defaults to the shared on-disk cache
+    :return: Dictionary of {UID: name}, UIDs unknown to the server are left out
+    """
+    client = _get_client(client)
+    metadata_cache = metadata_cache if metadata_cache is not None else get_metadata_cache()
+    syncMetadataNames(item_type, name_field, client, metadata_cache)
+
+    names = metadata_cache.get_names(client.server_url, item_type, uids)
+    missing = [uid for uid in uids if uid not in names]
+    if len(missing) > 0:
+        items = getItemsByUIDs(item_type, missing, _name_fields(name_field), client)
+        new_items = _named_items(items.values(), name_field)
+        metadata_cache.store(client.server_url, item_type, new_items)
+        names.update({uid: name for uid, name, _ in new_items})
+    return names
+
+@tracing.traced("dhis2.getAllNames")
+def getAllNames(item_type, name_field, client=None, metadata_cache=None):
+    """
+    Gets the names of all items of a metadata type, e.g. all data sets or org units, for matching OCR'd text against them.
+    The whole list is downloaded once per server and kept in the local metadata cache, later calls only sync changes.
+    :param item_type: Type of metadata, e.g. 'dataSets'
+    :param name_field: Field holding the name of the item, e.g. 'name'
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param metadata_cache: MetadataCache to use, defaults to the shared on-disk cache
+    :return: Dictionary of {UID: name}
+    """
+    client = _get_client(client)
+    metadata_cache = metadata_cache if metadata_cache is not None else get_metadata_cache()
+
+    if metadata_cache.is_complete(client.server_url, item_type):
+        syncMetadataNames(item_type, name_field, client, metadata_cache)
+    else:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        url = client.api_url(f'{item_type}?paging=false&fields={_name_fields(name_field)}')
+        data = getResponse(url, client)
+        metadata_cache.store(client.server_url, item_type, _named_items(data[item_type], name_field))
+        metadata_cache.set_complete(client.server_url, item_type)
+        metadata_cache.set_last_sync(client.server_url, item_type, now.strftime(METADATA_TIMESTAMP_FORMAT))
+    return metadata_cache.get_all_names(client.server_url, item_type)
+
+def _name_fields(name_field):
+    # DHIS2 leaves out optional names like formName when they are not set, name is requested as well to fall back on
+    return f'id,{name_field},lastUpdated' if name_field == 'name' else f'id,{name_field},name,lastUpdated'
+
+def _named_items(items, name_field):
+    items = [(item.get('id'), item.get(name_field, item.get('name')), item.get('lastUpdated')) for item in items]
+    return [(uid, name, last_updated) for uid, name, last_updated in items if uid is not None and name is not None]
+
+@tracing.traced("dhis2.get_DE_COC_List")
+def get_DE_COC_List(form, client=None, metadata_cache=None):
     """
     Finds the list of all dataElements (row names in tables) and categoryOptionCombos (column names in tables) within a DHIS2 form
+    Names are looked up in the local metadata cache, only the UIDs used by the form are ever requested from the server.
     :param json data containing hierarchical information about tabs, tables, non-tabular fields within a organisation, dataset, period combination in DHIS2. 
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param metadata_cache: MetadataCache to use, defaults to the shared on-disk cache
     :return List of row names found, List of column names found 
     """
-    url = f'{DHIS2_SERVER_URL}/api/dataElements?paging=false&fields=id,formName'
-    data = getResponse(url)
-    allDataElements = {item['id']:item['formName'] for item in data['dataElements'] if 'formName' in item and 'id' in item}
-
-    url = f'{DHIS2_SERVER_URL}/api/categoryOptionCombos?paging=false&fields=id,name'
-    data = getResponse(url)
-    allCategory = {item['id']:item['name'] for item in data['categoryOptionCombos'] if 'name' in item and 'id' in item}
-
     # Form tabs found in DHIS2
     tabs = form['groups']
+    DE_IDs = list(dict.fromkeys(field['dataElement'] for tab in tabs for field in tab['fields']))
+    COC_IDs = list(dict.fromkeys(field['categoryOptionCombo'] for tab in tabs for field in tab['fields']))
+
+    allDataElements = getNames('dataElements', DE_IDs, 'formName', client, metadata_cache)
+    allCategory = getNames('categoryOptionCombos', COC_IDs, 'name', client, metadata_cache)
+
     dataElement_list = {}
     categoryOptionCombo_list = {}
     for tab in tabs:
@@ -135,6 +409,80 @@ def get_DE_COC_List(form):
     return list(dataElement_list.keys()), list(categoryOptionCombo_list.keys())   
 
 
+def normalize_name(text):
+    """
+    Normalizes a row, column or field name for matching: lower case with collapsed whitespace.
+    """
+    return " ".join(str(text).lower().split())
+
+class FormIndex:
+    """
+    Lookup table of the fields of a DHIS2 form, compiled once per form so that finding the field of a table cell
+    is a dictionary lookup instead of a scan over every field of the form.
+    Fields are indexed by their label, by their normalized label and, when the names of data elements and
+    category option combos are known, by the normalized (data element name, category option combo name) pair.
+    """
+
+    def __init__(self, form, names=None):
+        """
+        :param form: json data of the form, as returned by getFormJson
+        :param names: Optional dictionary of {UID: name} for the data elements and category option combos of the form
+        """
+        self.by_label = {}
+        self.by_normalized_label = {}
+        self.by_name = {}
+        names = names if names is not None else {}
+        for group in form['groups']:
+            for field in group['fields']:
+                ids = (field['dataElement'], field['categoryOptionCombo'])
+                self.by_label[field['label']] = ids
+                self.by_normalized_label[normalize_name(field['label'])] = ids
+                if ids[0] in names and ids[1] in names:
+                    self.by_name[(normalize_name(names[ids[0]]), normalize_name(names[ids[1]]))] = ids
+
+    def lookup(self, data_element, category):
+        """
+        Finds the form field of a table cell.
+        :param data_element: Row name in the tally sheet
+        :param category: Column name in the tally sheet
+        :return: (data element UID, category option combo UID), or (None, None) if there is no such field
+        """
+        label = f"{data_element} {category}"
+        if label in self.by_label:
+            return self.by_label[label]
+        normalized_label = normalize_name(label)
+        if normalized_label in self.by_normalized_label:
+            return self.by_normalized_label[normalized_label]
+        return self.by_name.get((normalize_name(data_element), normalize_name(category)), (None, None))
+
+@tracing.traced("dhis2.compileForm")
+def compileForm(form, client=None, metadata_cache=None, form_cache=None):
+    """
+    Builds the FormIndex of a form, including the data element and category option combo names from the metadata cache.
+    The names are stored in the form cache, so compiling a form with the same fields again needs no DHIS2 request.
+    :param form: json data of the form, as returned by getFormJson
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param metadata_cache: MetadataCache to use, defaults to the shared on-disk cache
+    :param form_cache: FormCache to use, defaults to the shared on-disk cache
+    :return: FormIndex of the form
+    """
+    client = _get_client(client)
+    form_cache = form_cache if form_cache is not None else get_form_cache()
+    names = form_cache.get_names(client.server_url, form)
+    if names is None:
+        fields = [field for group in form['groups'] for field in group['fields']]
+        names = getNames('dataElements', list(dict.fromkeys(field['dataElement'] for field in fields)), 'formName', client, metadata_cache)
+        names.update(getNames('categoryOptionCombos', list(dict.fromkeys(field['categoryOptionCombo'] for field in fields)), 'name', client, metadata_cache))
+        form_cache.put_names(client.server_url, form, names)
+    return FormIndex(form, names)
+
+def is_empty_cell(cell_value, empty_values=("-", "")):
+    """
+    Checks if a table cell has no value to upload, i.e. None, NaN or one of empty_values.
+    """
+    return cell_value is None or (not isinstance(cell_value, str) and pd.isna(cell_value)) or cell_value in empty_values
+
+@tracing.traced("dhis2.generate_key_value_pairs")
 def generate_key_value_pairs(table, form):
     """
     Generates key-value pairs in the format required to upload data to DHIS2.
@@ -143,8 +491,10 @@ def generate_key_value_pairs(table, form):
      'value': cell_value}
      UIDs like data_element_id, category_id are obtained by querying the DHIS2 metadata.
     :param table: DataFrame generated from table detection
+    :param form: json data of the form or its FormIndex, pass the FormIndex when processing several tables of the same form
     :return: List of key value pairs as shown above.
     """ 
+    form_index = form if isinstance(form, FormIndex) else FormIndex(form)
     data_element_pairs = []
 
     # Iterate over each cell in the DataFrame
@@ -157,22 +507,14 @@ def generate_key_value_pairs(table, form):
             # Column name in tally sheet
             category = columns[col_index]
             cell_value = table_array[row_index][col_index]
-            if cell_value is not None and cell_value!="-" and cell_value!="":
-                data_element_id = None
-                category_id = None
-                # Search for the string in the "label" field of form information
-                string_search = data_element + " " + category
-                for group in form['groups']:
-                    for field in group['fields']:
-                        if field['label']==string_search:
-                            data_element_id = field['dataElement']
-                            category_id = field['categoryOptionCombo']
+            if not is_empty_cell(cell_value):
+                data_element_id, category_id = form_index.lookup(data_element, category)
                 
                 # The following exceptions will be raised if the row or column name in the tally sheet is different from the names used in metadata
                 # For eg. Pop1: Resident is called Population 1 in metadata
                 # If this exception is raised the only way forward is for the user to manually change the row/column name to the one used in metadata
                 if data_element_id is None or category_id is None:
-                    raise Exception(f"Unable to find {string_search} in DHIS2 metadata")
+                    raise Exception(f"Unable to find {data_element} {category} in DHIS2 metadata")
                 # Append to the list of data elements to be push to DHIS2
                 data_element_pairs.append(
                     {"dataElement": data_element_id,
@@ -181,3 +523,151 @@ def generate_key_value_pairs(table, form):
                     )
 
     return data_element_pairs
+
+@tracing.traced("dhis2.startDataValueImport")
+def startDataValueImport(payload, client=None, dry_run=False):
+    """
+    Starts an asynchronous import of a data value set, DHIS2 answers as soon as the job is queued.
+    :param payload: Data value set as a dictionary, with dataSet, period, orgUnit and dataValues
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param dry_run: Only validate the data values, nothing is stored
+    :return: Id of the import job, see waitForImport
+    """
+    client = _get_client(client)
+    url = client.api_url(f'dataValueSets?async=true&dryRun={str(dry_run).lower()}')
+    response = client.post(url, headers={'Content-Type': 'application/json'}, data=json.dumps(payload))
+    if response.status_code == 401:
+        raise ValueError("Authentication failed. Check your username and password.")
+    response.raise_for_status()
+    data = response.json()
+    # DHIS2 2.36 and later wrap the job in "response"
+    job = data.get('response', data)
+    if 'id' not in job:
+        raise ValueError(f"DHIS2 did not start an import job: {data}")
+    return job['id']
+
+@tracing.traced("dhis2.waitForImport")
+def waitForImport(job_id, client=None, poll_interval=IMPORT_POLL_INTERVAL, max_poll_interval=IMPORT_MAX_POLL_INTERVAL,
+                  timeout=IMPORT_TIMEOUT):
+    """
+    Polls the task endpoint of an import job until it is completed, with exponential backoff, then gets its summary.
+    :param job_id: Id of the import job, from startDataValueImport
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param poll_interval: Seconds before the first check, doubled after every check
+    :param max_poll_interval: Maximum number of seconds between two checks
+    :param timeout: Seconds to wait for the job before raising TimeoutError
+    :return: Import summary of the job as returned by DHIS2, see summarizeImport
+    """
+    client = _get_client(client)
+    deadline = time.monotonic() + timeout
+    while True:
+        # Notifications of the job, newest first, the job is done once one of them is completed
+        notifications = getResponse(client.api_url(f'system/tasks/DATAVALUE_IMPORT/{job_id}'), client)
+        if any(notification.get('completed') for notification in notifications):
+            break
+        if time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(f"DHIS2 import job {job_id} did not finish within {timeout} seconds")
+        time.sleep(poll_interval)
+        # A zero interval would never grow and poll the server in a tight loop
+        poll_interval = min(max(poll_interval * 2, IMPORT_MIN_POLL_INTERVAL), max_poll_interval)
+
+    summary = getResponse(client.api_url(f'system/taskSummaries/DATAVALUE_IMPORT/{job_id}'), client)
+    if not summary:
+        errors = [notification.get('message', '') for notification in notifications if notification.get('level') == 'ERROR']
+        raise RuntimeError(f"DHIS2 import job {job_id} failed without a summary: {'; '.join(errors)}")
+    return summary
+
+def summarizeImport(summary, data_values, offset=0):
+    """
+    Condenses a DHIS2 import summary into counts and one conflict per data value.
+    :param summary: Import summary as returned by DHIS2
+    :param data_values: List of the data values that were imported, to find the data values of the conflicts
+    :param offset: Index of the first data value in the whole upload, when it was imported in chunks
+    :return: Dictionary with the status ("status"), the numbers of imported, updated, ignored and deleted data values
+        and the list of conflicts ("conflicts"). Each conflict has the index of the data value in the upload ("index",
+        None if DHIS2 didn't say which one), its dataElement, categoryOptionCombo and value, and the reason ("error").
+    """
+    summary = summary.get('response', summary) if 'importCount' not in summary else summary
+    counts = summary.get('importCount', {})
+    conflicts = []
+    for conflict in summary.get('conflicts', []):
+        error = conflict.get('value', '')
+        indexes = conflict.get('indexes')
+        if not indexes:
+            # Older DHIS2 versions only name the offending metadata object
+            indexes = [i for i, data_value in enumerate(data_values)
+                       if conflict.get('object') in (data_value.get('dataElement'), data_value.get('categoryOptionCombo'))]
+        if not indexes:
+            conflicts.append({'index': None, 'dataElement': None, 'categoryOptionCombo': None, 'value': None,
+                              'object': conflict.get('object'), 'error': error})
+        for i in indexes:
+            data_value = data_values[i] if i < len(data_values) else {}
+            conflicts.append({'index': offset + i,
+                              'dataElement': data_value.get('dataElement'),
+                              'categoryOptionCombo': data_value.get('categoryOptionCombo'),
+                              'value': data_value.get('value'),
+                              'object': conflict.get('object'),
+                              'error': error})
+    return {'status': summary.get('status', 'ERROR' if conflicts else 'SUCCESS'),
+            'imported': counts.get('imported', 0),
+            'updated': counts.get('updated', 0),
+            'ignored': counts.get('ignored', 0),
+            'deleted': counts.get('deleted', 0),
+            'conflicts': conflicts}
+
+def _import_status_rank(status):
+    return IMPORT_STATUSES.index(status) if status in IMPORT_STATUSES else len(IMPORT_STATUSES)
+
+def mergeImportSummaries(summaries):
+    """
+    Combines the summaries of the chunks of an upload, from summarizeImport, into the summary of the whole upload.
+    A status missing from IMPORT_STATUSES is treated as worse than all of them, so it is kept in the merged summary.
+    """
+    merged = {'status': 'SUCCESS', 'imported': 0, 'updated': 0, 'ignored': 0, 'deleted': 0, 'conflicts': []}
+    for summary in summaries:
+        if _import_status_rank(summary['status']) > _import_status_rank(merged['status']):
+            merged['status'] = summary['status']
+        for count in ('imported', 'updated', 'ignored', 'deleted'):
+            merged[count] += summary[count]
+        merged['conflicts'].extend(summary['conflicts'])
+    return merged
+
+def countImportChunks(payload, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    :return: Number of import requests importDataValueSet sends for the payload
+    """
+    payload = json.loads(payload) if isinstance(payload, str) else payload
+    return max(1, -(-len(payload['dataValues']) // chunk_size))
+
+@tracing.traced("dhis2.importDataValueSet")
+def importDataValueSet(payload, client=None, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE, on_chunk=None, **poll_options):
+    """
+    Imports a data value set with DHIS2's asynchronous import, so large uploads don't hit request timeouts.
+    Payloads with more than chunk_size data values are split into several imports of the same data set,
+    period and org unit, sent one after the other.
+
+    Usage:
+    summary = importDataValueSet(json_payload, client, dry_run=True)
+    for conflict in summary['conflicts']:
+        ...
+
+    :param payload: Data value set as a dictionary or JSON string, with dataSet, period, orgUnit and dataValues
+    :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+    :param dry_run: Only validate the data values, nothing is stored
+    :param chunk_size: Maximum number of data values per import
+    :param on_chunk: Function called with (chunk index, summary of the chunk) as soon as each chunk is imported
+    :param poll_options: Options of waitForImport, e.g. timeout
+    :return: Summary of the whole upload, see summarizeImport
+    """
+    client = _get_client(client)
+    payload = json.loads(payload) if isinstance(payload, str) else payload
+    data_values = payload['dataValues']
+    summaries = []
+    for chunk_index, start in enumerate(range(0, max(len(data_values), 1), chunk_size)):
+        chunk = data_values[start:start + chunk_size]
+        job_id = startDataValueImport({**payload, 'dataValues': chunk}, client, dry_run)
+        summary = summarizeImport(waitForImport(job_id, client, **poll_options), chunk, offset=start)
+        summaries.append(summary)
+        if on_chunk is not None:
+            on_chunk(chunk_index, summary)
+    return mergeImportSummaries(summaries)
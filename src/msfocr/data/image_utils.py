@@ -0,0 +1,218 @@
+"""Image helpers shared by the apps and the OCR pipelines: EXIF orientation read from the image header and applied
+with lossless transposes, and display previews of uploaded tally sheets, decoded once per upload.
+A 12 megapixel phone photo takes a noticeable time to decode and is far larger than what the browser shows,
+so the apps keep a small encoded preview, and optionally a tile pyramid for zooming in, instead of the original.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+from PIL import Image
+
+# Largest dimension of previews, enough for the width of the Streamlit page
+PREVIEW_MAX_SIZE = 1600
+# Width and height of the tiles of the zoom pyramid
+TILE_SIZE = 512
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+# Id of the EXIF Orientation tag
+ORIENTATION_TAG = 0x0112
+# Transpose bringing an image with each EXIF orientation upright, 1 is already upright
+ORIENTATION_TRANSPOSES = {2: Image.Transpose.FLIP_LEFT_RIGHT,
+                          3: Image.Transpose.ROTATE_180,
+                          4: Image.Transpose.FLIP_TOP_BOTTOM,
+                          5: Image.Transpose.TRANSPOSE,
+                          6: Image.Transpose.ROTATE_270,
+                          7: Image.Transpose.TRANSVERSE,
+                          8: Image.Transpose.ROTATE_90}
+
+
+def _read_bytes(image_file):
+    if hasattr(image_file, "getvalue"):
+        return image_file.getvalue()
+    if hasattr(image_file, "read"):
+        image_file.seek(0)
+        data = image_file.read()
+        image_file.seek(0)
+        return data
+    with open(image_file, "rb") as f:
+        return f.read()
+
+
+def _open(image_file):
+    if hasattr(image_file, "seek"):
+        image_file.seek(0)
+    return Image.open(image_file)
+
+
+def get_image_metadata(image_file):
+    """
+    Reads the format, size and EXIF orientation of an image from its header, without decoding any pixels.
+
+    Usage:
+    metadata = get_image_metadata(uploaded_file)
+    if max(metadata["display_dimensions"]) > 2048:
+        ...
+
+    :param image_file: File object or path of the image
+    :return: Dictionary with the image format ("format"), mode ("mode"), stored dimensions ("dimensions"),
+        EXIF orientation ("orientation", 1 if there is none) and the dimensions once upright ("display_dimensions")
+    """
+    with _open(image_file) as image:
+        orientation = image.getexif().get(ORIENTATION_TAG, 1)
+        width, height = image.size
+        metadata = {"format": image.format, "mode": image.mode, "dimensions": (width, height), "orientation": orientation}
+    # Orientations 5 to 8 are rotated by 90 degrees, which swaps width and height
+    metadata["display_dimensions"] = (height, width) if orientation in (5, 6, 7, 8) else (width, height)
+    return metadata
+
+
+def normalize_image(image_file, mode=None, draft_size=None):
+    """
+    Decodes an image and brings it upright according to its EXIF orientation. All eight orientations are handled,
+    including the mirrored ones, with a single transpose.
+
+    Usage:
+    image = normalize_image("path/to/image.jpg", mode="RGB")
+
+    :param image_file: File object or path of the image
+    :param mode: PIL mode to convert the image to, e.g. "RGB" or "L", None keeps the mode of the file
+    :param draft_size: Lets the JPEG decoder decode at a reduced scale, as long as the image stays at least this
+        size (in the stored orientation). Other formats are decoded at full size.
+    :return: PIL.Image.Image in its display orientation
+    """
+    with _open(image_file) as image:
+        if image.format == "JPEG" and draft_size is not None:
+            image.draft(mode if mode in ("RGB", "L") else "RGB", draft_size)
+        transpose = ORIENTATION_TRANSPOSES.get(image.getexif().get(ORIENTATION_TAG, 1))
+        if transpose is not None:
+            image = image.transpose(transpose)
+        else:
+            image.load()
+        if mode is not None and image.mode != mode:
+            image = image.convert(mode)
+    return image
+
+
+def _encode(image, format, quality):
+    buffered = BytesIO()
+    image.save(buffered, format=format, quality=quality)
+    return buffered.getvalue()
+
+
+def create_tile_pyramid(image, tile_size=TILE_SIZE, format="JPEG", quality=85):
+    """
+    Cuts an image into tiles at full resolution and at every halved resolution down to a single tile.
+
+    Usage:
+    levels = create_tile_pyramid(image)
+    tile = levels[0]["tiles"][(column, row)]
+
+    :param image: PIL image, already in its display orientation
+    :param tile_size: Width and height of the tiles in pixels, tiles on the right and bottom edges can be smaller
+    :param format: Encoding of the tiles, "JPEG" or "WEBP"
+    :param quality: Quality of the encoding, from 1 to 100
+    :return: List of levels from full resolution (level 0) to the smallest. Each level is a dictionary with the
+        downscaling factor ("scale"), the dimensions of the level ("dimensions"), the number of tile columns and
+        rows ("grid") and the encoded tiles ("tiles") keyed by (column, row).
+    """
+    levels = []
+    scale = 1
+    level_image = image
+    while True:
+        width, height = level_image.size
+        columns, rows = -(-width // tile_size), -(-height // tile_size)
+        tiles = {}
+        for row in range(rows):
+            for column in range(columns):
+                box = (column * tile_size, row * tile_size,
+                       min((column + 1) * tile_size, width), min((row + 1) * tile_size, height))
+                tiles[(column, row)] = _encode(level_image.crop(box), format, quality)
+        levels.append({"scale": scale, "dimensions": (width, height), "grid": (columns, rows), "tiles": tiles})
+        if columns == 1 and rows == 1:
+            return levels
+        scale *= 2
+        level_image = level_image.resize((max(1, width // 2), max(1, height // 2)), Image.Resampling.BOX)
+
+
+def create_preview(image_file, max_size=PREVIEW_MAX_SIZE, format="JPEG", quality=85, tile_size=None):
+    """
+    Decodes an image once, applies its EXIF orientation and encodes a display size preview.
+
+    Usage:
+    preview = create_preview(uploaded_file, tile_size=512)
+    st.image(preview["data"])
+
+    :param image_file: File object or path of the image
+    :param max_size: Maximum size of the largest dimension of the preview in pixels
+    :param format: Encoding of the preview, "JPEG" or "WEBP"
+    :param quality: Quality of the encoding, from 1 to 100
+    :param tile_size: Also cut the full resolution image into a tile pyramid with tiles of this size, see create_tile_pyramid
+    :return: Dictionary with the encoded preview ("data"), its MIME type ("mime_type"), its dimensions ("dimensions"),
+        the dimensions of the oriented original ("original_dimensions") and the tile pyramid ("tiles", None without tile_size)
+    """
+    format = format.upper()
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported preview format {format}, use one of {list(MIME_TYPES)}")
+    original_dimensions = get_image_metadata(image_file)["display_dimensions"]
+    # Without tiles the full resolution isn't needed
+    image = normalize_image(image_file, "RGB", draft_size=(max_size, max_size) if tile_size is None else None)
+    tiles = create_tile_pyramid(image, tile_size, format, quality) if tile_size is not None else None
+    image.thumbnail((max_size, max_size))
+    return {"data": _encode(image, format, quality),
+            "mime_type": MIME_TYPES[format],
+            "dimensions": image.size,
+            "original_dimensions": original_dimensions,
+            "tiles": tiles}
+
+
+class PreviewCache:
+    """
+    In-memory cache of image previews keyed by the content of the image, so each upload is only decoded once.
+    The least recently used previews are dropped once more than max_entries are stored.
+    """
+
+    def __init__(self, max_entries=64, tile_size=TILE_SIZE, **preview_options):
+        """
+        :param max_entries: Maximum number of previews kept
+        :param tile_size: Size of the tiles of the zoom pyramid, which is only created when first asked for
+        :param preview_options: Other options of create_preview, e.g. format
+        """
+        self.tile_size = tile_size
+        self.max_entries = max_entries
+        self.preview_options = preview_options
+        self._previews = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_file, key=None, tiles=False):
+        """
+        :param image_file: File object or path of the image
+        :param key: Key identifying the image, e.g. the file_id of a Streamlit upload. Defaults to the hash of its content.
+        :param tiles: Also create the tile pyramid of the image if it doesn't have one yet
+        :return: Preview of the image from create_preview, created on first use
+        """
+        if key is None:
+            key = hashlib.sha256(_read_bytes(image_file)).hexdigest()
+        with self._lock:
+            preview = self._previews.get(key)
+            if preview is not None:
+                self._previews.move_to_end(key)
+        if preview is None:
+            preview = create_preview(image_file, **self.preview_options)
+        if tiles and preview["tiles"] is None:
+            # The full resolution image is only decoded again when zooming in is asked for
+            image = normalize_image(image_file, "RGB")
+            tile_options = {name: value for name, value in self.preview_options.items() if name in ("format", "quality")}
+            preview = {**preview, "tiles": create_tile_pyramid(image, self.tile_size, **tile_options)}
+        with self._lock:
+            self._previews[key] = preview
+            self._previews.move_to_end(key)
+            while len(self._previews) > self.max_entries:
+                self._previews.popitem(last=False)
+        return preview
+
+    def clear(self):
+        with self._lock:
+            self._previews.clear()
@@ -0,0 +1,89 @@
+"""Matching of OCR'd row and column names against DHIS2 names (data elements, category option combos).
+All queries are scored against the whole vocabulary in a single rapidfuzz call instead of comparing strings one pair at a time.
+"""
+import numpy as np
+from rapidfuzz import process
+from rapidfuzz.distance import Levenshtein
+
+# Corrections scoring below this similarity are reported back so they can be reviewed by the user
+LOW_CONFIDENCE_SCORE = 0.6
+
+
+class NameMatcher:
+    """
+    Finds the closest name in a fixed vocabulary for many queries at once.
+    Scores are the same as post_processing.letter_by_letter_similarity: 1 - Levenshtein distance / length of the longest string.
+    """
+
+    def __init__(self, vocabulary):
+        """
+        :param vocabulary: List of candidate names, duplicates are ignored
+        """
+        self.vocabulary = list(dict.fromkeys(vocabulary))
+
+    def scores(self, queries):
+        """
+        Scores every query against every name in the vocabulary.
+        :param queries: List of strings
+        :return: float32 array of shape (number of queries, size of vocabulary)
+        """
+        if len(queries) == 0 or len(self.vocabulary) == 0:
+            return np.zeros((len(queries), len(self.vocabulary)), dtype=np.float32)
+        return process.cdist(queries, self.vocabulary, scorer=Levenshtein.normalized_similarity,
+                             dtype=np.float32, workers=-1)
+
+    def match(self, queries):
+        """
+        Finds the best match of each query.
+        :param queries: List of strings, None entries are not matched
+        :return: List of (best name, score) tuples. The name is "" if nothing in the vocabulary is similar at all,
+            and None for None queries.
+        """
+        texts = [query for query in queries if query is not None]
+        scores = self.scores(texts)
+        best = scores.argmax(axis=1) if scores.shape[1] > 0 else np.zeros(len(texts), dtype=int)
+
+        matches = []
+        position = 0
+        for query in queries:
+            if query is None:
+                matches.append((None, 0.0))
+                continue
+            score = float(scores[position, best[position]]) if scores.shape[1] > 0 else 0.0
+            matches.append((self.vocabulary[best[position]] if score > 0 else "", score))
+            position += 1
+        return matches
+
+
+def correct_table_names(tables, dataElement_matcher, categoryOption_matcher, low_confidence=LOW_CONFIDENCE_SCORE):
+    """
+    Replaces the row names (first column) of each table with the closest data element name and the column names
+    (first row) with the closest category option combo name. The tables are changed in place.
+    :param tables: List of DataFrames, with the column names in their first row
+    :param dataElement_matcher: NameMatcher over the data element names of the form
+    :param categoryOption_matcher: NameMatcher over the category option combo names of the form
+    :param low_confidence: Corrections with a score below this value are reported
+    :return: List of (table index, row, column, original text, corrected text, score) for the low confidence corrections
+    """
+    row_cells = [(idx, row, 0) for idx, table in enumerate(tables) for row in range(table.shape[0])]
+    low_confidence_corrections = _apply_matches(tables, row_cells, dataElement_matcher, low_confidence)
+
+    # The corner cell (0, 0) belongs to the row names, not to the column names
+    header_cells = [(idx, 0, col) for idx, table in enumerate(tables) if table.shape[0] > 0 for col in range(1, table.shape[1])]
+    low_confidence_corrections.extend(_apply_matches(tables, header_cells, categoryOption_matcher, low_confidence))
+    return low_confidence_corrections
+
+
+def _apply_matches(tables, cells, matcher, low_confidence):
+    texts = [tables[idx].iloc[row, col] for idx, row, col in cells]
+    # Empty cells, e.g. the corner cell, have no name to correct
+    texts = [text if isinstance(text, str) and text.strip() else None for text in texts]
+
+    low_confidence_corrections = []
+    for (idx, row, col), text, (name, score) in zip(cells, texts, matcher.match(texts)):
+        if text is None:
+            continue
+        tables[idx].iloc[row, col] = name
+        if score < low_confidence:
+            low_confidence_corrections.append((idx, row, col, text, name, score))
+    return low_confidence_corrections
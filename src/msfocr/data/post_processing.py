@@ -1,8 +1,22 @@
-from datetime import datetime
+import re
+from datetime import date
 
 import Levenshtein
+import numpy as np
+import pandas as pd
 from simpleeval import simple_eval
 
+# Plain integers and sums of integers like "12 + 8", short enough to add up without overflowing int64
+INTEGER_SUM_PATTERN = r"\s*\d{1,15}(?:\s*\+\s*\d{1,15})*\s*"
+
+# Date formats recognized by get_yyyy_mm_dd, in order of preference
+DATE_FORMATS = ["%Y-%m-%d", "%d-%m-%Y", "%m/%d/%Y", "%d/%m/%Y", "%B %d, %Y", "%d %B %Y", "%Y/%m/%d"]
+_ENGLISH_MONTHS = ["January", "February", "March", "April", "May", "June", "July", "August", "September", "October",
+                   "November", "December"]
+# Month numbers of the English month names and their three letter abbreviations
+MONTH_NAMES = {**{name: month for month, name in enumerate(_ENGLISH_MONTHS, start=1)},
+               **{name[:3]: month for month, name in enumerate(_ENGLISH_MONTHS, start=1)}}
+
 
 def letter_by_letter_similarity(text1, text2):
     """
@@ -23,57 +37,198 @@ def letter_by_letter_similarity(text1, text2):
     return similarity
 
 
+class DateRecognizer:
+    """Finds dates written in any of a list of strptime style formats and converts them to YYYY-MM-DD.
+    All formats are compiled into one regular expression, so text without a date is rejected with a single regex search
+    and a date is only converted with the format that matched it, instead of trying every format with strptime.
+    Supported directives are %Y, %y, %m, %d, %B and %b; whitespace in a format matches any whitespace and numeric
+    fields may be preceded by stray spaces, as in OCR'd headers like "5/ 6/2024". Unlike strptime, %B and %b both
+    accept full month names and abbreviations, e.g. "Jun 30, 2024" for "%B %d, %Y".
+
+    Usage:
+        recognizer = DateRecognizer(["%d %B %Y"], month_names={"janvier": 1, "juin": 6})
+        recognizer.find_dates("Période: 25 juin 2024 - 30 juin 2024")  # ["2024-06-25", "2024-06-30"]
+    """
+
+    def __init__(self, formats=DATE_FORMATS, month_names=MONTH_NAMES):
+        """
+        Args:
+            formats (_List_, optional): Date formats, in order of preference for text matching several of them
+                (e.g. "06/05/2024" with "%m/%d/%Y" and "%d/%m/%Y"). Defaults to DATE_FORMATS.
+            month_names (_Dict_, optional): Month number of each month name and abbreviation, used for %B and %b.
+                Defaults to the English names in MONTH_NAMES.
+        """
+        self.formats = list(formats)
+        self.month_names = {name.lower(): month for name, month in month_names.items()}
+        self._format_patterns = [re.compile(self._format_to_regex(fmt), re.IGNORECASE) for fmt in self.formats]
+        alternatives = "|".join(f"(?P<f{i}>{self._format_to_regex(fmt, prefix=f'f{i}_')})" for i, fmt in enumerate(self.formats))
+        # Dates embedded in longer text must not be glued to other letters or digits
+        self._pattern = re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE)
+
+    def _format_to_regex(self, fmt, prefix=""):
+        months = "|".join(re.escape(name) for name in sorted(self.month_names, key=len, reverse=True))
+        directives = {"Y": r"\d{4}", "y": r"\d{2}", "m": r"\d{1,2}", "d": r"\d{1,2}", "B": months, "b": months}
+        parts = []
+        for literal, directive in re.findall(r"([^%]*)(?:%(.))?", fmt):
+            parts.append(r"\s+".join(re.escape(piece) for piece in re.split(r"\s+", literal)))
+            if directive:
+                if directive not in directives:
+                    raise ValueError(f"Unsupported date directive %{directive} in {fmt}")
+                # strptime allowed padding spaces before numbers, e.g. "2024-01- 5"
+                padding = r"\s*" if directive in "Yymd" else ""
+                parts.append(f"{padding}(?P<{prefix}{directive}>{directives[directive]})")
+        return "".join(parts)
+
+    def _to_date(self, fields):
+        if "Y" in fields:
+            year = int(fields["Y"])
+        else:
+            year = 2000 + int(fields["y"])
+        if "m" in fields:
+            month = int(fields["m"])
+        else:
+            month = self.month_names[fields.get("B", fields.get("b")).lower()]
+        try:
+            return date(year, month, int(fields["d"])).strftime("%Y-%m-%d")
+        except ValueError:
+            return None
+
+    def _convert(self, match):
+        text = match.group(0)
+        # The regex picks the first format matching at this position, later ones are only needed if that is no valid date
+        first = int(match.lastgroup[1:])
+        for pattern in self._format_patterns[first:]:
+            format_match = pattern.fullmatch(text)
+            if format_match is not None:
+                date_text = self._to_date(format_match.groupdict())
+                if date_text is not None:
+                    return date_text
+        return None
+
+    def parse(self, text):
+        """Converts text that is a date as a whole.
+
+        Args:
+            text (_str_): Text to convert
+
+        Returns:
+            _str_: Date in YYYY-MM-DD format, or None if the text is not a date
+        """
+        match = self._pattern.fullmatch(text)
+        return self._convert(match) if match is not None else None
+
+    def find_dates(self, text):
+        """Finds all dates in a text, e.g. both dates of "Period: 25/06/2024 - 30/06/2024".
+
+        Args:
+            text (_str_): Text to search
+
+        Returns:
+            _List_: Dates in YYYY-MM-DD format, in the order they appear
+        """
+        dates = []
+        for match in self._pattern.finditer(text):
+            date_text = self._convert(match)
+            if date_text is not None:
+                dates.append(date_text)
+        return dates
+
+
+DEFAULT_DATE_RECOGNIZER = DateRecognizer()
+
+
 def get_yyyy_mm_dd(text):
     """
     Checks if the input text is a date by comparing it with various known formats and returns date in unified YYYY-MM-DD format.
     :param text: String
     :return: Date in YYYY-MM-DD format or None
     """
-    formats = ["%Y-%m-%d", "%d-%m-%Y", "%m/%d/%Y", "%d/%m/%Y", "%B %d, %Y", "%d %B %Y", "%Y/%m/%d"]
-
-    for fmt in formats:
-        try:
-            date_obj = datetime.strptime(text, fmt)
-            return date_obj.strftime("%Y-%m-%d")
-        except ValueError:
-            continue
+    return DEFAULT_DATE_RECOGNIZER.parse(text)
 
-    return None  # Return None if text is not a valid date in any format
 
-
-def evaluate_cells(table_dfs):
-    """Uses simple_eval to perform math operations on each cell, defaulting to input if failed.
+def evaluate_cells(table_dfs, return_status=False):
+    """Performs the math operations written in each cell (e.g. "12+8"), defaulting to input if failed.
+    Plain integers and sums of integers, most of a tally sheet, are evaluated with vectorized string operations,
+    only the remaining cells go through simple_eval.
 
     Args:
         table_dfs (_List_): List of table data frames
+        return_status (bool, optional): Also return which cells could not be evaluated. Defaults to False.
 
     Returns:
-        _List_: List of table data frames
+        _List_: List of table data frames, changed in place. If return_status is True, also a list of boolean
+        data frames of the same shapes, True for the cells that could not be evaluated.
     """
+    status_masks = []
     for table in table_dfs:
-        table_removed_labels = table.iloc[1:, 1:]
-        for col in table_removed_labels.columns:
-            try:
-                # Contents should be strings in order to be editable later
-                table_removed_labels[col] = table_removed_labels[col].apply(lambda x: simple_eval(x) if x and x != "-" else x).astype("str")
-            except Exception:
+        failed = np.zeros(table.shape, dtype=bool)
+        # First row and column hold the labels
+        for col in range(1, table.shape[1]):
+            values = table.iloc[1:, col]
+            is_text = values.map(lambda x: isinstance(x, str)).to_numpy(dtype=bool)
+            positions = np.flatnonzero(is_text)
+            text = pd.Series(values.to_numpy()[is_text], index=positions, dtype=object)
+            text = text[(text != "") & (text != "-")]
+            if text.empty:
                 continue
-        table.update(table_removed_labels)
+
+            is_sum = text.str.fullmatch(INTEGER_SUM_PATTERN).to_numpy(dtype=bool)
+            results = text.copy()
+            if is_sum.any():
+                terms = text[is_sum].str.replace(r"\s", "", regex=True).str.split("+").explode().astype("int64")
+                sums = terms.groupby(level=0).sum().astype(str)
+                results.loc[sums.index] = sums
+            for position in text.index[~is_sum]:
+                # Contents should be strings in order to be editable later
+                try:
+                    results[position] = str(simple_eval(text[position]))
+                except Exception:
+                    failed[position + 1, col] = True
+
+            changed = results[results != text]
+            if not changed.empty:
+                table.iloc[changed.index + 1, col] = changed.to_numpy()
+        status_masks.append(pd.DataFrame(failed, index=table.index, columns=table.columns))
+
+    if return_status:
+        return table_dfs, status_masks
     return table_dfs
 
-def clean_up(table_dfs):
-    """Cleans up values in table that are returned as the string "None" by OCR model into empty string "" 
+def clean_up(table_dfs, inplace=False):
+    """Cleans up values in table that are returned as None (or NaN) or the string "None" by OCR model into empty string ""
+    Each table is cleaned with whole DataFrame operations on its text columns, numeric columns are left as they are.
 
     Args:
         table_dfs (_List_): List of table data frames
+        inplace (bool, optional): Change the given tables instead of returning cleaned copies. Defaults to False.
 
     Returns:
         _List_: List of table data frames
     """
+    cleaned_dfs = []
     for table in table_dfs:
-        for row in range(table.shape[0]):
-            for col in range(table.shape[1]):
-                cell_value = table.iloc[row][col]
-                if cell_value is None or cell_value=="None":
-                    table.iloc[row][col] = ""            
-    return table_dfs
\ No newline at end of file
+        if not inplace:
+            table = table.copy()
+        is_text = [pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype) for dtype in table.dtypes]
+        if all(is_text):
+            table.fillna("", inplace=True)
+            table.replace("None", "", inplace=True)
+        elif any(is_text):
+            table.iloc[:, is_text] = table.iloc[:, is_text].fillna("").replace("None", "")
+        cleaned_dfs.append(table)
+    return cleaned_dfs
+
+
+def set_first_row_as_header(df):
+    """Sets the first row in the recognized table (ideally the header information for each column) as the table header
+
+    Args:
+        df (_DataFrame_): Table data frame with the column names in its first row
+
+    Returns:
+        _DataFrame_: Table data frame without its first row, which became its column names
+    """
+    df.columns = df.iloc[0]
+    df = df.iloc[1:]
+    df.reset_index(drop=True, inplace=True)
+    return df
@@ -0,0 +1,81 @@
+"""Detection of the data set, org unit and period a tally sheet is for, from the OCR'd text in its header.
+Names are matched against the data sets and org units of the DHIS2 server, so the sheet types don't have to be hardcoded.
+"""
+import numpy as np
+
+from msfocr.data import dhis2, post_processing
+from msfocr.data.matching import NameMatcher
+
+# Only lines starting in this top fraction of the page are searched, that is where the sheet title, org unit and period are
+HEADER_FRACTION = 0.4
+
+
+class SheetClassifier:
+    """
+    Finds the type of a tally sheet (dataSet, orgUnit, period) from the result of the docTR OCR model.
+    All header lines are scored against all data set and org unit names at once, which stays fast with
+    thousands of names.
+    """
+
+    def __init__(self, dataSet_names, orgUnit_names, header_fraction=HEADER_FRACTION, date_recognizer=None):
+        """
+        :param dataSet_names: List of data set names
+        :param orgUnit_names: List of org unit names
+        :param header_fraction: Only lines starting in this top fraction of the page are used, 1 uses the whole page
+        :param date_recognizer: post_processing.DateRecognizer for the date formats of the sheets,
+            defaults to the formats of post_processing.get_yyyy_mm_dd
+        """
+        self.dataSet_matcher = NameMatcher(dataSet_names)
+        self.orgUnit_matcher = NameMatcher(orgUnit_names)
+        self.header_fraction = header_fraction
+        self.date_recognizer = date_recognizer if date_recognizer is not None else post_processing.DEFAULT_DATE_RECOGNIZER
+
+    @classmethod
+    def from_dhis2(cls, client=None, metadata_cache=None, header_fraction=HEADER_FRACTION, date_recognizer=None):
+        """
+        Creates a classifier for the data sets and org units of a DHIS2 server. The names are downloaded once
+        and kept in the local metadata cache.
+        :param client: DHIS2Client to use, defaults to the client set up by configure_DHIS2_server
+        :param metadata_cache: MetadataCache to use, defaults to the shared on-disk cache
+        :param header_fraction: See __init__
+        :param date_recognizer: See __init__
+        :return: SheetClassifier
+        """
+        dataSet_names = dhis2.getAllNames('dataSets', 'name', client, metadata_cache)
+        orgUnit_names = dhis2.getAllNames('organisationUnits', 'name', client, metadata_cache)
+        return cls(dataSet_names.values(), orgUnit_names.values(), header_fraction, date_recognizer)
+
+    def header_lines(self, res):
+        """
+        :param res: Result of docTR OCR model
+        :return: Text of the lines in the header region of each page
+        """
+        lines = []
+        for page in res.pages:
+            for block in page.blocks:
+                for line in block.lines:
+                    # Relative (x, y) corners of the line, 0 is the top of the page
+                    top = min(y for _, y in line.geometry)
+                    if top <= self.header_fraction:
+                        lines.append(" ".join(word.value for word in line.words))
+        return lines
+
+    def classify(self, res):
+        """
+        :param res: Result of docTR OCR model
+        :return: List of dataSet, orgUnit, period. dataSet and orgUnit are the names most similar to any header line,
+            or "" if there is none. period is the sorted list of dates found in the header lines, in YYYY-MM-DD format.
+        """
+        lines = self.header_lines(res)
+        dataSet = self._best_name(self.dataSet_matcher, lines)
+        orgUnit = self._best_name(self.orgUnit_matcher, lines)
+        period = [date for line in lines for date in self.date_recognizer.find_dates(line)]
+        return [dataSet, orgUnit, sorted(period)]
+
+    @staticmethod
+    def _best_name(matcher, lines):
+        scores = matcher.scores(lines)
+        if scores.size == 0 or scores.max() <= 0:
+            return ""
+        _, name_index = np.unravel_index(scores.argmax(), scores.shape)
+        return matcher.vocabulary[name_index]
@@ -1,10 +1,27 @@
-import re
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import pandas as pd
-from PIL import Image, ExifTags
+from doctr.io.elements import Document
+from img2table.document import Image as TableImage
+from img2table.ocr import DocTR
+from img2table.ocr.base import OCRInstance
+
+from msfocr import tracing
+from msfocr.data import dhis2, image_utils
+from msfocr.data.sheet_type import SheetClassifier
+
+# Minimum OCR confidence (0-99) of the words img2table puts in table cells
+MIN_CONFIDENCE = 50
 
-from msfocr.data import post_processing
+# Sheet types known without asking DHIS2, used by get_sheet_type when no classifier is given
+DEFAULT_SHEET_CLASSIFIER = SheetClassifier(
+    dataSet_names=["RHGynobs - outpatient (resident/displaced)", "Vaccination - paediatric", "Vaccination - other preventive"],
+    orgUnit_names=["W-14"])
 
+
+@tracing.traced("doctr.get_word_level_content")
 def get_word_level_content(model, doc):
     """
     Inputs a document to the OCR model and returns the result
@@ -16,9 +33,58 @@ def get_word_level_content(model, doc):
     return res
 
 
+@tracing.traced("doctr.get_word_level_content_batch")
+def get_word_level_content_batch(model, docs):
+    """
+    Runs several documents through the OCR model in a single call, so that detection runs over a batch of pages
+    and recognition over the word crops of all pages together, then splits the result back per document.
+
+    Usage:
+    results = get_word_level_content_batch(model, [DocumentFile.from_images(path) for path in paths])
+
+    :param model: docTR OCR model
+    :param docs: List of documents, each a list of pages as returned by DocumentFile
+    :return: List of docTR results, one per document
+    """
+    pages = [page for doc in docs for page in doc]
+    res = model(pages) if len(pages) > 0 else Document(pages=[])
+    return _split_pages(res, [len(doc) for doc in docs])
+
+
+def _split_pages(res, page_counts):
+    results = []
+    start = 0
+    for count in page_counts:
+        results.append(Document(pages=res.pages[start:start + count]))
+        start += count
+    return results
+
+
+class PrecomputedOCR(OCRInstance):
+    """
+    img2table OCR instance that returns a docTR result computed beforehand instead of running the model,
+    so that one OCR pass can be shared between table extraction and other uses of the result.
+    """
+
+    def __init__(self, ocr, res):
+        """
+        :param ocr: img2table DocTR instance, used to convert the result for img2table
+        :param res: docTR result for the pages of the document
+        """
+        self.ocr = ocr
+        self.res = res
+
+    def content(self, document):
+        return self.res
+
+    def to_ocr_dataframe(self, content):
+        return self.ocr.to_ocr_dataframe(content)
+
+
 def get_confidence_values(res):
     """
     Creates a dictionary with text recognized by OCR model as key and model's confidence for the text as the value.
+    Repeated words keep the confidence of their last occurrence, use get_word_boxes to get the confidence of every word.
     :param res: result obtained from doctTR OCR model
     :return: dictionary of { "text recognized" : confidence value } pairs
     """
@@ -31,46 +97,108 @@ def get_confidence_values(res):
     return confidence_dict
 
 
-def get_tabular_content_with_confidence(model, image, confidence_dict=None):
+def get_word_boxes(page):
+    """
+    Collects the bounding boxes and confidences of all words of a page of a docTR result.
+    :param page: Page of a docTR result
+    :return: float32 array of (x1, y1, x2, y2) word boxes in pixels, of shape (number of words, 4),
+        and float32 array of the word confidences
+    """
+    words = [word for block in page.blocks for line in block.lines for word in line.words]
+    if len(words) == 0:
+        return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32)
+    # Relative (x, y) corners, 2 for straight boxes and 4 for rotated ones
+    corners = np.array([word.geometry for word in words], dtype=np.float32)
+    height, width = page.dimensions
+    scale = np.array([width, height, width, height], dtype=np.float32)
+    word_boxes = np.concatenate([corners.min(axis=1), corners.max(axis=1)], axis=1) * scale
+    word_confidences = np.array([word.confidence for word in words], dtype=np.float32)
+    return word_boxes, word_confidences
+
+
+@tracing.traced("doctr.get_cell_confidences")
+def get_cell_confidences(table, word_boxes, word_confidences):
+    """
+    Calculates the confidence of each cell of a table as the mean confidence of the words inside it.
+    A word belongs to the cell containing the center of its box, so repeated words (e.g. "0") each count for their own cell.
+    :param table: ExtractedTable from img2table
+    :param word_boxes: float32 array of (x1, y1, x2, y2) word boxes in pixels, from get_word_boxes
+    :param word_confidences: float32 array of word confidences, from get_word_boxes
+    :return: float32 array with the shape of the table, 0 for cells without words
+    """
+    rows = list(table.content.values())
+    if len(rows) == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    shape = (len(rows), len(rows[0]))
+    cell_boxes = np.array([[cell.bbox.x1, cell.bbox.y1, cell.bbox.x2, cell.bbox.y2] for row in rows for cell in row],
+                          dtype=np.float32)
+    # Merged cells are repeated over the positions they span, so words are assigned to unique cell boxes
+    cell_boxes, positions = np.unique(cell_boxes, axis=0, return_inverse=True)
+
+    centers = (word_boxes[:, :2] + word_boxes[:, 2:]) / 2
+    inside = ((centers[:, None, 0] >= cell_boxes[None, :, 0]) & (centers[:, None, 0] <= cell_boxes[None, :, 2])
+              & (centers[:, None, 1] >= cell_boxes[None, :, 1]) & (centers[:, None, 1] <= cell_boxes[None, :, 3]))
+    in_table = inside.any(axis=1)
+    cell_of_word = inside.argmax(axis=1)[in_table]
+
+    totals = np.bincount(cell_of_word, weights=word_confidences[in_table], minlength=len(cell_boxes))
+    counts = np.bincount(cell_of_word, minlength=len(cell_boxes))
+    means = np.divide(totals, counts, out=np.zeros(len(cell_boxes)), where=counts > 0)
+    return means[positions.reshape(-1)].reshape(shape).astype(np.float32)
+
+
+@tracing.traced("doctr._extract_tables")
+def _extract_tables(model, image):
+    return image.extract_tables(ocr=model,
+                                implicit_rows=False,
+                                borderless_tables=False,
+                                min_confidence=MIN_CONFIDENCE)
+
+
+def _tables_with_confidence(model, image, res):
+    extracted_tables = _extract_tables(PrecomputedOCR(model, res), image)
+    # Words below img2table's min_confidence are left out of the cells, so they don't count for the cell confidence either
+    word_boxes, word_confidences = get_word_boxes(res.pages[0])
+    kept = np.round(100 * word_confidences) >= MIN_CONFIDENCE
+    word_boxes, word_confidences = word_boxes[kept], word_confidences[kept]
+
+    table_df = [table.df for table in extracted_tables]
+    confidence_df = [get_cell_confidences(table, word_boxes, word_confidences) for table in extracted_tables]
+    return table_df, confidence_df
+
+
+@tracing.traced("doctr.get_tabular_content_with_confidence")
+def get_tabular_content_with_confidence(model, image):
     """
     Runs the input image in the OCR model. Detects all tables and content within tables and stores results as
-    a list of pandas dataFrames (table_df). Calculates confidence values for all detected values in table_df
-    and stores it in a list of pandas dataFrames (confidence_df).
-    :param model: OCR model
+    a list of pandas dataFrames (table_df). Calculates the confidence of every cell in table_df from the words
+    inside it and stores it as a list of float32 arrays (confidence_df), with the same shape as the tables.
+    :param model: OCR model (img2table DocTR instance)
     :param image: Image to be tested (Image object from img2table package)
-    :param confidence_dict: Dictionary of text-confidence values
-    :return: Two dataframes, table_df and confidence_df
+    :return: Two lists, table_df and confidence_df
     """
-    if confidence_dict is None:
-        confidence_dict = {}
-    extracted_tables = image.extract_tables(ocr=model,
-                                            implicit_rows=False,
-                                            borderless_tables=False,
-                                            min_confidence=50)
+    return _tables_with_confidence(model, image, model.content(image))
 
-    table_df = []
-    for _, table in enumerate(extracted_tables):
-        table_df.append(table.df)
 
-    confidence_df = [pd.DataFrame(np.zeros(df.shape), columns=df.columns, index=df.index) for df in table_df]
-
-    for idx in range(len(table_df)):
-        array = table_df[idx].values
-        for row in range(array.shape[0]):
-            for col in range(array.shape[1]):
-                confidence = 0
-                count = 0
-                if array[row][col] is not None:
-                    words = re.split(r'[ \n]+', array[row][col])
-                    for word in words:
-                        if word in confidence_dict:
-                            confidence += confidence_dict[word]
-                            count += 1
-                    if count != 0: 
-                        confidence_df[idx].iloc[row, col] = confidence / count
+@tracing.traced("doctr.get_sheet_content")
+def get_sheet_content(model, image, classifier=None):
+    """
+    Runs docTR once on the image and uses the same result for table extraction, cell confidences and sheet type
+    detection, instead of running the model separately for get_tabular_content and get_word_level_content.
+
+    Usage:
+    table_df, confidence_df, sheet_type = get_sheet_content(DocTR(detect_language=False), Image(src=path))
 
-    return table_df, confidence_df
+    :param model: OCR model (img2table DocTR instance)
+    :param image: Image to be tested (Image object from img2table package)
+    :param classifier: SheetClassifier used to find the sheet type, see get_sheet_type
+    :return: List of table DataFrames, list of float32 cell confidence arrays and the sheet type, see get_sheet_type
+    """
+    res = model.content(image)
+    table_df, confidence_df = _tables_with_confidence(model, image, res)
+    return table_df, confidence_df, get_sheet_type(res, classifier)
 
+@tracing.traced("doctr.get_tabular_content")
 def get_tabular_content(model, image):
     """
     Runs the input image in the OCR model. Detects all tables and content within tables and stores results as
@@ -79,10 +207,7 @@ def get_tabular_content(model, image):
     :param image: Image to be tested (Image object from img2table package)
     :return: Dataframe table_df 
     """
-    extracted_tables = image.extract_tables(ocr=model,
-                                            implicit_rows=False,
-                                            borderless_tables=False,
-                                            min_confidence=50)
+    extracted_tables = _extract_tables(model, image)
 
     table_df = []
     for _, table in enumerate(extracted_tables):
@@ -90,42 +215,140 @@ def get_tabular_content(model, image):
 
     return table_df
 
-def get_sheet_type(res):
+@tracing.traced("doctr.get_tabular_content_batch")
+def get_tabular_content_batch(ocr, images, batch_size=8):
+    """
+    Extracts the tables of several images, running docTR over batches of pages from all images instead of
+    one image at a time. Table detection then runs per image on its share of the OCR result.
+
+    Usage:
+    table_dfs = get_tabular_content_batch(DocTR(detect_language=False), [Image(src=path) for path in paths])
+
+    :param ocr: img2table DocTR instance
+    :param images: List of images to be tested (Image objects from img2table package)
+    :param batch_size: Maximum number of images whose pages are sent to the model together
+    :return: List with the list of table DataFrames of each image
+    """
+    table_dfs = []
+    for start in range(0, len(images), batch_size):
+        batch = images[start:start + batch_size]
+        page_counts = [len(image.images) for image in batch]
+        res = ocr.model([page for image in batch for page in image.images])
+        for image, image_res in zip(batch, _split_pages(res, page_counts)):
+            table_dfs.append(get_tabular_content(PrecomputedOCR(ocr, image_res), image))
+    return table_dfs
+
+@tracing.traced("doctr.create_ocr_models")
+def create_ocr_models(n_models=None):
+    """
+    Loads the img2table docTR models used by iter_tabular_content, one per worker.
+    :param n_models: Number of models, defaults to the number of CPU cores, at most 4 as each model takes a few hundred MB
+    :return: List of DocTR OCR instances
+    """
+    if n_models is None:
+        n_models = min(os.cpu_count() or 1, 4)
+    return [DocTR(detect_language=False) for _ in range(n_models)]
+
+def create_model_pool(models):
+    """
+    Puts OCR models in a pool that can be shared by concurrent calls of iter_tabular_content, e.g. from several
+    Streamlit sessions. A model is taken out of the pool while a sheet is processed, so it is only ever used
+    by one thread at a time, whichever call the thread belongs to.
+
+    Usage:
+    model_pool = create_model_pool(create_ocr_models())
+
+    :param models: List of OCR models (img2table DocTR instances)
+    :return: queue.Queue holding the models
+    """
+    model_pool = queue.Queue(maxsize=len(models))
+    for model in models:
+        model_pool.put(model)
+    return model_pool
+
+def _iter_concurrently(function, sheets, models, return_exceptions=False):
+    if isinstance(models, queue.Queue):
+        available_models = models
+        n_models = models.maxsize
+    else:
+        available_models = create_model_pool(models)
+        n_models = len(models)
+
+    @tracing.propagate
+    def process_sheet(sheet):
+        model = available_models.get()
+        try:
+            if hasattr(sheet, "seek"):
+                sheet.seek(0)
+            return function(model, TableImage(src=sheet))
+        except Exception as e:
+            if return_exceptions:
+                return e
+            raise
+        finally:
+            available_models.put(model)
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(n_models, len(sheets))))
+    try:
+        yield from enumerate(executor.map(process_sheet, sheets))
+    finally:
+        # Sheets not started yet are dropped if the caller stops iterating early
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def iter_tabular_content(sheets, models, return_exceptions=False):
+    """
+    Extracts the tables of several tally sheets concurrently, one worker thread per model. Image decoding,
+    table detection and docTR recognition of a sheet all run in its worker.
+    Results are yielded in page order as soon as they and the pages before them are done. Closing the generator
+    early cancels the sheets that haven't started yet.
+
+    Usage:
+    for page_index, table_df in iter_tabular_content(tally_sheet_images, create_ocr_models()):
+        ...
+
+    :param sheets: List of images, as paths or file objects
+    :param models: List of OCR models (img2table DocTR instances), each one is only used by one worker at a time,
+        or a pool from create_model_pool to share the models with other concurrent calls
+    :param return_exceptions: If True, sheets that failed have their exception yielded instead of stopping the iteration
+    :return: Generator of (page index, list of table DataFrames) tuples
+    """
+    return _iter_concurrently(get_tabular_content, sheets, models, return_exceptions)
+
+def iter_sheet_content(sheets, models, classifier=None, return_exceptions=False):
+    """
+    Same as iter_tabular_content, but yields the full result of get_sheet_content for each sheet.
+
+    Usage:
+    for page_index, (table_df, confidence_df, sheet_type) in iter_sheet_content(tally_sheet_images, create_ocr_models()):
+        ...
+
+    :param sheets: List of images, as paths or file objects
+    :param models: List of OCR models (img2table DocTR instances), each one is only used by one worker at a time,
+        or a pool from create_model_pool to share the models with other concurrent calls
+    :param classifier: SheetClassifier used to find the sheet type, see get_sheet_type
+    :param return_exceptions: See iter_tabular_content
+    :return: Generator of (page index, (list of table DataFrames, list of confidence arrays, sheet type)) tuples
+    """
+    return _iter_concurrently(lambda model, image: get_sheet_content(model, image, classifier), sheets, models,
+                              return_exceptions)
+
+@tracing.traced("doctr.get_sheet_type")
+def get_sheet_type(res, classifier=None):
     """
     Finds the type of the tally sheet (dataSet, orgUnit, period) from the result of OCR model, where
     dataSet is the name of the dataset.
     orgUnit is the name of the organization unit where the data was taken.
     period is list of start and end dates detected.
     :param res: Result of OCR model
+    :param classifier: sheet_type.SheetClassifier with the names to look for, use SheetClassifier.from_dhis2 to
+        match against the data sets and org units of the DHIS2 server. Defaults to a few known sheet types.
     :return: List of dataSet, orgUnit, period.
     """
-    dataSet_list = ["RHGynobs - outpatient (resident/displaced)", "Vaccination - paediatric", "Vaccination - other preventive"]
-    orgUnit_list = ["W-14"]
-
-    max_similarity_dataSet = 0
-    max_similarity_orgUnit = 0
-    dataSet = ""
-    orgUnit = ""
-    period = []
-    for page in res.pages:
-        for block in page.blocks:
-            for line in block.lines:
-                text = " ".join(word.value for word in line.words)
-                for name in dataSet_list:
-                    sim = post_processing.letter_by_letter_similarity(text, name)
-                    if max_similarity_dataSet < sim:
-                        max_similarity_dataSet = sim
-                        dataSet = name
-                for name in orgUnit_list:
-                    sim = post_processing.letter_by_letter_similarity(text, name)
-                    if max_similarity_orgUnit < sim:
-                        max_similarity_orgUnit = sim
-                        orgUnit = name
-                date = post_processing.get_yyyy_mm_dd(text)
-                if date is not None:
-                    period.append(date)
-    return [dataSet, orgUnit, sorted(period)]
+    if classifier is None:
+        classifier = DEFAULT_SHEET_CLASSIFIER
+    return classifier.classify(res)
 
+@tracing.traced("doctr.generate_key_value_pairs")
 def generate_key_value_pairs(table, form):
     """
     Generates key-value pairs in the format required to upload data to DHIS2.
@@ -134,8 +357,10 @@ def generate_key_value_pairs(table, form):
      'value': cell_value}
      UIDs like data_element_id, category_id are obtained by querying the DHIS2 metadata.
     :param table: DataFrame generated from table detection
+    :param form: json data of the form or its dhis2.FormIndex, pass the FormIndex when processing several tables of the same form
     :return: List of key value pairs as shown above.
     """ 
+    form_index = form if isinstance(form, dhis2.FormIndex) else dhis2.FormIndex(form)
     data_element_pairs = []
 
     # Iterate over each cell in the DataFrame
@@ -148,22 +373,14 @@ def generate_key_value_pairs(table, form):
             # Column name in tally sheet
             category = columns[col_index]
             cell_value = table_array[row_index][col_index]
-            if cell_value is not None and cell_value!="-" and cell_value!="" and cell_value!="None":
-                data_element_id = None
-                category_id = None
-                # Search for the string in the "label" field of form information
-                string_search = data_element + " " + category
-                for group in form['groups']:
-                    for field in group['fields']:
-                        if field['label']==string_search:
-                            data_element_id = field['dataElement']
-                            category_id = field['categoryOptionCombo']
+            if not dhis2.is_empty_cell(cell_value, empty_values=("-", "", "None")):
+                data_element_id, category_id = form_index.lookup(data_element, category)
                 
                 # The following exceptions will be raised if the row or column name in the tally sheet is different from the names used in metadata
                 # For eg. Pop1: Resident is called Population 1 in metadata
                 # If this exception is raised the only way forward is for the user to manually change the row/column name to the one used in metadata
                 if data_element_id is None or category_id is None:
-                    raise Exception(f"Unable to find {string_search} in DHIS2 metadata")
+                    raise Exception(f"Unable to find {data_element} {category} in DHIS2 metadata")
                 # Append to the list of data elements to be push to DHIS2
                 data_element_pairs.append(
                     {"dataElement": data_element_id,
@@ -175,7 +392,7 @@ def generate_key_value_pairs(table, form):
 
 def correct_image_orientation(image_path):
     """
-    Corrects the orientation of an image based on its EXIF data.
+    Corrects the orientation of an image based on its EXIF data, see msfocr.data.image_utils.normalize_image.
 
     Usage:
     corrected_image = correct_image_orientation("path/to/image.jpg")
@@ -183,23 +400,7 @@ def correct_image_orientation(image_path):
     :param image_path: The path to the image file.
     :return: PIL.Image.Image: The image with corrected orientation.
     """
-    with Image.open(image_path) as image:
-        image.load()
-    orientation = None
-    try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        exif = dict(image.getexif().items())
-        if exif.get(orientation) == 3:
-            image = image.rotate(180, expand=True)
-        elif exif.get(orientation) == 6:
-            image = image.rotate(270, expand=True)
-        elif exif.get(orientation) == 8:
-            image = image.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        pass
-    return image
+    return image_utils.normalize_image(image_path)
 
 # ocr_model = ocr_predictor(det_arch='db_resnet50', reco_arch='crnn_vgg16_bn', pretrained=True)
 # document = DocumentFile.from_images("IMG_20240514_090947.jpg")
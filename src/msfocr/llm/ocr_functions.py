@@ -2,37 +2,161 @@
 Note that the OPENAI_API_KEY environment variable must be set for this module to work correctly. 
 This should be done before you run your program. See https://github.com/openai/openai-python for details
 """ 
+import asyncio
 import base64
 import json
-from concurrent.futures.thread import ThreadPoolExecutor
+import random
+import threading
+import time
 from io import BytesIO
 
 import pandas as pd
 
-from openai import OpenAI
-from PIL import Image, ExifTags, ImageOps
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, InternalServerError, OpenAI, RateLimitError
 
-def get_results(uploaded_image_paths):
+from msfocr import tracing
+from msfocr.data import image_utils
+from msfocr.data.cache import ResultCache, get_cache_dir
+
+MODEL = "gpt-4o"
+
+# Options of encode_image_payload used for the images sent to OpenAI, also part of the cache key of their results.
+# Resized to GPT's proportions (max 2048 x 768), JPEG is several times smaller than PNG for photos of tally sheets.
+DEFAULT_ENCODING = {"format": "JPEG", "quality": 90, "grayscale": False, "max_size": 2048, "min_size": 768}
+
+MIME_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp"}
+
+PROMPT = ("Analyze this image as a completely new task. "
+          "Identify and parse all tables and non-table data. "
+          "For each table, carefully examine and transcribe its name from the image, typically located at the top left of the table. "
+          "If the table name is unclear or missing, label it 'Table X' where X is a sequential number. "
+          "Do not use any previously identified table names. "
+          "Apply image corrections if needed for better text recognition. "
+          "Construct each table with its newly identified name, columns, and rows, extracting all visible numbers. "
+          "Format JSON with two main objects: 1) 'tables': an array of table objects {'table_name': '...', 'headers': [...], 'data': [[...], ...]}, 2) 'non_table_data': an object with key-value pairs for all non-table information. "
+          "Respond only with the JSON: {'tables': [...], 'non_table_data': {...}}. "
+          "No explanations. "
+          "Treat this as an entirely new image with no relation to any previous tasks.")
+
+# Errors that are retried with backoff, anything else (e.g. an invalid API key) fails the image straight away
+RETRYABLE_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+
+
+class BatchCancelledError(Exception):
+    """Result of an image that was not sent to the API because its batch was cancelled."""
+
+# Synchronous client shared by extract_text_from_image calls
+_client = None
+_client_lock = threading.Lock()
+
+_result_cache = None
+
+
+def get_openai_client():
+    """
+    Returns the OpenAI client shared by the synchronous functions of this module, created on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = OpenAI()
+    return _client
+
+
+def get_result_cache():
+    """
+    Returns the on-disk cache of OpenAI results shared by the whole process, stored in the llm_results
+    folder of the cache directory.
+    """
+    global _result_cache
+    with _client_lock:
+        if _result_cache is None:
+            _result_cache = ResultCache(get_cache_dir() / "llm_results")
+    return _result_cache
+
+
+def read_image_bytes(image_path):
+    """
+    Reads the raw bytes of an image given as a path or a file object, leaving file objects at their start.
+    """
+    if hasattr(image_path, "read"):
+        image_path.seek(0)
+        data = image_path.read()
+        image_path.seek(0)
+        return data
+    with open(image_path, "rb") as f:
+        return f.read()
+
+
+def get_encoding(encoding=None):
+    """
+    Completes encoding options with the values of DEFAULT_ENCODING.
+    """
+    return {**DEFAULT_ENCODING, **(encoding or {})}
+
+
+def result_cache_key(image_path, encoding=None):
+    """
+    Cache key of the result of an image: hash of the image bytes, prompt, model and preprocessing parameters.
+    """
+    return ResultCache.make_key(read_image_bytes(image_path), PROMPT, MODEL, get_encoding(encoding))
+
+
+@tracing.traced("llm.get_results")
+def get_results(uploaded_image_paths, return_exceptions=False, cache=None, encoding=None, on_result=None, **batch_options):
     """
     Processes uploaded image paths using the OpenAI API and returns the results.
+    Results are looked up per image in an on-disk cache first, so only images that were never processed
+    before are sent to the API.
 
     Usage:
     image_paths = ["path/to/image1.jpg", "path/to/image2.jpg"]
     results = get_results(image_paths)
 
     :param uploaded_image_paths: List of uploaded image file paths.
+    :param return_exceptions: If True, images that failed have their exception in the results instead of raising it.
+    :param cache: ResultCache to use, None for the default on-disk cache and False to always call the API
+    :param encoding: Options of encode_image_payload overriding DEFAULT_ENCODING
+    :param on_result: Function called with (image index, result or exception) as soon as each image is done,
+        right away for cached images
+    :param batch_options: Options passed on to extract_text_from_batch_images_async, e.g. max_concurrency
     :return: List of results from the OpenAI API.
     """
-    '''
-    results = []
-    for img_path in uploaded_image_paths:
-        result = extract_text_from_image(img_path)
-        results.append(result)
-    '''
-
-    return extract_text_from_batch_images(uploaded_image_paths)
+    if cache is False:
+        return extract_text_from_batch_images(uploaded_image_paths, return_exceptions=return_exceptions, encoding=encoding,
+                                              on_result=on_result, **batch_options)
+    cache = cache if cache is not None else get_result_cache()
+
+    keys = [result_cache_key(image_path, encoding) for image_path in uploaded_image_paths]
+    results = [cache.get(key) for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    tracing.set_attributes(images=len(uploaded_image_paths), cached=len(uploaded_image_paths) - len(missing))
+    if on_result is not None:
+        for i, result in enumerate(results):
+            if result is not None:
+                on_result(i, result)
+
+    def store_result(position, result):
+        # Stored as soon as it arrives, so finished images are not lost if the batch is interrupted
+        i = missing[position]
+        results[i] = result
+        if not isinstance(result, Exception):
+            cache.put(keys[i], result)
+        if on_result is not None:
+            on_result(i, result)
+
+    if len(missing) > 0:
+        extract_text_from_batch_images([uploaded_image_paths[i] for i in missing], return_exceptions=True,
+                                       encoding=encoding, on_result=store_result, **batch_options)
+
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+    return results
 
 
+@tracing.traced("llm.parse_table_data")
 def parse_table_data(result):
     """
     Parses table data from the OpenAI API results into DataFrames.
@@ -83,7 +207,64 @@ def rescale_image(img, limit, maxi=True):
     return img
 
 
-def encode_image(image_path):
+def _target_size(size, max_size, min_size):
+    """Size of an image after scaling it down so that its largest dimension fits max_size and its smallest min_size."""
+    width, height = size
+    scale = min(1, max_size / max(width, height), min_size / min(width, height))
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+@tracing.traced("llm.encode_image_payload")
+def encode_image_payload(image_path, format=None, quality=None, grayscale=None, max_size=None, min_size=None):
+    """
+    Encodes an image file for the OpenAI API: applies the EXIF orientation, shrinks it in a single resize so that
+    neither its largest dimension exceeds max_size nor its smallest min_size, then encodes it in base64.
+    JPEG sources are decoded directly at a reduced scale when they are much larger than needed.
+    Options left as None take their value from DEFAULT_ENCODING, like the encoding options of get_results.
+
+    Usage:
+    payload = encode_image_payload(image_file, format="JPEG", quality=85, grayscale=True)
+
+    :param image_path: File object or path of the image to encode.
+    :param format: Output format, one of "PNG", "JPEG" or "WEBP"
+    :param quality: Quality of lossy formats, from 1 to 100
+    :param grayscale: Convert the image to grayscale, which is enough for tally sheets and makes it smaller
+    :param max_size: Maximum size of the largest dimension in pixels
+    :param min_size: Maximum size of the smallest dimension in pixels
+    :return: Dictionary with the base64 string ("data"), its MIME type ("mime_type"),
+        the size of the encoded image in bytes ("size") and its dimensions ("dimensions")
+    """
+    options = get_encoding({name: value for name, value in (("format", format), ("quality", quality), ("grayscale", grayscale),
+                                                            ("max_size", max_size), ("min_size", min_size))
+                            if value is not None})
+    format, quality, grayscale = options["format"].upper(), options["quality"], options["grayscale"]
+    max_size, min_size = options["max_size"], options["min_size"]
+    if format not in MIME_TYPES:
+        raise ValueError(f"Unsupported image format {format}, use one of {list(MIME_TYPES)}")
+    # The header tells the size, so the JPEG decoder can skip detail we would throw away.
+    # The decoded image is still at least the target size.
+    draft_size = _target_size(image_utils.get_image_metadata(image_path)["dimensions"], max_size, min_size)
+    img = image_utils.normalize_image(image_path, "L" if grayscale else None, draft_size)
+    if img.mode not in ("RGB", "L") and not (format != "JPEG" and img.mode == "RGBA"):
+        img = img.convert("RGB")
+    target_size = _target_size(img.size, max_size, min_size)
+    if img.size != target_size:
+        img = img.resize(target_size)
+
+    buffered = BytesIO()
+    if format == "PNG":
+        img.save(buffered, format=format)
+    else:
+        img.save(buffered, format=format, quality=quality)
+    data = buffered.getvalue()
+    tracing.set_attributes(format=format, size=len(data), dimensions=img.size)
+    return {"data": base64.b64encode(data).decode("utf-8"),
+            "mime_type": MIME_TYPES[format],
+            "size": len(data),
+            "dimensions": img.size}
+
+
+def encode_image(image_path, **encoding):
     """
     Encodes an image file to base64 string.
 
@@ -91,19 +272,33 @@ def encode_image(image_path):
     base64_string = encode_image(image_file)
 
     :param image_path: File object of the image to encode.
+    :param encoding: Options of encode_image_payload, e.g. format="JPEG"
     :return: Base64 encoded string of the image.
     """
-    image_path.seek(0)
-    with Image.open(image_path) as img:
-        img = ImageOps.exif_transpose(img)
-        img = rescale_image(img, 2048, True)
-        img = rescale_image(img, 768, False)
-        buffered = BytesIO()
-        img.save(buffered, format="PNG")
-        return base64.b64encode(buffered.getvalue()).decode("utf-8")
+    return encode_image_payload(image_path, **encoding)["data"]
 
 
-def extract_text_from_image(image_path):
+def build_messages(base64_image, mime_type=MIME_TYPES[DEFAULT_ENCODING["format"]]):
+    """
+    Builds the chat messages asking the model to extract the tables of an image.
+    :param base64_image: Base64 encoded image
+    :param mime_type: MIME type of the encoded image
+    :return: List of messages for the chat completions API
+    """
+    return [
+        {"role": "user", "content": [
+            {"type": "text",
+             "text": PROMPT
+             },
+            {"type": "image_url", "image_url": {
+                "url": f"data:{mime_type};base64,{base64_image}"}
+             }
+        ]}
+    ]
+
+
+@tracing.traced("llm.extract_text_from_image")
+def extract_text_from_image(image_path, client=None, encoding=None):
     """
     Extracts text and table data from an image using OpenAI's GPT-4 vision model.
 
@@ -111,57 +306,187 @@ def extract_text_from_image(image_path):
     result = extract_text_from_image("path/to/image.jpg")
 
     :param image_path: Path to the image file.
+    :param client: OpenAI client to use, defaults to the client shared by this module
+    :param encoding: Options of encode_image_payload overriding DEFAULT_ENCODING
     :return: JSON object containing extracted text and table data.
     """
-    client = OpenAI()
-    MODEL = "gpt-4o"
-    base64_image = encode_image(image_path)
+    client = client if client is not None else get_openai_client()
+    payload = encode_image_payload(image_path, **get_encoding(encoding))
     response = client.chat.completions.create(
         model=MODEL,
-        messages=[
-            {"role": "user", "content": [
-                {"type": "text",
-                 "text": "Analyze this image as a completely new task. "
-                         "Identify and parse all tables and non-table data. "
-                         "For each table, carefully examine and transcribe its name from the image, typically located at the top left of the table. "
-                         "If the table name is unclear or missing, label it 'Table X' where X is a sequential number. "
-                         "Do not use any previously identified table names. "
-                         "Apply image corrections if needed for better text recognition. "
-                         "Construct each table with its newly identified name, columns, and rows, extracting all visible numbers. "
-                         "Format JSON with two main objects: 1) 'tables': an array of table objects {'table_name': '...', 'headers': [...], 'data': [[...], ...]}, 2) 'non_table_data': an object with key-value pairs for all non-table information. "
-                         "Respond only with the JSON: {'tables': [...], 'non_table_data': {...}}. "
-                         "No explanations. "
-                         "Treat this as an entirely new image with no relation to any previous tasks."
-
-                 },
-                {"type": "image_url", "image_url": {
-                    "url": f"data:image/png;base64,{base64_image}"}
-                 }
-            ]}
-        ],
+        messages=build_messages(payload["data"], payload["mime_type"]),
         temperature=0.0,
         response_format={"type": "json_object"}
     )
     return json.loads(response.choices[0].message.content)
 
-def extract_text_from_batch_images(image_paths):
+
+class AsyncRateLimiter:
+    """
+    Token bucket limiting how many requests are started per minute, shared by all the requests of a batch.
+    """
+
+    def __init__(self, requests_per_minute, burst=None):
+        """
+        :param requests_per_minute: Average number of requests allowed per minute
+        :param burst: Number of requests that can start at once after an idle period, defaults to one second's worth
+        """
+        self.rate = requests_per_minute / 60
+        self.capacity = burst if burst is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Waits until a request may be sent."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds):
+        """
+        Holds back all requests for the given time, e.g. after the API answered with a rate limit error.
+        Pauses requested at the same time don't add up, requests are held back until the furthest one ends.
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+def _retry_delay(error, attempt, base_delay, max_delay):
+    """Delay before retrying: the Retry-After header if the API sent one, otherwise exponential backoff with full jitter."""
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            return min(max_delay, float(response.headers.get("retry-after")))
+        except (TypeError, ValueError):
+            pass
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+@tracing.traced("llm.extract_text_from_image_async")
+async def extract_text_from_image_async(image_path, client, semaphore, rate_limiter, max_retries=5, base_delay=1.0, max_delay=60.0,
+                                        encoding=None, cancelled=None):
+    """
+    Extracts text and table data from an image with an AsyncOpenAI client, retrying rate limit, timeout,
+    connection and server errors with exponential backoff.
+
+    :param image_path: Path to the image file.
+    :param client: AsyncOpenAI client
+    :param semaphore: asyncio.Semaphore limiting the number of requests in flight
+    :param rate_limiter: AsyncRateLimiter limiting the number of requests started per minute
+    :param max_retries: Number of retries before giving up on the image
+    :param base_delay: Delay in seconds before the first retry, doubled for each following one
+    :param max_delay: Maximum delay in seconds between two attempts
+    :param encoding: Options of encode_image_payload overriding DEFAULT_ENCODING
+    :param cancelled: Function returning True once the batch is cancelled, no request is sent for the image after that
+    :return: JSON object containing extracted text and table data.
+    """
+    def check_cancelled():
+        if cancelled is not None and cancelled():
+            raise BatchCancelledError(f"Recognition of {image_path} was cancelled")
+
+    check_cancelled()
+    # Image decoding and resizing is CPU work, keep it off the event loop
+    payload = await asyncio.to_thread(lambda: encode_image_payload(image_path, **get_encoding(encoding)))
+    messages = build_messages(payload["data"], payload["mime_type"])
+    for attempt in range(max_retries + 1):
+        await rate_limiter.acquire()
+        try:
+            async with semaphore:
+                # Checked again after waiting, which can take long in a large batch
+                check_cancelled()
+                # Only the request itself, waiting for the rate limiter and a free slot is left out
+                with tracing.span("llm.openai_request", attempt=attempt):
+                    response = await client.chat.completions.create(
+                        model=MODEL,
+                        messages=messages,
+                        temperature=0.0,
+                        response_format={"type": "json_object"}
+                    )
+            return json.loads(response.choices[0].message.content)
+        except RETRYABLE_ERRORS as error:
+            if attempt == max_retries:
+                raise
+            delay = _retry_delay(error, attempt, base_delay, max_delay)
+            if isinstance(error, RateLimitError):
+                rate_limiter.pause(delay)
+            await asyncio.sleep(delay)
+
+
+@tracing.traced("llm.extract_text_from_batch_images_async")
+async def extract_text_from_batch_images_async(image_paths, client=None, max_concurrency=4, requests_per_minute=60, max_retries=5,
+                                               encoding=None, on_result=None, cancelled=None):
+    """
+    Extracts text and table data from multiple images concurrently, using one AsyncOpenAI client for the whole batch.
+    An image that fails doesn't stop the others, its exception is returned in place of its result.
+
+    :param image_paths: List of paths to the image files.
+    :param client: AsyncOpenAI client, a new one is created and closed for the batch if not given
+    :param max_concurrency: Maximum number of requests in flight at the same time
+    :param requests_per_minute: Maximum average number of requests started per minute
+    :param max_retries: Number of retries for each image before giving up on it
+    :param encoding: Options of encode_image_payload overriding DEFAULT_ENCODING
+    :param on_result: Function called with (image index, result or exception) as soon as each image is done
+    :param cancelled: Function returning True once the batch is cancelled, e.g. BackgroundJob's cancelled.
+        Images not sent to the API yet then get a BatchCancelledError as their result.
+    :return: List with, for each image, the JSON object of extracted data or the exception raised for it
+    """
+    owns_client = client is None
+    if owns_client:
+        # Retries are handled here, so that they are coordinated with the rate limiter
+        client = AsyncOpenAI(max_retries=0)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = AsyncRateLimiter(requests_per_minute)
+
+    async def extract(index, image_path):
+        try:
+            result = await extract_text_from_image_async(image_path, client, semaphore, rate_limiter, max_retries,
+                                                         encoding=encoding, cancelled=cancelled)
+        except Exception as e:
+            result = e
+        if on_result is not None:
+            on_result(index, result)
+        return result
+
+    try:
+        return await asyncio.gather(*(extract(index, image_path) for index, image_path in enumerate(image_paths)))
+    finally:
+        if owns_client:
+            await client.close()
+
+
+@tracing.traced("llm.extract_text_from_batch_images")
+def extract_text_from_batch_images(image_paths, return_exceptions=False, **batch_options):
     """
     Extracts text and table data from multiple images using OpenAI's GPT-4 omni model.
-    This version processes images concurrently using multithreading.
+    Synchronous wrapper around extract_text_from_batch_images_async, images are processed concurrently.
 
     Usage:
-    results = extract_text_from_images(["path/to/image1.jpg", "path/to/image2.jpg"])
+    results = extract_text_from_batch_images(["path/to/image1.jpg", "path/to/image2.jpg"])
 
     :param image_paths: List of paths to the image files.
+    :param return_exceptions: If True, images that failed have their exception in the results instead of raising it.
+    :param batch_options: Options passed on to extract_text_from_batch_images_async, e.g. max_concurrency
     :return: List of JSON objects containing extracted text and table data for each image.
     """
-    with ThreadPoolExecutor() as executor:
-        results = list(executor.map(extract_text_from_image, image_paths))
+    results = asyncio.run(extract_text_from_batch_images_async(image_paths, **batch_options))
+    if not return_exceptions:
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
     return results
 
 def correct_image_orientation(image_path):
     """
-    Corrects the orientation of an image based on its EXIF data.
+    Corrects the orientation of an image based on its EXIF data, see msfocr.data.image_utils.normalize_image.
 
     Usage:
     corrected_image = correct_image_orientation("path/to/image.jpg")
@@ -169,23 +494,6 @@ def correct_image_orientation(image_path):
     :param image_path: The path to the image file.
     :return: PIL.Image.Image: The image with corrected orientation.
     """
-    with Image.open(image_path) as image:
-        image.load()
-
-    orientation = None
-    try:
-        for orientation in ExifTags.TAGS.keys():
-            if ExifTags.TAGS[orientation] == 'Orientation':
-                break
-        exif = dict(image.getexif().items())
-        if exif.get(orientation) == 3:
-            image = image.rotate(180, expand=True)
-        elif exif.get(orientation) == 6:
-            image = image.rotate(270, expand=True)
-        elif exif.get(orientation) == 8:
-            image = image.rotate(90, expand=True)
-    except (AttributeError, KeyError, IndexError):
-        pass
-    return image
+    return image_utils.normalize_image(image_path)
 
 
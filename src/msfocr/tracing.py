@@ -0,0 +1,293 @@
+"""Lightweight timing spans for the OCR pipeline, to find out which stage a slow upload spent its time in.
+
+Usage:
+with tracing.span("dhis2.getFormJson", dataSet=dataSet_uid):
+    ...
+
+@tracing.traced("llm.get_results")
+def get_results(...):
+    ...
+
+Spans nest through contextvars, so they follow asyncio tasks, and threads started with propagate or BackgroundJob.
+Nothing is recorded until exporters are set with configure: InMemoryExporter keeps the spans of each trace, e.g. a
+Streamlit session, and OpenTelemetryExporter forwards them to OpenTelemetry. Without exporters a span costs a few
+attribute lookups.
+"""
+import contextvars
+import functools
+import inspect
+import itertools
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# Exporters spans are reported to, none by default
+_exporters = ()
+# (trace id, innermost open Span) of the running code
+_current = contextvars.ContextVar("msfocr_tracing_current", default=(None, None))
+_span_ids = itertools.count(1)
+
+
+class Span:
+    """
+    One timed operation. Times are in nanoseconds since the epoch, like OpenTelemetry's.
+    """
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "attributes", "start_time_ns", "end_time_ns",
+                 "error", "thread_name", "_start_counter")
+
+    def __init__(self, name, trace_id, parent_id, attributes):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = next(_span_ids)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_time_ns = time.time_ns()
+        self.end_time_ns = None
+        self.error = None
+        self.thread_name = threading.current_thread().name
+        self._start_counter = time.perf_counter_ns()
+
+    def set_attributes(self, **attributes):
+        self.attributes.update(attributes)
+
+    def _end(self):
+        # The monotonic clock gives the duration, the wall clock only the start
+        self.end_time_ns = self.start_time_ns + time.perf_counter_ns() - self._start_counter
+
+    @property
+    def duration(self):
+        """
+        :return: Duration in seconds, None while the span is open
+        """
+        return (self.end_time_ns - self.start_time_ns) / 1e9 if self.end_time_ns is not None else None
+
+
+class _NoSpan:
+    """Stands in for a Span when nothing is recorded."""
+
+    def set_attributes(self, **attributes):
+        pass
+
+
+NO_SPAN = _NoSpan()
+
+
+def configure(*exporters):
+    """
+    Sets the exporters spans are reported to, replacing the previous ones. configure() turns recording off.
+    :param exporters: Objects with on_start(span) and on_end(span) methods, e.g. InMemoryExporter
+    """
+    global _exporters
+    _exporters = tuple(exporters)
+
+
+def is_recording():
+    return len(_exporters) > 0
+
+
+def new_trace_id():
+    return uuid.uuid4().hex
+
+
+def set_trace(trace_id):
+    """
+    Makes the spans started from now on in the current context part of a trace, e.g. the trace of a Streamlit session.
+    :param trace_id: Trace id, see new_trace_id
+    :return: Token to restore the previous trace with reset_trace
+    """
+    return _current.set((trace_id, None))
+
+
+def reset_trace(token):
+    _current.reset(token)
+
+
+@contextmanager
+def span(name, **attributes):
+    """
+    Times the code inside the with block. Exceptions are recorded in the span and raised again.
+    :param name: Name of the operation, e.g. "dhis2.getFormJson"
+    :param attributes: Values describing the operation, e.g. the number of images
+    :return: Span, or a stand-in without effect when nothing is recorded. Both have set_attributes.
+    """
+    exporters = _exporters
+    if not exporters:
+        yield NO_SPAN
+        return
+    trace_id, parent = _current.get()
+    current = Span(name, trace_id if trace_id is not None else new_trace_id(),
+                   parent.span_id if parent is not None else None, attributes)
+    token = _current.set((current.trace_id, current))
+    for exporter in exporters:
+        exporter.on_start(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        _current.reset(token)
+        current._end()
+        for exporter in exporters:
+            exporter.on_end(current)
+
+
+def set_attributes(**attributes):
+    """
+    Adds attributes to the innermost open span, e.g. from inside a function decorated with traced.
+    """
+    _, current = _current.get()
+    if current is not None:
+        current.set_attributes(**attributes)
+
+
+def traced(name=None):
+    """
+    Decorator running each call of a function, or coroutine function, in a span.
+    :param name: Name of the spans, defaults to the module and name of the function
+    """
+    def decorator(function):
+        span_name = name if name is not None else f"{function.__module__}.{function.__qualname__}"
+        if inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def async_wrapper(*args, **kwargs):
+                if not _exporters:
+                    return await function(*args, **kwargs)
+                with span(span_name):
+                    return await function(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _exporters:
+                return function(*args, **kwargs)
+            with span(span_name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def propagate(function):
+    """
+    Binds a function to the current context, so the spans it starts in another thread (e.g. a ThreadPoolExecutor
+    worker) are children of the span open here.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, each call gets its own copy
+        return context.copy().run(function, *args, **kwargs)
+
+    return run
+
+
+class InMemoryExporter:
+    """
+    Keeps the spans of the most recent traces in memory, e.g. to show the spans of a Streamlit session.
+    """
+
+    def __init__(self, max_traces=100, max_spans_per_trace=2000):
+        """
+        :param max_traces: Number of traces kept, the least recently active ones are dropped
+        :param max_spans_per_trace: Number of spans kept per trace, the oldest ones are dropped
+        """
+        self.max_traces = max_traces
+        self.max_spans_per_trace = max_spans_per_trace
+        self._traces = OrderedDict()
+        self._lock = threading.Lock()
+
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        with self._lock:
+            spans = self._traces.get(span.trace_id)
+            if spans is None:
+                spans = self._traces[span.trace_id] = deque(maxlen=self.max_spans_per_trace)
+            self._traces.move_to_end(span.trace_id)
+            spans.append(span)
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def spans(self, trace_id):
+        """
+        :return: List of the finished spans of a trace, in the order they started
+        """
+        with self._lock:
+            spans = list(self._traces.get(trace_id, ()))
+        return sorted(spans, key=lambda span: (span.start_time_ns, span.span_id))
+
+    def clear(self, trace_id=None):
+        with self._lock:
+            if trace_id is None:
+                self._traces.clear()
+            else:
+                self._traces.pop(trace_id, None)
+
+
+class OpenTelemetryExporter:
+    """
+    Reports spans to OpenTelemetry, e.g. to send them to a collector with the OTLP exporter of the OpenTelemetry SDK.
+    Needs the opentelemetry-api package; the tracer provider is configured as usual for OpenTelemetry.
+    """
+
+    def __init__(self, tracer=None):
+        """
+        :param tracer: OpenTelemetry tracer, defaults to the "msfocr" tracer of the global tracer provider
+        """
+        try:
+            from opentelemetry import trace
+        except ImportError as e:
+            raise ImportError("OpenTelemetryExporter needs the opentelemetry-api package, pip install opentelemetry-api") from e
+        self._trace = trace
+        self.tracer = tracer if tracer is not None else trace.get_tracer("msfocr")
+        self._otel_spans = {}
+        self._lock = threading.Lock()
+
+    def on_start(self, span):
+        with self._lock:
+            parent = self._otel_spans.get(span.parent_id)
+        context = self._trace.set_span_in_context(parent) if parent is not None else None
+        otel_span = self.tracer.start_span(span.name, context=context, start_time=span.start_time_ns)
+        with self._lock:
+            self._otel_spans[span.span_id] = otel_span
+
+    def on_end(self, span):
+        with self._lock:
+            otel_span = self._otel_spans.pop(span.span_id, None)
+        if otel_span is None:
+            return
+        otel_span.set_attributes({key: value if isinstance(value, (str, bool, int, float)) else str(value)
+                                  for key, value in span.attributes.items()})
+        otel_span.set_attribute("msfocr.trace_id", span.trace_id)
+        if span.error is not None:
+            otel_span.set_status(self._trace.Status(self._trace.StatusCode.ERROR, span.error))
+        otel_span.end(end_time=span.end_time_ns)
+
+
+def waterfall(spans):
+    """
+    Lays out spans for a waterfall chart.
+    :param spans: List of spans, e.g. from InMemoryExporter.spans
+    :return: List of dictionaries with the name of each span indented by its depth ("span"), its start relative to
+        the first span ("start_ms"), its end ("end_ms"), its duration ("duration_ms"), thread, attributes and error
+    """
+    if not spans:
+        return []
+    depths = {}
+    origin = min(span.start_time_ns for span in spans)
+    rows = []
+    for span in sorted(spans, key=lambda span: (span.start_time_ns, span.span_id)):
+        depth = depths[span.span_id] = depths.get(span.parent_id, -1) + 1
+        rows.append({"span": "  " * depth + span.name,
+                     "start_ms": (span.start_time_ns - origin) / 1e6,
+                     "end_ms": (span.end_time_ns - origin) / 1e6,
+                     "duration_ms": (span.end_time_ns - span.start_time_ns) / 1e6,
+                     "thread": span.thread_name,
+                     "attributes": ", ".join(f"{key}={value}" for key, value in span.attributes.items()),
+                     "error": span.error or ""})
+    return rows
@@ -0,0 +1,117 @@
+import asyncio
+import json
+
+import pandas as pd
+import pytest
+
+from msfocr import cli
+from msfocr.data.dhis2 import FormIndex
+from msfocr.data.matching import NameMatcher
+
+
+def make_table():
+    return pd.DataFrame([["", "0-11m", "12-59m"], ["BCG", "12", None], ["Polio (IPV)", "3", "-"]])
+
+
+def test_find_images(tmp_path, monkeypatch):
+    (tmp_path / "week1").mkdir()
+    for name in ["week1/a.jpg", "week1/b.PNG", "c.jpeg", "notes.txt"]:
+        (tmp_path / name).write_bytes(b"")
+
+    assert cli.find_images([str(tmp_path)]) == [str(tmp_path / name) for name in ["c.jpeg", "week1/a.jpg", "week1/b.PNG"]]
+    assert cli.find_images([str(tmp_path / "week1" / "*.jpg"), str(tmp_path / "week1" / "a.jpg")]) == [str(tmp_path / "week1" / "a.jpg")]
+    # Relative inputs give the same paths, so a resumed run matches the checkpoint
+    monkeypatch.chdir(tmp_path / "week1")
+    assert cli.find_images(["a.jpg", "../c.jpeg"]) == [str(tmp_path / name) for name in ["c.jpeg", "week1/a.jpg"]]
+
+
+def test_read_mapping(tmp_path):
+    path = tmp_path / "mapping.csv"
+    path.write_text("image,dataSet,orgUnit,period\na.jpg,ds1,ou1,2024W3\nb.jpg,ds2,,\n")
+    assert cli.read_mapping(path) == {"a.jpg": {"dataSet": "ds1", "orgUnit": "ou1", "period": "2024W3"},
+                                      "b.jpg": {"dataSet": "ds2"}}
+
+
+def test_process_images_resumes(tmp_path):
+    output = tmp_path / "results.jsonl"
+    images = ["a.jpg", "b.jpg", "c.jpg"]
+    recognized = []
+
+    def recognize(chunk, on_result):
+        recognized.extend(chunk)
+        for i, image in enumerate(chunk):
+            on_result(i, ValueError("unreadable") if image == "b.jpg" else (["Table 1"], [make_table()], None))
+
+    writer = cli.JsonlWriter(output)
+    failures = cli.process_images(images, recognize, cli.SheetProcessor(defaults={"period": "2024W3"}), writer, chunk_size=2)
+    writer.close()
+    assert failures == 1
+    records = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [record["status"] for record in records] == ["ok", "error", "ok"]
+    assert records[0]["period"] == "2024W3"
+    assert records[0]["tables"] == [{"name": "Table 1", "rows": [["", "0-11m", "12-59m"], ["BCG", "12", None], ["Polio (IPV)", "3", "-"]]}]
+    assert "payload" not in records[0]
+    assert records[1]["error"] == "ValueError: unreadable"
+
+    # A run killed while writing leaves a partial line, which is ignored and not appended to
+    with open(output, "a") as f:
+        f.write('{"image": "d.jpg", "sta')
+    assert cli.read_checkpoint(output) == {"a.jpg", "c.jpg"}
+    writer = cli.JsonlWriter(output)
+    writer.write({"image": "b.jpg", "status": "ok"})
+    writer.close()
+    assert cli.read_checkpoint(output) == {"a.jpg", "b.jpg", "c.jpg"}
+    writer = cli.JsonlWriter(output)
+    writer.write({"image": "e.jpg", "status": "partial", "payloadError": "502 Server Error"})
+    writer.close()
+    assert cli.read_checkpoint(output) == {"a.jpg", "b.jpg", "c.jpg"}
+
+
+def test_SheetProcessor_payload():
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"},
+                                   {"label": "Polio (IPV) 0-11m", "dataElement": "polioid", "categoryOptionCombo": "0to11mid"}]}]}
+    processor = cli.SheetProcessor(client=object(), defaults={"dataSet": "ds1", "orgUnit": "ou1", "period": "2024W3"},
+                                   mapping={"b.jpg": {"period": "2024W4"}})
+    # Forms are only downloaded once per data set, period and org unit
+    processor._forms[("ds1", "2024W3", "ou1")] = (FormIndex(form), NameMatcher(["BCG", "Polio (IPV)"]), NameMatcher(["0-11m", "12-59m"]))
+
+    table = make_table()
+    table.iloc[1, 0] = "BCC"
+    record = processor.record("scans/a.jpg", ["Table 1"], [table])
+    assert record["payload"] == {"dataSet": "ds1", "period": "2024W3", "orgUnit": "ou1",
+                                 "dataValues": [{"dataElement": "bcgid", "categoryOptionCombo": "0to11mid", "value": "12"},
+                                                {"dataElement": "polioid", "categoryOptionCombo": "0to11mid", "value": "3"}]}
+    # The written tables are the corrected ones, with their header row
+    assert record["tables"][0]["rows"][1][0] == "BCG"
+    assert "payloadError" not in record
+
+    processor._forms[("ds1", "2024W4", "ou1")] = (FormIndex({'groups': []}), NameMatcher(["BCG"]), NameMatcher(["0-11m"]))
+    record = processor.record("scans/b.jpg", ["Table 1"], [make_table()])
+    # Payload errors can be transient, the image is processed again on resume
+    assert record["status"] == "partial"
+    assert record["payloadError"].startswith("Unable to find")
+
+
+def test_llm_engine_records_outside_event_loop(monkeypatch):
+    from msfocr.llm import ocr_functions
+
+    def get_results(images, return_exceptions, on_result, max_concurrency):
+        async def run():
+            for i in range(len(images)):
+                on_result(i, {"tables": [{"table_name": "Table 1", "headers": ["", "0-11m"], "data": [["BCG", "2+3"]]}]})
+        asyncio.run(run())
+
+    monkeypatch.setattr(ocr_functions, "get_results", get_results)
+    recorded = {}
+
+    def on_result(i, result):
+        # Blocking work here must not hold up the event loop sending the OpenAI requests
+        with pytest.raises(RuntimeError):
+            asyncio.get_running_loop()
+        recorded[i] = result
+
+    cli.llm_engine(2)(["a.jpg", "b.jpg"], on_result)
+    assert sorted(recorded) == [0, 1]
+    names, tables, sheet_type = recorded[0]
+    assert names == ["Table 1"]
+    assert tables[0].iloc[1, 1] == "5"
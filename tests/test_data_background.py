@@ -0,0 +1,47 @@
+import threading
+
+from msfocr.data.background import BackgroundJob
+
+
+def test_BackgroundJob_reports_results_as_they_arrive():
+    release = threading.Event()
+
+    def recognize(on_result):
+        on_result(1, "page 2")
+        release.wait(5)
+        on_result(0, "page 1")
+
+    job = BackgroundJob(recognize, 2).start()
+    assert not job.wait(0.1)
+    assert job.results() == {1: "page 2"}
+    assert job.progress() == 0.5
+
+    release.set()
+    assert job.wait(5)
+    assert job.results() == {0: "page 1", 1: "page 2"}
+    assert job.progress() == 1.0
+    assert job.error is None
+
+
+def test_BackgroundJob_error_and_cancel():
+    def fail(on_result):
+        on_result(0, "page 1")
+        raise RuntimeError("model not available")
+
+    job = BackgroundJob(fail, 2).start()
+    assert job.wait(5)
+    assert isinstance(job.error, RuntimeError)
+    assert job.results() == {0: "page 1"}
+
+    release = threading.Event()
+
+    def recognize(on_result):
+        release.wait(5)
+        on_result(0, "page 1")
+
+    job = BackgroundJob(recognize, 1).start()
+    job.cancel()
+    release.set()
+    assert job.wait(5)
+    assert job.cancelled
+    assert job.results() == {}
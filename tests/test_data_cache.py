@@ -0,0 +1,109 @@
+import os
+import time
+
+import pytest
+
+from msfocr.data.cache import FormCache, MetadataCache, ResultCache
+
+
+def test_metadata_cache(tmp_path):
+    cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    cache.store("http://test.com", "dataElements", [("bcgid", "BCG", "2024-06-25T10:00:00.000"), ("polioid", "Polio (IPV)", None)])
+    cache.store("http://other.com", "dataElements", [("bcgid", "BCG other server", None)])
+
+    assert cache.get_names("http://test.com", "dataElements", ["bcgid", "polioid", "unknown"]) == {"bcgid": "BCG", "polioid": "Polio (IPV)"}
+    assert cache.get_names("http://test.com", "categoryOptionCombos", ["bcgid"]) == {}
+    assert cache.get_last_sync("http://test.com", "dataElements") is None
+
+    cache.set_last_sync("http://test.com", "dataElements", "2024-06-25T10:00:00")
+    assert not cache.is_complete("http://test.com", "dataElements")
+    cache.set_complete("http://test.com", "dataElements")
+    cache.close()
+
+    # Contents persist on disk
+    cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    assert cache.get_last_sync("http://test.com", "dataElements") == "2024-06-25T10:00:00"
+    assert cache.get_names("http://other.com", "dataElements", ["bcgid"]) == {"bcgid": "BCG other server"}
+    assert cache.is_complete("http://test.com", "dataElements")
+    assert cache.get_all_names("http://test.com", "dataElements") == {"bcgid": "BCG", "polioid": "Polio (IPV)"}
+
+    cache.clear("http://other.com")
+    assert cache.get_names("http://other.com", "dataElements", ["bcgid"]) == {}
+    assert cache.get_names("http://test.com", "dataElements", ["bcgid"]) == {"bcgid": "BCG"}
+
+
+def test_result_cache_lru_eviction(tmp_path):
+    cache = ResultCache(tmp_path / "results", max_bytes=10 ** 6)
+    keys = [ResultCache.make_key(b"image", "prompt", {"size": i}) for i in range(3)]
+    assert len(set(keys)) == 3
+
+    for i, key in enumerate(keys):
+        cache.put(key, {"tables": [], "padding": "x" * 400})
+        # Distinct, increasing modification times
+        os.utime(cache.directory / f"{key}.json", (1000 + i, 1000 + i))
+
+    # Reading the oldest result marks it as recently used
+    assert cache.get(keys[0]) == {"tables": [], "padding": "x" * 400}
+    assert cache.get("missing") is None
+
+    # Shrinking the cache to two results evicts the least recently used one
+    cache.max_bytes = 2 * (cache.directory / f"{keys[0]}.json").stat().st_size
+    cache.put(keys[0], {"tables": [], "padding": "x" * 400})
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[2]) is not None
+    assert cache.get(keys[0]) is not None
+
+
+def test_result_cache_put_keeps_running_total(tmp_path, monkeypatch):
+    cache = ResultCache(tmp_path / "results", max_bytes=10 ** 6)
+    evictions = []
+    monkeypatch.setattr(cache, "_evict", lambda: evictions.append(True))
+    for i in range(5):
+        cache.put(ResultCache.make_key(i), {"padding": "x" * 100})
+    cache.put(ResultCache.make_key(0), {"padding": "x" * 200})
+
+    # The directory is only listed to evict results once the cache is over its size limit
+    assert evictions == []
+    assert cache._total_bytes == sum(path.stat().st_size for path in cache.directory.glob("*.json"))
+
+
+def test_result_cache_put_removes_temporary_file(tmp_path):
+    cache = ResultCache(tmp_path / "results")
+    with pytest.raises(TypeError):
+        cache.put(ResultCache.make_key("unserializable"), {"value": object()})
+    assert list(cache.directory.iterdir()) == []
+
+
+def test_form_cache_period_independence(tmp_path):
+    cache = FormCache(tmp_path / "forms")
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"}]}]}
+    other_form = {'groups': [{'fields': [{"label": "BCG 12-59m", "dataElement": "bcgid", "categoryOptionCombo": "12to59mid"}]}]}
+
+    cache.put_form("http://test.com", "ds1", "2024W1", "ou1", form)
+    assert cache.get_form("http://test.com", "ds1", "2024W1", "ou1") == form
+    # One period doesn't tell whether the form depends on it
+    assert cache.get_form("http://test.com", "ds1", "2024W3", "ou1") is None
+
+    cache.put_form("http://test.com", "ds1", "2024W2", "ou1", form)
+    assert cache.get_form("http://test.com", "ds1", "2024W3", "ou1") == form
+    assert cache.get_form("http://test.com", "ds1", "2024W3", "ou2") is None
+    assert cache.get_form("http://other.com", "ds1", "2024W3", "ou1") is None
+
+    # Once a period gives other fields, every period needs its own form
+    cache.put_form("http://test.com", "ds1", "2024W4", "ou1", other_form)
+    assert cache.get_form("http://test.com", "ds1", "2024W3", "ou1") is None
+    assert cache.get_form("http://test.com", "ds1", "2024W4", "ou1") == other_form
+
+    assert cache.get_names("http://test.com", form) is None
+    cache.put_names("http://test.com", form, {"bcgid": "BCG", "0to11mid": "0-11m"})
+    assert cache.get_names("http://test.com", {'groups': [{'label': 'Renamed tab', **form['groups'][0]}]}) == {"bcgid": "BCG", "0to11mid": "0-11m"}
+    assert cache.get_names("http://test.com", other_form) is None
+
+
+def test_form_cache_ttl(tmp_path):
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"}]}]}
+    FormCache(tmp_path / "forms").put_form("http://test.com", "ds1", "2024W1", "ou1", form)
+
+    assert FormCache(tmp_path / "forms", ttl=60).get_form("http://test.com", "ds1", "2024W1", "ou1") == form
+    time.sleep(0.01)
+    assert FormCache(tmp_path / "forms", ttl=0.001).get_form("http://test.com", "ds1", "2024W1", "ou1") is None
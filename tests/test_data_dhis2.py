@@ -1,6 +1,14 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 import pandas as pd
+import pytest
 
-from msfocr.data.dhis2 import getAllUIDs, generate_key_value_pairs
+import msfocr.data.dhis2
+from msfocr.data.cache import FormCache, MetadataCache
+from msfocr.data.dhis2 import DHIS2Client, FormIndex, getAllUIDs, getDataSets, getItemsByUIDs, getResponse, get_DE_COC_List, generate_key_value_pairs, \
+    compileForm, getFormJson, importDataValueSet, mergeImportSummaries, waitForImport
 
 def test_getAllUIDs(test_server_config, requests_mock):
     requests_mock.get("http://test.com/api/categoryOptions?filter=name:ilike:12-59m", json={'categoryOptions': [{'id': 'tWRttYIzvBn', 'displayName': '12-59m'}]})
@@ -56,3 +64,205 @@ def test_generate_key_value_pairs(test_server_config, requests_mock):
     for i in range(len(data_element_pairs)):
         assert data_element_pairs[i]['value'] == answer[i]['value']
         
+
+
+def test_DHIS2Client_reuses_session(requests_mock):
+    requests_mock.get("http://client.test/api/dataSets/abc", json={'id': 'abc', 'name': 'Vaccination', 'periodType': 'Monthly'})
+    with DHIS2Client("http://client.test", "user", "pass", pool_size=2) as client:
+        session = client.session
+        assert getResponse(client.api_url("dataSets/abc"), client) == {'id': 'abc', 'name': 'Vaccination', 'periodType': 'Monthly'}
+        assert client.get_json("http://client.test/api/dataSets/abc")['name'] == 'Vaccination'
+        assert client.session is session
+
+    assert requests_mock.call_count == 2
+    assert requests_mock.last_request.headers['Authorization'].startswith('Basic ')
+    assert requests_mock.last_request.timeout == (10, 120)
+
+
+def test_DHIS2Client_retries_get_but_not_post():
+    # requests_mock replaces the transport adapter and its retries, so a real local server answers here
+    statuses = {"GET": [503, 200], "POST": [503, 200]}
+    calls = {"GET": 0, "POST": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        def respond(self):
+            status = statuses[self.command][calls[self.command]]
+            calls[self.command] += 1
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(b'{"status": "OK"}')
+
+        do_GET = do_POST = respond
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with DHIS2Client(f"http://127.0.0.1:{server.server_port}", "user", "pass", backoff_factor=0) as client:
+            assert client.get_json(client.api_url("system/ping")) == {"status": "OK"}
+            assert calls["GET"] == 2
+            # POSTs are not idempotent, their failures are left to the caller
+            assert client.post(client.api_url("dataValueSets"), json={}).status_code == 503
+            assert calls["POST"] == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_DHIS2Client_authentication_error(requests_mock):
+    requests_mock.get("http://client.test/api/33/me", status_code=401)
+    client = DHIS2Client("http://client.test", "user", "wrong_password")
+    with pytest.raises(ValueError):
+        client.get_json(client.api_url("33/me"))
+
+
+def test_getDataSets(test_server_config, requests_mock):
+    requests_mock.get("http://test.com/api/dataSets?paging=false&fields=id,name,periodType&filter=id:in:[dsB,dsA]",
+                      json={'dataSets': [{'id': 'dsA', 'name': 'Vaccination - paediatric', 'periodType': 'Weekly'},
+                                         {'id': 'dsB', 'name': 'Vaccination - other preventive', 'periodType': 'Monthly'}]})
+    result = getDataSets([{'id': 'dsB'}, {'id': 'dsA'}])
+
+    assert result == [('Vaccination - other preventive', 'dsB', 'Monthly'), ('Vaccination - paediatric', 'dsA', 'Weekly')]
+    assert requests_mock.call_count == 1
+
+
+def test_getItemsByUIDs_chunks_long_urls(test_server_config, requests_mock, monkeypatch):
+    monkeypatch.setattr(msfocr.data.dhis2, "MAX_URL_LENGTH", 100)
+    uids = [f"uid{i:08d}" for i in range(10)]
+    requests_mock.get("http://test.com/api/dataSets",
+                      json=lambda request, context: {'dataSets': [{'id': uid} for uid in uids if uid.lower() in request.url.lower()]})
+    result = getItemsByUIDs('dataSets', uids, 'id')
+
+    assert sorted(result) == uids
+    assert requests_mock.call_count > 1
+    assert all(len(request.url) <= 100 for request in requests_mock.request_history)
+
+
+def test_get_DE_COC_List(test_server_config, requests_mock, tmp_path):
+    metadata_cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"},
+                                   {"label": "BCG 12-59m", "dataElement": "bcgid", "categoryOptionCombo": "12to59mid"}]},
+                       {'fields': [{"label": "Polio (IPV) 0-11m", "dataElement": "polioid", "categoryOptionCombo": "0to11mid"}]}]}
+    # DHIS2 leaves out the formName of data elements that don't have one, their name is used instead
+    requests_mock.get("http://test.com/api/dataElements?paging=false&fields=id,formName,name,lastUpdated&filter=id:in:[bcgid,polioid]",
+                      json={'dataElements': [{'id': 'bcgid', 'formName': 'BCG', 'name': 'BCG vaccine'}, {'id': 'polioid', 'name': 'Polio (IPV)'}]})
+    requests_mock.get("http://test.com/api/categoryOptionCombos?paging=false&fields=id,name,lastUpdated&filter=id:in:[0to11mid,12to59mid]",
+                      json={'categoryOptionCombos': [{'id': '0to11mid', 'name': '0-11m'}, {'id': '12to59mid', 'name': '12-59m'}]})
+
+    expected = (['BCG', 'Polio (IPV)'], ['0-11m', '12-59m'])
+    assert get_DE_COC_List(form, metadata_cache=metadata_cache) == expected
+    assert requests_mock.call_count == 2
+
+    # Second lookup is answered from the local cache, data elements without formName included
+    assert get_DE_COC_List(form, metadata_cache=metadata_cache) == expected
+    assert requests_mock.call_count == 2
+
+    # Once the sync interval has passed, only items changed since the last sync are requested
+    metadata_cache.set_last_sync("http://test.com", "dataElements", "2024-06-25T10:00:00")
+    requests_mock.get("http://test.com/api/dataElements?paging=false&fields=id,formName,name,lastUpdated&filter=lastUpdated:gt:2024-06-24T10:00:00",
+                      json={'dataElements': [{'id': 'polioid', 'formName': 'Polio (IPV) renamed', 'lastUpdated': '2024-06-26T08:00:00.000'}]})
+    assert get_DE_COC_List(form, metadata_cache=metadata_cache) == (['BCG', 'Polio (IPV) renamed'], ['0-11m', '12-59m'])
+    assert requests_mock.call_count == 3
+
+
+def test_FormIndex_lookup():
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"}]},
+                       {'fields': [{"label": "Polio IPV 0-11m", "dataElement": "polioid", "categoryOptionCombo": "0to11mid"}]}]}
+    form_index = FormIndex(form, names={"bcgid": "BCG", "polioid": "Polio (IPV)", "0to11mid": "0-11m"})
+
+    assert form_index.lookup("BCG", "0-11m") == ("bcgid", "0to11mid")
+    assert form_index.lookup(" bcg", "0-11M ") == ("bcgid", "0to11mid")
+    # Label differs from the metadata names, found through the names of the data element and category option combo
+    assert form_index.lookup("polio (ipv)", "0-11m") == ("polioid", "0to11mid")
+    assert form_index.lookup("BCG", "12-59m") == (None, None)
+
+    df = pd.DataFrame({'0': ['BCG', 'Polio (IPV)'], '0-11m': ['12', '3'], '12-59m': [None, '-']})
+    assert generate_key_value_pairs(df, form_index) == [{"dataElement": "bcgid", "categoryOptionCombo": "0to11mid", "value": "12"},
+                                                       {"dataElement": "polioid", "categoryOptionCombo": "0to11mid", "value": "3"}]
+
+
+def test_importDataValueSet_chunks_and_polls(test_server_config, requests_mock):
+    payload = {'dataSet': 'dsid', 'period': '202406', 'orgUnit': 'ouid',
+               'dataValues': [{'dataElement': 'bcgid', 'categoryOptionCombo': '0to11mid', 'value': '12'},
+                              {'dataElement': 'polioid', 'categoryOptionCombo': '0to11mid', 'value': '3'},
+                              {'dataElement': 'bcgid', 'categoryOptionCombo': '12to59mid', 'value': 'x'}]}
+    requests_mock.post("http://test.com/api/dataValueSets?async=true&dryRun=true",
+                       [{'json': {'response': {'id': 'job1'}}}, {'json': {'response': {'id': 'job2'}}}])
+    # The first job is still running at the first check
+    requests_mock.get("http://test.com/api/system/tasks/DATAVALUE_IMPORT/job1",
+                      [{'json': [{'completed': False}]}, {'json': [{'completed': True}, {'completed': False}]}])
+    requests_mock.get("http://test.com/api/system/tasks/DATAVALUE_IMPORT/job2", json=[{'completed': True}])
+    requests_mock.get("http://test.com/api/system/taskSummaries/DATAVALUE_IMPORT/job1",
+                      json={'status': 'SUCCESS', 'importCount': {'imported': 1, 'updated': 1, 'ignored': 0, 'deleted': 0}})
+    requests_mock.get("http://test.com/api/system/taskSummaries/DATAVALUE_IMPORT/job2",
+                      json={'status': 'WARNING', 'importCount': {'imported': 0, 'updated': 0, 'ignored': 1, 'deleted': 0},
+                            'conflicts': [{'object': 'x', 'value': 'Value must be a positive integer', 'indexes': [0]}]})
+    chunks = []
+
+    summary = importDataValueSet(json.dumps(payload), dry_run=True, chunk_size=2, poll_interval=0.01,
+                                 on_chunk=lambda i, chunk_summary: chunks.append(i))
+
+    assert chunks == [0, 1]
+    assert summary == {'status': 'WARNING', 'imported': 1, 'updated': 1, 'ignored': 1, 'deleted': 0,
+                       'conflicts': [{'index': 2, 'dataElement': 'bcgid', 'categoryOptionCombo': '12to59mid', 'value': 'x',
+                                      'object': 'x', 'error': 'Value must be a positive integer'}]}
+    posted = [request.json() for request in requests_mock.request_history if request.method == 'POST']
+    assert [len(chunk['dataValues']) for chunk in posted] == [2, 1]
+    assert all(chunk['dataSet'] == 'dsid' and chunk['orgUnit'] == 'ouid' for chunk in posted)
+
+
+def test_mergeImportSummaries_unknown_status():
+    def summary(status, imported):
+        return {'status': status, 'imported': imported, 'updated': 0, 'ignored': 0, 'deleted': 0, 'conflicts': []}
+
+    assert mergeImportSummaries([summary('OK', 1), summary('WARNING', 2)])['status'] == 'WARNING'
+    # A status DHIS2 added later doesn't break the report and isn't hidden behind a better one
+    merged = mergeImportSummaries([summary('OK', 1), summary('PARTIAL_SUCCESS', 2), summary('ERROR', 0)])
+    assert merged['status'] == 'PARTIAL_SUCCESS'
+    assert merged['imported'] == 3
+
+
+def test_waitForImport_timeout(test_server_config, requests_mock):
+    requests_mock.get("http://test.com/api/system/tasks/DATAVALUE_IMPORT/job1", json=[])
+    with pytest.raises(TimeoutError):
+        waitForImport('job1', poll_interval=0.01, timeout=0.05)
+
+
+def test_getFormJson_caches_forms(test_server_config, requests_mock, tmp_path):
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"}]}]}
+    form_cache = FormCache(tmp_path / "forms")
+    requests_mock.get("http://test.com/api/dataSets/dsid/form.json", json=form)
+    priming = requests_mock.post("http://test.com/api/dataValueSets?dryRun=true", json={})
+
+    for period in ["2024W1", "2024W2", "2024W3", "2024W2"]:
+        assert getFormJson("dsid", period, "ouid", form_cache=form_cache) == form
+    # The form was the same for the first two periods, so the third comes from the cache, without priming
+    assert requests_mock.call_count == 2
+    assert not priming.called
+
+
+def test_getFormJson_primes_form_on_failure(test_server_config, requests_mock, tmp_path):
+    form = {'groups': []}
+    requests_mock.get("http://test.com/api/dataSets/dsid/form.json", [{'status_code': 409}, {'json': form}])
+    priming = requests_mock.post("http://test.com/api/dataValueSets?dryRun=true", json={})
+
+    assert getFormJson("dsid", "2024W1", "ouid", form_cache=FormCache(tmp_path / "forms")) == form
+    assert priming.call_count == 1
+    assert priming.last_request.json() == {"dataSet": "dsid", "period": "2024W1", "orgUnit": "ouid", "dataValues": []}
+
+
+def test_compileForm_stores_names(test_server_config, requests_mock, tmp_path):
+    form = {'groups': [{'fields': [{"label": "BCG 0-11m", "dataElement": "bcgid", "categoryOptionCombo": "0to11mid"}]}]}
+    metadata_cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    form_cache = FormCache(tmp_path / "forms")
+    requests_mock.get("http://test.com/api/dataElements", json={'dataElements': [{'id': 'bcgid', 'formName': 'BCG'}]})
+    requests_mock.get("http://test.com/api/categoryOptionCombos", json={'categoryOptionCombos': [{'id': '0to11mid', 'name': '0-11m'}]})
+
+    assert compileForm(form, metadata_cache=metadata_cache, form_cache=form_cache).lookup("bcg", "0-11M") == ("bcgid", "0to11mid")
+    n_requests = requests_mock.call_count
+    assert compileForm(form, metadata_cache=metadata_cache, form_cache=form_cache).by_name == {("bcg", "0-11m"): ("bcgid", "0to11mid")}
+    assert requests_mock.call_count == n_requests
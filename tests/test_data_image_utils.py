@@ -0,0 +1,86 @@
+from io import BytesIO
+
+from PIL import Image
+
+from msfocr.data import image_utils
+
+
+def make_image_file(size=(1200, 900), orientation=None):
+    image = Image.new("RGB", size, color=(200, 30, 30))
+    exif = Image.Exif()
+    if orientation is not None:
+        exif[0x0112] = orientation
+    buffered = BytesIO()
+    image.save(buffered, format="JPEG", exif=exif)
+    buffered.seek(0)
+    return buffered
+
+
+def test_normalize_image():
+    # Red top left corner, so that every rotation and mirroring is visible
+    upright = Image.new("RGB", (64, 32), color=(0, 0, 255))
+    upright.paste((255, 0, 0), (0, 0, 32, 16))
+    inverse = {Image.Transpose.ROTATE_270: Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_90: Image.Transpose.ROTATE_270}
+    for orientation in range(1, 9):
+        transpose = image_utils.ORIENTATION_TRANSPOSES.get(orientation)
+        stored = upright.transpose(inverse.get(transpose, transpose)) if transpose is not None else upright
+        exif = Image.Exif()
+        exif[image_utils.ORIENTATION_TAG] = orientation
+        buffered = BytesIO()
+        stored.save(buffered, format="JPEG", quality=95, exif=exif)
+
+        metadata = image_utils.get_image_metadata(buffered)
+        assert metadata["orientation"] == orientation
+        assert metadata["dimensions"] == stored.size
+        assert metadata["display_dimensions"] == (64, 32)
+
+        image = image_utils.normalize_image(buffered)
+        assert image.size == (64, 32)
+        assert max(abs(a - b) for a, b in zip(image.getpixel((4, 4)), (255, 0, 0))) <= 10
+        assert max(abs(a - b) for a, b in zip(image.getpixel((60, 28)), (0, 0, 255))) <= 10
+    assert image_utils.normalize_image(buffered, mode="L").mode == "L"
+
+
+def test_create_preview():
+    preview = image_utils.create_preview(make_image_file(), max_size=400)
+    assert preview["mime_type"] == "image/jpeg"
+    assert preview["dimensions"] == (400, 300)
+    assert preview["original_dimensions"] == (1200, 900)
+    assert preview["tiles"] is None
+    with Image.open(BytesIO(preview["data"])) as image:
+        assert image.size == (400, 300)
+
+    # Orientation 6 is a photo taken with the phone held upright
+    preview = image_utils.create_preview(make_image_file(orientation=6), max_size=400, format="webp")
+    assert preview["mime_type"] == "image/webp"
+    assert preview["dimensions"] == (300, 400)
+    assert preview["original_dimensions"] == (900, 1200)
+
+
+def test_create_tile_pyramid():
+    levels = image_utils.create_tile_pyramid(Image.new("RGB", (1200, 900)), tile_size=512)
+    assert [level["scale"] for level in levels] == [1, 2, 4]
+    assert [level["grid"] for level in levels] == [(3, 2), (2, 1), (1, 1)]
+    assert [level["dimensions"] for level in levels] == [(1200, 900), (600, 450), (300, 225)]
+    with Image.open(BytesIO(levels[0]["tiles"][(2, 1)])) as tile:
+        # Tiles on the edges are cut to the image
+        assert tile.size == (1200 - 1024, 900 - 512)
+
+
+def test_PreviewCache():
+    cache = image_utils.PreviewCache(max_entries=2, tile_size=512, max_size=400)
+    first = make_image_file()
+    preview = cache.get(first)
+    assert preview["tiles"] is None
+    assert cache.get(make_image_file()) is preview
+
+    tiled = cache.get(first, tiles=True)
+    assert tiled["data"] == preview["data"]
+    assert len(tiled["tiles"]) == 3
+    assert cache.get(first) is tiled
+
+    cache.get(make_image_file(size=(640, 480)))
+    cache.get(make_image_file(size=(800, 600)), key="upload")
+    # The first image was used least recently and is dropped
+    assert len(cache._previews) == 2
+    assert cache.get(first) is not tiled
@@ -0,0 +1,31 @@
+import pandas as pd
+import pytest
+
+from msfocr.data import matching, post_processing
+
+
+def test_NameMatcher_match():
+    vocabulary = ['BCG', 'Polio (OPV) 1 (from 6 wks)', 'Polio (OPV) 2', 'Polio (IPV)']
+    matcher = matching.NameMatcher(vocabulary)
+    queries = ['BC6', 'Polio (OPV) 1 (from 6 wk)', 'Poli0 (IPV)', None, 'zzz']
+
+    matches = matcher.match(queries)
+
+    assert [name for name, _ in matches] == ['BCG', 'Polio (OPV) 1 (from 6 wks)', 'Polio (IPV)', None, '']
+    # Scores agree with letter_by_letter_similarity
+    for query, (name, score) in zip(queries[:3], matches[:3]):
+        assert score == pytest.approx(post_processing.letter_by_letter_similarity(query, name))
+
+
+def test_correct_table_names():
+    table = pd.DataFrame([['', '0-11n', '12-59m'], ['BCG', '12', '3'], ['Poli IPV', '4', ''], [' ', '1', '2']])
+    dataElement_matcher = matching.NameMatcher(['BCG', 'Polio (IPV)'])
+    categoryOption_matcher = matching.NameMatcher(['0-11m', '12-59m'])
+
+    low_confidence = matching.correct_table_names([table], dataElement_matcher, categoryOption_matcher)
+
+    assert table.iloc[:, 0].tolist() == ['', 'BCG', 'Polio (IPV)', ' ']
+    assert table.iloc[0, 1:].tolist() == ['0-11m', '12-59m']
+    assert table.iloc[1:, 1:].values.tolist() == [['12', '3'], ['4', ''], ['1', '2']]
+    # Empty cells, like the corner cell, are left alone and not reported
+    assert low_confidence == []
@@ -1,4 +1,5 @@
 import pandas as pd
+import pytest
 
 from msfocr.data import post_processing
 
@@ -21,4 +22,90 @@ def test_evaluate_cells():
         3: ["Column 3", "20", "12"]
     })
     
-    assert post_processing.evaluate_cells([df])[0].equals(answer)
\ No newline at end of file
+    assert post_processing.evaluate_cells([df])[0].equals(answer)
+
+def test_evaluate_cells_status():
+    """
+    Tests if cells that can't be evaluated are kept and reported without skipping the rest of their column
+    """
+    df = pd.DataFrame({
+        0: ["", "Row 1", "Row 2", "Row 3"],
+        1: ["Column 1", "45 + 29", "abc", "2*3"],
+        2: ["Column 2", None, "007", "1+"]
+    })
+
+    tables, status = post_processing.evaluate_cells([df], return_status=True)
+
+    assert tables[0].iloc[1:, 1].tolist() == ["74", "abc", "6"]
+    assert pd.isna(tables[0].iloc[1, 2])
+    assert tables[0].iloc[2:, 2].tolist() == ["7", "1+"]
+    assert status[0].values.tolist() == [[False, False, False],
+                                         [False, False, False],
+                                         [False, True, False],
+                                         [False, False, True]]
+
+
+def test_clean_up():
+    """
+    Tests if None values are replaced by empty strings, in a copy or in place
+    """
+    df = pd.DataFrame({
+        0: ["", "Row 1", "Row 2"],
+        1: ["Column 1", None, "None"],
+        2: ["Column 2", "12", None]
+    })
+    answer = pd.DataFrame({
+        0: ["", "Row 1", "Row 2"],
+        1: ["Column 1", "", ""],
+        2: ["Column 2", "12", ""]
+    })
+
+    cleaned = post_processing.clean_up([df])
+    assert cleaned[0].equals(answer)
+    assert df.iloc[1, 1] is None or pd.isna(df.iloc[1, 1])
+
+    cleaned = post_processing.clean_up([df], inplace=True)
+    assert cleaned[0] is df
+    assert df.equals(answer)
+
+
+def test_get_yyyy_mm_dd():
+    """
+    Tests if whole-text dates in the default formats are converted, and other text is not.
+    """
+    assert post_processing.get_yyyy_mm_dd("2024-06-25") == "2024-06-25"
+    assert post_processing.get_yyyy_mm_dd("25/06/2024") == "2024-06-25"
+    # Month first is preferred for ambiguous dates, as in the order of DATE_FORMATS
+    assert post_processing.get_yyyy_mm_dd("06/05/2024") == "2024-06-05"
+    assert post_processing.get_yyyy_mm_dd("June 25, 2024") == "2024-06-25"
+    assert post_processing.get_yyyy_mm_dd("25 june 2024") == "2024-06-25"
+    assert post_processing.get_yyyy_mm_dd("Jun 25, 2024") == "2024-06-25"
+    # Stray spaces before numbers, common in OCR'd headers
+    assert post_processing.get_yyyy_mm_dd(" 5/6/2024") == "2024-05-06"
+    assert post_processing.get_yyyy_mm_dd("5/ 6/2024") == "2024-05-06"
+    assert post_processing.get_yyyy_mm_dd("2024-01- 5") == "2024-01-05"
+    assert post_processing.get_yyyy_mm_dd("30/02/2024") is None
+    assert post_processing.get_yyyy_mm_dd("Period: 2024-06-25") is None
+    assert post_processing.get_yyyy_mm_dd("BCG 12") is None
+
+
+def test_DateRecognizer_find_dates():
+    """
+    Tests if dates embedded in longer text are found, with formats and month names of another language.
+    """
+    recognizer = post_processing.DateRecognizer()
+    assert recognizer.find_dates("Period: 25/06/2024 - 30/06/2024, printed 1 July 2024") == ["2024-06-25", "2024-06-30", "2024-07-01"]
+    assert recognizer.find_dates("Ref 12024-06-25") == []
+
+    french = post_processing.DateRecognizer(["%d %B %Y", "%d/%m/%y"], month_names={"juin": 6, "juillet": 7})
+    assert french.find_dates("Période du 25 juin 2024 au 3 Juillet 2024, saisi le 04/07/24") == ["2024-06-25", "2024-07-03", "2024-07-04"]
+
+    with pytest.raises(ValueError):
+        post_processing.DateRecognizer(["%H:%M"])
+
+
+def test_set_first_row_as_header():
+    df = pd.DataFrame([["", "0-11m"], ["BCG", "12"]])
+    df = post_processing.set_first_row_as_header(df)
+    assert list(df.columns) == ["", "0-11m"]
+    assert df.values.tolist() == [["BCG", "12"]]
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from msfocr.data.cache import MetadataCache
+from msfocr.data.sheet_type import SheetClassifier
+
+
+def create_ocr_result(lines):
+    """
+    Mimics a docTR result with one block per line, lines are given as (text, top of the line relative to the page).
+    """
+    blocks = [SimpleNamespace(lines=[SimpleNamespace(geometry=((0.1, top), (0.9, top + 0.02)),
+                                                     words=[SimpleNamespace(value=word) for word in text.split()])])
+              for text, top in lines]
+    return SimpleNamespace(pages=[SimpleNamespace(blocks=blocks)])
+
+
+def test_SheetClassifier_classify():
+    classifier = SheetClassifier(["Vaccination - paediatric", "Vaccination - other preventive", "Malaria"], ["W-14", "W-15"])
+    res = create_ocr_result([("Vaccinati0n - paediatric", 0.05),
+                             ("W-14", 0.1),
+                             ("Period: 2024-06-25 to 30/06/2024", 0.15),
+                             ("BCG 12", 0.5),
+                             # Dates and names below the header are not part of the sheet type
+                             ("2024-07-01", 0.8),
+                             ("W-15", 0.9)])
+
+    assert classifier.classify(res) == ["Vaccination - paediatric", "W-14", ["2024-06-25", "2024-06-30"]]
+
+    whole_page = SheetClassifier(["Malaria"], ["W-14"], header_fraction=1)
+    assert whole_page.classify(res)[2] == ["2024-06-25", "2024-06-30", "2024-07-01"]
+    assert SheetClassifier([], []).classify(res)[:2] == ["", ""]
+
+
+def test_SheetClassifier_from_dhis2(test_server_config, requests_mock, tmp_path):
+    metadata_cache = MetadataCache(tmp_path / "metadata.sqlite3")
+    requests_mock.get("http://test.com/api/dataSets?paging=false&fields=id,name,lastUpdated",
+                      json={'dataSets': [{'id': 'vaccid', 'name': 'Vaccination - paediatric'}, {'id': 'malid', 'name': 'Malaria'}]})
+    requests_mock.get("http://test.com/api/organisationUnits?paging=false&fields=id,name,lastUpdated",
+                      json={'organisationUnits': [{'id': 'w14id', 'name': 'W-14'}]})
+
+    classifier = SheetClassifier.from_dhis2(metadata_cache=metadata_cache)
+    assert sorted(classifier.dataSet_matcher.vocabulary) == ['Malaria', 'Vaccination - paediatric']
+    assert classifier.orgUnit_matcher.vocabulary == ['W-14']
+    assert requests_mock.call_count == 2
+
+    # Names are only downloaded once
+    SheetClassifier.from_dhis2(metadata_cache=metadata_cache)
+    assert requests_mock.call_count == 2
@@ -1,3 +1,8 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
 from doctr.io import DocumentFile
 from doctr.models import ocr_predictor
 from img2table.document import Image
@@ -28,19 +33,121 @@ def test_get_tabular_content(datadir):
     Tests if all rows and columns of every table in the sample image is detected correctly.
     """
     img_path = str(datadir / 'IMG_20240514_091004.jpg')
-    document = DocumentFile.from_images(img_path)
-
-    ocr_model = ocr_predictor(det_arch='db_resnet50', reco_arch='crnn_vgg16_bn', pretrained=True)
-
-    result = ocr_functions.get_word_level_content(ocr_model, document)
-
-    confidence_lookup_dict = ocr_functions.get_confidence_values(result)
 
     doctr_ocr = DocTR(detect_language=False)
     img = Image(src=img_path)  # , detect_rotation=True
-    table_df, confidence_df = ocr_functions.get_tabular_content_with_confidence(doctr_ocr, img, confidence_lookup_dict)
+    table_df, confidence_df = ocr_functions.get_tabular_content_with_confidence(doctr_ocr, img)
 
     assert len(table_df) == 2
 
     assert table_df[0].shape == (8,4)
-    assert table_df[1].shape == (5,4)
\ No newline at end of file
+    assert table_df[1].shape == (5,4)
+
+    assert [confidence.shape for confidence in confidence_df] == [(8,4), (5,4)]
+    assert all(confidence.dtype == np.float32 for confidence in confidence_df)
+    assert all(((confidence >= 0) & (confidence <= 1)).all() for confidence in confidence_df)
+
+
+def test_get_cell_confidences():
+    """
+    Tests if word confidences are averaged per cell by position, including repeated words and merged cells.
+    """
+    def cell(x1, y1, x2, y2):
+        return SimpleNamespace(bbox=SimpleNamespace(x1=x1, y1=y1, x2=x2, y2=y2))
+
+    merged = cell(0, 0, 200, 50)
+    table = SimpleNamespace(content={0: [merged, merged],
+                                     1: [cell(0, 50, 100, 100), cell(100, 50, 200, 100)]})
+
+    def word(x1, y1, x2, y2, confidence):
+        return SimpleNamespace(value="0", confidence=confidence, geometry=((x1 / 200, y1 / 100), (x2 / 200, y2 / 100)))
+
+    page = SimpleNamespace(dimensions=(100, 200), blocks=[SimpleNamespace(lines=[SimpleNamespace(words=[
+        word(10, 10, 90, 40, 0.9), word(110, 10, 190, 40, 0.7),
+        word(10, 60, 40, 90, 0.8), word(50, 60, 90, 90, 0.6),
+        word(300, 300, 310, 310, 0.1)])])])
+
+    word_boxes, word_confidences = ocr_functions.get_word_boxes(page)
+    confidences = ocr_functions.get_cell_confidences(table, word_boxes, word_confidences)
+
+    assert confidences.dtype == np.float32
+    np.testing.assert_allclose(confidences, [[0.8, 0.8], [0.7, 0.0]], rtol=1e-6)
+
+def test_iter_tabular_content(datadir):
+    """
+    Tests if tables of several sheets processed concurrently come back in page order.
+    """
+    img_path = str(datadir / 'IMG_20240514_091004.jpg')
+    models = ocr_functions.create_ocr_models(2)
+
+    results = list(ocr_functions.iter_tabular_content([img_path, img_path, img_path], models))
+
+    assert [page_index for page_index, _ in results] == [0, 1, 2]
+    for _, table_df in results:
+        assert len(table_df) == 2
+        assert table_df[0].shape == (8,4)
+
+
+def test_iter_tabular_content_shared_model_pool(datadir):
+    """
+    Tests if concurrent iterations sharing a model pool never use the same model on two threads at once.
+    """
+    img_path = str(datadir / 'IMG_20240514_091004.jpg')
+    model_pool = ocr_functions.create_model_pool(["model"])
+    in_use = []
+    max_in_use = []
+    lock = threading.Lock()
+
+    def recognize(model, image):
+        with lock:
+            in_use.append(model)
+            max_in_use.append(in_use.count(model))
+        time.sleep(0.05)
+        with lock:
+            in_use.remove(model)
+        return model
+
+    def iterate():
+        list(ocr_functions._iter_concurrently(recognize, [img_path, img_path], model_pool))
+
+    threads = [threading.Thread(target=iterate) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert max(max_in_use) == 1
+    assert model_pool.qsize() == 1
+
+def test_get_tabular_content_batch(datadir):
+    """
+    Tests if batched inference over several images finds the same tables as processing them one by one.
+    """
+    img_paths = [str(datadir / 'IMG_20240514_091004.jpg'), str(datadir / 'IMG_20240514_090947.png')]
+    doctr_ocr = DocTR(detect_language=False)
+
+    batch_tables = ocr_functions.get_tabular_content_batch(doctr_ocr, [Image(src=path) for path in img_paths], batch_size=2)
+    single_tables = [ocr_functions.get_tabular_content(doctr_ocr, Image(src=path)) for path in img_paths]
+
+    assert len(batch_tables) == 2
+    for batch_df, single_df in zip(batch_tables, single_tables):
+        assert [df.shape for df in batch_df] == [df.shape for df in single_df]
+
+    documents = [DocumentFile.from_images(path) for path in img_paths]
+    results = ocr_functions.get_word_level_content_batch(doctr_ocr.model, documents)
+    assert [len(result.pages) for result in results] == [1, 1]
+
+
+def test_get_sheet_content(datadir):
+    """
+    Tests if the combined single OCR pass gives the same tables and sheet type as the separate functions.
+    """
+    img_path = str(datadir / 'IMG_20240514_090947.png')
+    doctr_ocr = DocTR(detect_language=False)
+
+    table_df, confidence_df, sheet_type = ocr_functions.get_sheet_content(doctr_ocr, Image(src=img_path))
+
+    assert [df.shape for df in table_df] == [df.shape for df in ocr_functions.get_tabular_content(doctr_ocr, Image(src=img_path))]
+    assert [confidence.shape for confidence in confidence_df] == [df.shape for df in table_df]
+    assert sheet_type[0] == "Vaccination - paediatric"
+    assert sheet_type[1] == "W-14"
@@ -1,5 +1,9 @@
+import asyncio
+import time
+
 import pytest
-from unittest.mock import patch
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
 from typing import Optional
 from requests.models import Response
 import pandas as pd
@@ -8,8 +12,9 @@ from io import BytesIO
 import base64
 
 import openai
-from openai import APIConnectionError, AuthenticationError, APIStatusError
+from openai import APIConnectionError, AuthenticationError, APIStatusError, RateLimitError
 
+from msfocr.data.cache import ResultCache
 from msfocr.llm import ocr_functions
 
 'Part1-testing llm_ocr_function'
@@ -103,15 +108,43 @@ def test_encode_image():
     # Encode the image using the encode_image function
     encoded_string = ocr_functions.encode_image(buffered)
 
-    # Verify that the encoded string is a valid base64 string
+    # Verify that the encoded string is a valid base64 string, in the format of DEFAULT_ENCODING
     decoded_image = base64.b64decode(encoded_string)
-    assert decoded_image[:8] == b'\x89PNG\r\n\x1a\n'
+    assert decoded_image[:3] == b'\xff\xd8\xff'
+    assert base64.b64decode(ocr_functions.encode_image(buffered, format="PNG"))[:8] == b'\x89PNG\r\n\x1a\n'
 
     # Optionally, check if the image can be successfully loaded back
     img_back = Image.open(BytesIO(decoded_image))
     assert max(img_back.size) == 2048 or min(img_back.size) == 768
 
 
+def test_encode_image_payload():
+    # Noise compresses like a photo, unlike a plain color
+    img = Image.effect_noise((3000, 1500), 64).convert('RGB')
+    buffered = BytesIO()
+    img.save(buffered, format="JPEG", quality=95)
+    png_size = len(base64.b64decode(ocr_functions.encode_image(buffered, format="PNG")))
+
+    payload = ocr_functions.encode_image_payload(buffered, format="JPEG", quality=80, grayscale=True)
+
+    assert payload["mime_type"] == "image/jpeg"
+    assert payload["dimensions"] == (1536, 768)
+    decoded_image = base64.b64decode(payload["data"])
+    assert payload["size"] == len(decoded_image)
+    assert payload["size"] < png_size
+    img_back = Image.open(BytesIO(decoded_image))
+    assert img_back.format == "JPEG"
+    assert img_back.mode == "L"
+    assert img_back.size == (1536, 768)
+
+    payload = ocr_functions.encode_image_payload(buffered, format="webp", max_size=1000)
+    assert payload["mime_type"] == "image/webp"
+    assert payload["dimensions"] == (1000, 500)
+
+    with pytest.raises(ValueError):
+        ocr_functions.encode_image_payload(buffered, format="GIF")
+
+
 def create_test_image_with_orientation(orientation):
     # Create a simple image
     img = Image.new('RGB', (100, 50), color='red')
@@ -160,6 +193,104 @@ def test_correct_image_orientation():
     assert_color_within_tolerance(corrected_image.getpixel((corrected_image.size[0] - 1, 0)), (255, 0, 0))
 
 
+class FakeAsyncCompletions:
+    """Stands in for AsyncOpenAI().chat.completions, answering based on the text of the image."""
+    def __init__(self, failures):
+        self.failures = failures
+        self.calls = 0
+
+    async def create(self, model, messages, **kwargs):
+        self.calls += 1
+        url = messages[0]["content"][1]["image_url"]["url"]
+        if url in self.failures and self.failures[url]:
+            raise self.failures[url].pop(0)
+        content = '{"tables": [], "non_table_data": {"size": "%d"}}' % len(url)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+class FakeAsyncClient:
+    def __init__(self, failures=None):
+        self.chat = SimpleNamespace(completions=FakeAsyncCompletions(failures or {}))
+
+
+def create_test_image_file(color):
+    buffered = BytesIO()
+    Image.new('RGB', (60, 30), color=color).save(buffered, format="PNG")
+    buffered.seek(0)
+    return buffered
+
+
+def test_extract_text_from_batch_images_retries_and_isolates_errors():
+    images = [create_test_image_file(color) for color in ('red', 'green', 'blue')]
+    payloads = [ocr_functions.encode_image_payload(image, **ocr_functions.DEFAULT_ENCODING) for image in images]
+    urls = [f"data:{payload['mime_type']};base64,{payload['data']}" for payload in payloads]
+    rate_limited = RateLimitError("Slow down", response=Mock(status_code=429, headers={"retry-after": "0"}), body=None)
+    unauthorized = AuthenticationError("Invalid API key", response=Mock(status_code=401, headers={}), body=None)
+    client = FakeAsyncClient({urls[0]: [rate_limited, rate_limited], urls[1]: [unauthorized]})
+
+    results = ocr_functions.extract_text_from_batch_images(images, return_exceptions=True, client=client, requests_per_minute=6000)
+
+    assert results[0] == {"tables": [], "non_table_data": {"size": str(len(urls[0]))}}
+    assert results[1] is unauthorized
+    assert results[2] == {"tables": [], "non_table_data": {"size": str(len(urls[2]))}}
+    # Two rate limited attempts retried, the authentication error is not retried
+    assert client.chat.completions.calls == 5
+
+    with pytest.raises(AuthenticationError):
+        ocr_functions.extract_text_from_batch_images(images, client=FakeAsyncClient({urls[1]: [unauthorized]}), requests_per_minute=6000)
+
+
+def test_extract_text_from_batch_images_cancelled():
+    images = [create_test_image_file(color) for color in ('red', 'green', 'blue')]
+    client = FakeAsyncClient()
+    reported = {}
+
+    def on_result(i, result):
+        reported[i] = result
+
+    # Cancelled once the first image is done, the others are not sent
+    results = ocr_functions.extract_text_from_batch_images(images, return_exceptions=True, client=client, requests_per_minute=6000,
+                                                           max_concurrency=1, on_result=on_result, cancelled=lambda: len(reported) > 0)
+    assert client.chat.completions.calls == 1
+    assert isinstance(results[0], dict)
+    assert all(isinstance(result, ocr_functions.BatchCancelledError) for result in results[1:])
+
+
+def test_rate_limiter_concurrent_pauses_do_not_add_up():
+    async def pause_then_acquire():
+        rate_limiter = ocr_functions.AsyncRateLimiter(6000)
+
+        async def rate_limited():
+            rate_limiter.pause(0.3)
+
+        await asyncio.gather(*(rate_limited() for _ in range(4)))
+        start = time.monotonic()
+        await rate_limiter.acquire()
+        return time.monotonic() - start
+
+    waited = asyncio.run(pause_then_acquire())
+    assert 0.25 <= waited < 0.6
+
+
+def test_get_results_uses_cache(tmp_path):
+    cache = ResultCache(tmp_path / "llm_results")
+    images = [create_test_image_file('red'), create_test_image_file('green')]
+    client = FakeAsyncClient()
+
+    first_results = ocr_functions.get_results(images, cache=cache, client=client, requests_per_minute=6000)
+    assert client.chat.completions.calls == 2
+
+    # Only the new image is sent to the API
+    images.append(create_test_image_file('blue'))
+    reported = {}
+    results = ocr_functions.get_results(images, cache=cache, client=client, requests_per_minute=6000,
+                                        on_result=reported.__setitem__)
+    assert client.chat.completions.calls == 3
+    assert results[:2] == first_results
+    # Every image is reported, cached ones included
+    assert reported == dict(enumerate(results))
+
+
 'Part2-testing openai api call'
 class AIHandler:
     MODEL = "gpt-4o"
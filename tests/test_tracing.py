@@ -0,0 +1,97 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from msfocr import tracing
+from msfocr.data.background import BackgroundJob
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.InMemoryExporter()
+    tracing.configure(exporter)
+    token = tracing.set_trace("test")
+    yield exporter
+    tracing.reset_trace(token)
+    tracing.configure()
+
+
+@tracing.traced("test.add")
+def add(a, b):
+    tracing.set_attributes(result=a + b)
+    return a + b
+
+
+@tracing.traced("test.add_async")
+async def add_async(a, b):
+    await asyncio.sleep(0)
+    return add(a, b)
+
+
+def test_nothing_recorded_by_default():
+    assert not tracing.is_recording()
+    with tracing.span("test.nothing") as span:
+        span.set_attributes(images=3)
+    assert add(1, 2) == 3
+
+
+def test_spans_nest(exporter):
+    with tracing.span("test.outer", images=2):
+        assert add(1, 2) == 3
+        assert asyncio.run(add_async(2, 3)) == 5
+        with pytest.raises(ValueError):
+            with tracing.span("test.failing"):
+                raise ValueError("unreadable image")
+
+    spans = {span.name: span for span in exporter.spans("test")}
+    assert [span.name for span in exporter.spans("test")] == ["test.outer", "test.add", "test.add_async", "test.add", "test.failing"]
+    outer = spans["test.outer"]
+    assert outer.parent_id is None
+    assert outer.attributes == {"images": 2}
+    assert spans["test.add_async"].parent_id == outer.span_id
+    # The synchronous call inside the coroutine is a child of the coroutine's span
+    assert exporter.spans("test")[3].parent_id == spans["test.add_async"].span_id
+    assert exporter.spans("test")[1].attributes == {"result": 3}
+    assert spans["test.failing"].error == "ValueError: unreadable image"
+    assert outer.duration >= spans["test.add_async"].duration >= 0
+
+    rows = tracing.waterfall(exporter.spans("test"))
+    assert [row["span"] for row in rows] == ["test.outer", "  test.add", "  test.add_async", "    test.add", "  test.failing"]
+    assert rows[0]["start_ms"] == 0
+    assert rows[-1]["error"] == "ValueError: unreadable image"
+
+
+def test_spans_follow_threads(exporter):
+    with tracing.span("test.batch") as batch:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert list(executor.map(tracing.propagate(add), [1, 2], [3, 4])) == [4, 6]
+        job = BackgroundJob(lambda on_result: on_result(0, add(5, 6)), 1).start()
+        assert job.wait(5)
+
+    # Threads started without propagating the context start their own trace
+    thread = threading.Thread(target=add, args=(0, 0))
+    thread.start()
+    thread.join()
+
+    spans = exporter.spans("test")
+    assert len(spans) == 4
+    assert all(span.parent_id == batch.span_id for span in spans if span.name == "test.add")
+    assert tracing.waterfall([]) == []
+
+
+def test_InMemoryExporter_limits(exporter):
+    exporter.max_traces = 2
+    exporter.max_spans_per_trace = 3
+    for trace_id in ["a", "b", "c"]:
+        token = tracing.set_trace(trace_id)
+        for i in range(5):
+            add(i, i)
+        tracing.reset_trace(token)
+
+    assert exporter.spans("a") == []
+    assert [span.attributes["result"] for span in exporter.spans("c")] == [4, 6, 8]
+    exporter.clear("c")
+    assert exporter.spans("c") == []
+    assert len(exporter.spans("b")) == 3